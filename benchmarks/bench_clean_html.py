@@ -0,0 +1,113 @@
+"""clean_html_content 的微基准与一致性校验
+
+用法：python benchmarks/bench_clean_html.py [chatHis.txt]
+传入原始日志时，会额外抽取其中的htmlBody加入校验语料和基准。
+"""
+import json
+import os
+import re
+import sys
+import timeit
+from html import unescape
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from convert_data import clean_html_content
+
+def legacy_clean_html_content(html):
+    """改写前的实现，作为一致性校验的参照"""
+    clean_text = re.sub(r'<[^>]+>', '', str(html))
+    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+    return clean_text
+
+# 单次扫描的对照实现：一个预编译正则同时匹配标签、实体和空白，由Python回调逐个替换。
+# 只用于基准比较，说明convert_data保留三次C层处理（各自按'<'、'&'跳过）的原因
+_SINGLE_PASS_RE = re.compile(r'<[^>]+>|&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[A-Za-z][A-Za-z0-9]*;?)|\s+')
+
+def _single_pass_replace(match):
+    token = match.group()
+    if token[0] == '<':
+        return ''
+    if token[0] == '&':
+        return unescape(token)
+    return ' '
+
+def single_pass_clean_html_content(html):
+    """一次re.sub完成去标签、解码实体和合并空白（实体解码出的空白不再与相邻空白合并）"""
+    if not isinstance(html, str):
+        html = str(html)
+    return _SINGLE_PASS_RE.sub(_single_pass_replace, html).strip()
+
+PARITY_CORPUS = [
+    "",
+    "   ",
+    "您好，请问有什么可以帮您？",
+    "  我的快递到哪了  ",
+    "<p>感谢您的咨询</p>",
+    "<p>亲，您的包裹<b>正在</b>派送中</p>\n<br/>请耐心等待",
+    "<div class=\"msg\">\r\n\t订单号：<span>1234567890</span>\r\n</div>",
+    "<img src='https://example.com/a.png'>",
+    "a<br>b<br/>c",
+    "未闭合的<标签",
+    "多个>右尖括号>>",
+    "<<嵌套>>文本",
+    "全角空格\u3000和不换行空格\xa0都算空白",
+    "行分隔符\u2028段分隔符\u2029控制分隔符\x1c\x1d\x1e\x1f",
+    "好的&amp;收到",
+    "派送中&nbsp;&nbsp;请耐心等待",
+    "&lt;b&gt;转义的标签保留为正文&lt;/b&gt;",
+    "数字实体&#20320;&#x597D;",
+    "不完整的实体 & 和 &amp 以及 &unknown;",
+    "<a href=\"?a=1&amp;b=2\">链接</a>&quot;引号&quot;",
+    None,
+    12345,
+    ["列表", "<b>x</b>"],
+]
+
+def check_parity(corpus):
+    """新实现 = 旧实现的输出再解码实体并合并空白；不含'&'的输入两者完全一致"""
+    mismatches = []
+    for sample in corpus:
+        new = clean_html_content(sample)
+        legacy = legacy_clean_html_content(sample)
+        expected = ' '.join(unescape(legacy).split())
+        if new != expected or ('&' not in str(sample) and new != legacy):
+            mismatches.append((sample, legacy, new))
+    return mismatches
+
+def load_html_bodies(input_txt_path, limit=20000):
+    bodies = []
+    with open(input_txt_path, 'r', encoding='utf-8') as f:
+        for line in islice(f, limit):
+            line = line.strip().rstrip(',')
+            try:
+                session = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            bodies.extend(msg.get('htmlBody', '') for msg in session.get('chatHistory', []))
+    return bodies
+
+def bench(corpus, number):
+    results = {}
+    for name, func in (("legacy", legacy_clean_html_content), ("current", clean_html_content),
+                       ("1-pass", single_pass_clean_html_content)):
+        seconds = min(timeit.repeat(lambda: [func(sample) for sample in corpus], number=number, repeat=3))
+        results[name] = seconds
+        print(f"{name:>8}: {seconds / (number * len(corpus)) * 1e6:.3f} µs/条")
+    print(f"加速比：{results['legacy'] / results['current']:.2f}x（单次扫描{results['legacy'] / results['1-pass']:.2f}x）")
+
+if __name__ == "__main__":
+    corpus = list(PARITY_CORPUS)
+    if len(sys.argv) > 1:
+        corpus.extend(load_html_bodies(sys.argv[1]))
+
+    mismatches = check_parity(corpus)
+    for sample, legacy, new in mismatches[:20]:
+        print(f"不一致：{sample!r}\n  旧：{legacy!r}\n  新：{new!r}")
+    print(f"一致性校验：{len(corpus) - len(mismatches)}/{len(corpus)} 条通过")
+    single_pass_mismatches = sum(single_pass_clean_html_content(sample) != clean_html_content(sample)
+                                 for sample in corpus)
+    print(f"单次扫描实现与当前实现不一致：{single_pass_mismatches}/{len(corpus)} 条（仅供参考，不计入校验结果）")
+
+    bench(corpus, number=max(1, 200000 // len(corpus)))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,79 @@
+"""会话JSON解码后端基准：在合成日志上比较各后端的解码速度
+
+用法：python benchmarks/bench_session_decode.py [会话数，默认20000]
+合成会话除了转换用到的字段，还带有客服系统导出的大量无关字段，以模拟真实日志。
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from session_decoder import available_backends, get_session_decoder
+
+def make_synthetic_session(i, rng):
+    session_id = f"meeting{i:08d}"
+    agent_id = f"agent{rng.randint(1, 50):03d}"
+    chat_history = []
+    for turn in range(rng.randint(2, 30)):
+        from_user = turn % 2 == 0
+        text = "请问我的快递到哪里了？" if from_user else "<p>亲，您的包裹正在派送中&nbsp;请耐心等待</p>"
+        chat_history.append({
+            "htmlBody": text * rng.randint(1, 4),
+            "body": text,
+            "fromRecipient": session_id if from_user else agent_id,
+            "externalNickName": "" if from_user else "客服小邮",
+            "sendTime": f"2025-06-01 10:{turn % 60:02d}:00",
+            # 以下为转换用不到的字段
+            "msgId": f"{i}-{turn}",
+            "msgType": "text",
+            "readStatus": 1,
+            "attachments": [{"name": "a.png", "size": 1024, "url": "https://example.com/a.png"}] if turn % 7 == 0 else [],
+            "extInfo": {"channel": "web", "device": {"os": "Android", "version": "14"}, "tags": ["物流", "查询"]},
+        })
+    return {
+        "meetingid": session_id,
+        "chatHistory": chat_history,
+        "agentloginid": agent_id,
+        "createmeetingtime": "2025-06-01 10:00:00",
+        "customerInfo": {"province": "广东", "city": "广州", "level": rng.randint(1, 5), "orders": list(range(10))},
+        "satisfaction": {"score": rng.randint(1, 5), "comment": "服务很好" * rng.randint(0, 5)},
+        "queueInfo": {"waitSeconds": rng.randint(0, 600), "skillGroup": "物流查询"},
+    }
+
+def make_synthetic_lines(num_sessions, seed=0):
+    rng = random.Random(seed)
+    return [json.dumps(make_synthetic_session(i, rng), ensure_ascii=False).encode('utf-8')
+            for i in range(num_sessions)]
+
+def used_fields(session):
+    """转换实际读取的字段，用于校验各后端结果一致"""
+    return (
+        session.get('meetingid'), session.get('agentloginid'), session.get('createmeetingtime'),
+        [(m.get('htmlBody'), m.get('fromRecipient'), m.get('sendTime'), m.get('body'), m.get('externalNickName'))
+         for m in session.get('chatHistory', [])],
+    )
+
+if __name__ == "__main__":
+    num_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lines = make_synthetic_lines(num_sessions)
+    total_mb = sum(len(line) for line in lines) / 1024 / 1024
+    print(f"合成日志：{num_sessions}个会话，{total_mb:.1f} MB")
+
+    reference = None
+    timings = {}
+    for backend in available_backends():
+        decode = get_session_decoder(backend)
+        start = time.perf_counter()
+        sessions = [decode(line) for line in lines]
+        timings[backend] = time.perf_counter() - start
+        fields = [used_fields(s) for s in sessions]
+        if reference is None:
+            reference = fields
+        consistent = "一致" if fields == reference else "不一致！"
+        print(f"{backend:>8}: {timings[backend]:.3f} s，{total_mb / timings[backend]:.1f} MB/s，结果{consistent}")
+
+    baseline = timings["json"]
+    for backend, seconds in timings.items():
+        print(f"{backend:>8} 相对标准库加速：{baseline / seconds:.2f}x")
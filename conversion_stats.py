@@ -0,0 +1,94 @@
+"""转换过程的统计与限流提示
+
+工作进程只累计各阶段耗时，以快照（普通dict）的形式随结果返回，由主进程合并；
+跳过原因的计数和提示输出都在主进程完成。每种原因只完整打印前 warn_first 条，
+之后每 warn_interval 秒最多打印一条并注明省略的条数，避免逐行写终端拖慢转换。
+"""
+import json
+import time
+from collections import Counter, defaultdict
+
+STAGES = ("parse", "clean", "role_map", "write")
+
+class ConversionStats:
+    def __init__(self, warn_first=10, warn_interval=5.0):
+        self.warn_first = warn_first
+        self.warn_interval = warn_interval
+        self.lines = 0
+        self.reasons = Counter()
+        self.stage_seconds = defaultdict(float)
+        self.suppressed = Counter()
+        self.totals = Counter()
+        self._last_warn_time = {}
+        self._start_time = time.perf_counter()
+
+    def add_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def count(self, reason, n=1):
+        self.reasons[reason] += n
+
+    def add_total(self, name, n):
+        """累计按样本求和的数值（如token数），与原因计数分开报告"""
+        self.totals[name] += n
+
+    def warn(self, reason, message):
+        """计数并按限流规则打印一条提示"""
+        self.reasons[reason] += 1
+        if self.reasons[reason] <= self.warn_first:
+            print(message)
+            return
+        now = time.perf_counter()
+        if now - self._last_warn_time.get(reason, 0.0) < self.warn_interval:
+            self.suppressed[reason] += 1
+            return
+        self._last_warn_time[reason] = now
+        skipped = self.suppressed[reason]
+        print(f"{message}（此前已省略{skipped}条同类提示）" if skipped else message)
+
+    def snapshot(self):
+        """可pickle的快照，供工作进程返回给主进程合并"""
+        return {
+            "lines": self.lines,
+            "reasons": dict(self.reasons),
+            "stage_seconds": dict(self.stage_seconds),
+            "suppressed": dict(self.suppressed),
+            "totals": dict(self.totals),
+        }
+
+    def merge(self, snapshot):
+        self.lines += snapshot["lines"]
+        self.reasons.update(snapshot["reasons"])
+        self.suppressed.update(snapshot["suppressed"])
+        self.totals.update(snapshot["totals"])
+        for stage, seconds in snapshot["stage_seconds"].items():
+            self.stage_seconds[stage] += seconds
+
+    def report(self, **extra):
+        elapsed = time.perf_counter() - self._start_time
+        return {
+            **extra,
+            "lines": self.lines,
+            "elapsed_seconds": round(elapsed, 3),
+            "lines_per_second": round(self.lines / elapsed, 1) if elapsed > 0 else None,
+            "reasons": dict(self.reasons.most_common()),
+            # 工作进程中的耗时按进程累加，并行时总和可以超过墙钟时间
+            "stage_seconds": {stage: round(self.stage_seconds.get(stage, 0.0), 3) for stage in STAGES},
+            "suppressed_warnings": dict(self.suppressed),
+            "totals": dict(self.totals),
+        }
+
+    def write_report(self, report_path, **extra):
+        report = self.report(**extra)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+    def print_summary(self, labels):
+        """打印各原因计数与阶段耗时，labels把原因代码映射为中文说明"""
+        report = self.report()
+        for reason, count in report["reasons"].items():
+            print(f"  {labels.get(reason, reason)}：{count}")
+        stage_text = "，".join(f"{stage} {seconds:.2f}s" for stage, seconds in report["stage_seconds"].items())
+        print(f"各阶段耗时：{stage_text}")
+        print(f"吞吐：{report['lines_per_second']} 行/秒")
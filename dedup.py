@@ -0,0 +1,128 @@
+"""会话去重：精确内容哈希 + MinHash/LSH 近似重复检测
+
+客服日志里有大量话术模板和几乎相同的“查快递”对话，这些重复样本只会增加训练token。
+指纹计算（fingerprint）是纯函数，可以放在进程池的工作进程里执行；去重索引
+（SessionDeduplicator）在主进程按输出顺序查询，结果与并行度无关。
+
+MinHash 采用单次哈希分桶（one permutation hashing），每个字符片段只哈希一次，代价与
+会话长度成线性关系，而不是 num_perm 倍。短会话会留下空桶，估计相似度时忽略两边都为空的桶。
+"""
+import hashlib
+import re
+import zlib
+from array import array
+from collections import OrderedDict
+from functools import partial
+
+_DIGITS_RE = re.compile(r'\d+')
+_EMPTY_BIN = 0xFFFFFFFF
+
+def normalize_conversations(conversations):
+    """归一化对话：忽略大小写和空白，数字串（订单号、运单号等）统一替换为0"""
+    parts = []
+    for message in conversations:
+        content = _DIGITS_RE.sub('0', ''.join(message["content"].lower().split()))
+        parts.append(f"{message['role']}:{content}")
+    return '\n'.join(parts)
+
+def minhash_signature(text, num_perm=64, shingle_size=3):
+    """计算字符shingle集合的MinHash签名（长度num_perm的array('I')）"""
+    # UTF-32编码后每个字符定长4字节，shingle可以直接按字节切片
+    encoded = text.encode('utf-32-le')
+    width = 4 * shingle_size
+    bins = array('I', [_EMPTY_BIN]) * num_perm
+    for start in range(0, max(len(encoded) - width, 0) + 4, 4):
+        h = zlib.crc32(encoded[start:start + width])
+        index = h % num_perm
+        value = h // num_perm
+        if value < bins[index]:
+            bins[index] = value
+
+    return bins
+
+def session_fingerprint(conversations, num_perm=64, shingle_size=3):
+    """返回(精确内容摘要, MinHash签名)"""
+    text = normalize_conversations(conversations)
+    exact_digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    return exact_digest, minhash_signature(text, num_perm, shingle_size)
+
+class SessionDeduplicator:
+    """有界内存的去重索引
+
+    代表会话按插入顺序保存在有界字典里，超过max_index_size个后最早的会被淘汰，
+    它的精确摘要和LSH桶条目随之删除，因此内存上限固定；重复样本通常集中在相近的导出时间段，淘汰对召回影响很小。
+    LSH命中后再用签名估计Jaccard相似度，达到threshold才判为近似重复。
+    """
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, shingle_size=3, max_index_size=200000):
+        if num_perm % bands:
+            raise ValueError(f"num_perm（{num_perm}）必须能被bands（{bands}）整除")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_index_size = max_index_size
+        self.exact_dropped = 0
+        self.near_dropped = 0
+        self._exact = {}
+        self._buckets = OrderedDict()
+        # 代表会话 -> (精确摘要, 签名, LSH桶键)，按插入顺序淘汰
+        self._sessions = OrderedDict()
+        self._next_id = 0
+
+    def fingerprint(self, conversations):
+        return session_fingerprint(conversations, self.num_perm, self.shingle_size)
+
+    def fingerprint_func(self):
+        """可pickle的指纹函数，交给工作进程使用（不携带索引本身）"""
+        return partial(session_fingerprint, num_perm=self.num_perm, shingle_size=self.shingle_size)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def _similarity(self, sig_a, sig_b):
+        matches = 0
+        used_bins = 0
+        for a, b in zip(sig_a, sig_b):
+            if a == _EMPTY_BIN and b == _EMPTY_BIN:
+                continue
+            used_bins += 1
+            matches += a == b
+        return matches / used_bins if used_bins else 1.0
+
+    def check(self, fingerprint):
+        """判断会话是否重复：返回 'exact'、'near' 或 None；不重复时加入索引"""
+        exact_digest, signature = fingerprint
+        if exact_digest in self._exact:
+            self.exact_dropped += 1
+            return 'exact'
+
+        band_keys = self._band_keys(signature)
+        candidates = {self._buckets[key] for key in band_keys if key in self._buckets}
+        for candidate in candidates:
+            candidate_signature = self._sessions[candidate][1]
+            if self._similarity(signature, candidate_signature) >= self.threshold:
+                self.near_dropped += 1
+                return 'near'
+
+        session_ref = self._next_id
+        self._next_id += 1
+        self._exact[exact_digest] = session_ref
+        self._sessions[session_ref] = (exact_digest, signature, band_keys)
+        for key in band_keys:
+            # 桶指向最新的代表会话
+            self._buckets[key] = session_ref
+            self._buckets.move_to_end(key)
+        self._evict()
+        return None
+
+    def _evict(self):
+        while len(self._sessions) > self.max_index_size:
+            session_ref, (exact_digest, _, band_keys) = self._sessions.popitem(last=False)
+            del self._exact[exact_digest]
+            for key in band_keys:
+                # 已被更新的会话接管的桶保留
+                if self._buckets.get(key) == session_ref:
+                    del self._buckets[key]
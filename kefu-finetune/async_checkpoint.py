@@ -0,0 +1,414 @@
+"""异步保存checkpoint：训练只暂停到把LoRA权重和优化器状态复制进内存，写文件在后台线程中进行
+
+Trainer每save_steps步同步写出adapter、优化器、学习率调度器、RNG状态和一整份tokenizer文件，期间训练停止；
+模型越大（8B、30B）优化器状态越大，停顿越长。use_async_checkpoint 替换trainer._save_checkpoint：
+    1. 主线程：后台写入中的保存达到max_in_flight个时，先等最早的一个写完（限制内存中快照的份数）；
+       再把adapter权重、优化器/调度器/scaler状态复制到CPU内存，记下RNG状态和trainer_state.json；
+       tokenizer文件只在第一次保存时写到 <output_dir>/.tokenizer（同样在主线程中，后台线程不访问tokenizer对象）；
+    2. 后台线程（单线程，按提交顺序写）：在 <output_dir>/.tmp-checkpoint-N 中写出adapter_model.safetensors、
+       adapter_config.json、optimizer.pt、scheduler.pt、scaler.pt、rng_state.pth、trainer_state.json、
+       training_args.bin，并硬链接（不支持时复制）.tokenizer中的文件，fsync后原子重命名为checkpoint-N，
+       再按save_total_limit删除旧的checkpoint。写到一半中断时只留下.tmp-目录，不会出现不完整的checkpoint-N；
+       同名checkpoint已存在时先把它重命名为.old-checkpoint-N，新目录就位后才删除，任何时刻中断都至少保留一份完整的。
+checkpoint的目录结构和文件名与Trainer同步保存的相同，resume_from_checkpoint直接可用。
+每次保存打印训练暂停的时间（等待 + 复制）和后台写入耗时，并记入trainer_state.json的log_history；
+训练结束时等待所有保存写完并打印汇总。后台写入出错时在下一次保存或训练结束时抛出。
+多进程训练、单进程多卡（DataParallel）、DeepSpeed/FSDP、全参数微调（非PEFT模型）、load_best_model_at_end和push_to_hub仍用Trainer的同步保存。
+"""
+import copy
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+MAX_IN_FLIGHT = 1
+TMP_PREFIX = ".tmp-"
+OLD_PREFIX = ".old-"
+TOKENIZER_DIR = ".tokenizer"
+
+def _to_cpu(obj):
+    """复制嵌套dict/list/tuple中的张量到CPU，其他值深拷贝"""
+    import torch
+
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def _fsync_tree(path):
+    for root, _, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                os.fsync(f.fileno())
+    _fsync_dir(path)
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _link_files(src_dir, dst_dir):
+    for name in os.listdir(src_dir):
+        src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+def rotate_checkpoints(run_dir, save_total_limit):
+    """按步数只保留最新的save_total_limit个checkpoint-N"""
+    if not save_total_limit:
+        return
+    pattern = re.compile(rf"{PREFIX_CHECKPOINT_DIR}-(\d+)")
+    steps = sorted(int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(run_dir)) if match)
+    for step in steps[:max(0, len(steps) - save_total_limit)]:
+        shutil.rmtree(os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}"), ignore_errors=True)
+
+class AsyncCheckpointWriter:
+    """在一个后台线程中按提交顺序写checkpoint目录，写入中（含排队）的最多max_in_flight个"""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight至少为1")
+        self.max_in_flight = max_in_flight
+        self.records = []
+        self._pending = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+
+    def _collect(self, keep):
+        """取回已写完的结果（后台出错时在这里抛出），并等到写入中的不超过keep个"""
+        for future in [future for future in self._pending if future.done()]:
+            self._pending.remove(future)
+            future.result()
+        while len(self._pending) > keep:
+            self._pending.pop(0).result()
+
+    def wait_for_slot(self):
+        """等到可以再提交一个保存，返回等待的秒数"""
+        start_time = time.perf_counter()
+        self._collect(self.max_in_flight - 1)
+        return time.perf_counter() - start_time
+
+    def wait(self):
+        """等待所有保存写完"""
+        self._collect(0)
+
+    @property
+    def in_flight(self):
+        return sum(not future.done() for future in self._pending)
+
+    def submit(self, output_dir, write_files, record, after_write=None):
+        """后台调用write_files(临时目录)写出全部文件，原子重命名为output_dir后调用after_write()
+
+        record（本次保存的统计）会补上write_seconds并加入self.records。
+        """
+        self.records.append(record)
+        future = self._executor.submit(self._write, output_dir, write_files, record, after_write)
+        self._pending.append(future)
+        return future
+
+    def _write(self, output_dir, write_files, record, after_write):
+        start_time = time.perf_counter()
+        parent, name = os.path.split(os.path.abspath(output_dir))
+        tmp_dir = os.path.join(parent, TMP_PREFIX + name)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        write_files(tmp_dir)
+        _fsync_tree(tmp_dir)
+        # 不能先删除再重命名：两步之间中断会同时失去新旧两份
+        old_dir = None
+        if os.path.exists(output_dir):
+            old_dir = os.path.join(parent, OLD_PREFIX + name)
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.replace(output_dir, old_dir)
+        os.replace(tmp_dir, output_dir)
+        _fsync_dir(parent)
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
+        if after_write is not None:
+            after_write()
+        record["write_seconds"] = round(time.perf_counter() - start_time, 4)
+        print(f"{name}已写入（后台{record['write_seconds']:.2f}s）")
+
+    def summary(self):
+        if not self.records:
+            return None
+        stalls = np.array([record["stall_seconds"] for record in self.records])
+        writes = np.array([record["write_seconds"] for record in self.records if "write_seconds" in record])
+        return {
+            "saves": len(self.records),
+            "stall_seconds_total": float(stalls.sum()),
+            "stall_seconds_mean": float(stalls.mean()),
+            "stall_seconds_max": float(stalls.max()),
+            "write_seconds_mean": float(writes.mean()) if len(writes) else None,
+        }
+
+def _snapshot_checkpoint(trainer):
+    """在主线程中取得checkpoint的全部内容：张量复制到CPU，trainer_state序列化为JSON"""
+    import torch
+    from peft import get_peft_model_state_dict
+    from transformers.trainer_callback import ExportableState
+    from transformers.training_args import ParallelMode
+
+    model = trainer.model
+    adapter_name = model.active_adapter
+    snapshot = {
+        "adapter": _to_cpu(get_peft_model_state_dict(model, adapter_name=adapter_name)),
+        "adapter_config": copy.deepcopy(model.peft_config[adapter_name]),
+    }
+    if not trainer.args.save_only_model:
+        snapshot["optimizer"] = _to_cpu(trainer.optimizer.state_dict())
+        snapshot["scheduler"] = _to_cpu(trainer.lr_scheduler.state_dict())
+        scaler = getattr(trainer.accelerator, "scaler", None)
+        if scaler is not None:
+            snapshot["scaler"] = _to_cpu(scaler.state_dict())
+        # 与Trainer._save_rng_state相同：分布式时保存所有设备的CUDA RNG状态，恢复时对应set_rng_state_all
+        rng_state = {"python": random.getstate(), "numpy": np.random.get_state(), "cpu": torch.random.get_rng_state()}
+        if torch.cuda.is_available():
+            if trainer.args.parallel_mode == ParallelMode.DISTRIBUTED:
+                rng_state["cuda"] = torch.cuda.random.get_rng_state_all()
+            else:
+                rng_state["cuda"] = torch.cuda.random.get_rng_state()
+        snapshot["rng_state"] = rng_state
+    # 与Trainer相同：记下可导出状态的callback（如EarlyStoppingCallback）和TrainerControl的当前状态
+    state = trainer.state
+    for callback in trainer.callback_handler.callbacks + [trainer.control]:
+        if isinstance(callback, ExportableState):
+            callback_name = type(callback).__name__
+            if isinstance(state.stateful_callbacks.get(callback_name), list):
+                state.stateful_callbacks[callback_name].append(callback.state())
+            else:
+                state.stateful_callbacks[callback_name] = callback.state()
+    snapshot["trainer_state"] = json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n"
+    return snapshot
+
+def _write_checkpoint(snapshot, checkpoint_dir, args, tokenizer_dir):
+    import torch
+    from peft.utils import SAFETENSORS_WEIGHTS_NAME
+    from safetensors.torch import save_file
+    from transformers.trainer import (OPTIMIZER_NAME, SCALER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME,
+                                      TRAINING_ARGS_NAME)
+
+    adapter = {key: tensor.contiguous() for key, tensor in snapshot["adapter"].items()}
+    save_file(adapter, os.path.join(checkpoint_dir, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"})
+    adapter_config = snapshot["adapter_config"]
+    adapter_config.inference_mode = True
+    adapter_config.save_pretrained(checkpoint_dir)
+    torch.save(args, os.path.join(checkpoint_dir, TRAINING_ARGS_NAME))
+    for key, file_name in (("optimizer", OPTIMIZER_NAME), ("scheduler", SCHEDULER_NAME), ("scaler", SCALER_NAME),
+                           ("rng_state", "rng_state.pth")):
+        if key in snapshot:
+            torch.save(snapshot[key], os.path.join(checkpoint_dir, file_name))
+    with open(os.path.join(checkpoint_dir, TRAINER_STATE_NAME), 'w', encoding='utf-8') as f:
+        f.write(snapshot["trainer_state"])
+    if tokenizer_dir is not None:
+        _link_files(tokenizer_dir, checkpoint_dir)
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """训练结束时等待所有保存写完并打印汇总"""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.writer.wait()
+        summary = self.writer.summary()
+        if summary is not None and state.is_world_process_zero:
+            print(f"checkpoint异步保存：{summary['saves']}次，训练共暂停{summary['stall_seconds_total']:.2f}s"
+                  f"（平均{summary['stall_seconds_mean']:.2f}s，最长{summary['stall_seconds_max']:.2f}s），"
+                  f"后台平均每次写入{summary['write_seconds_mean'] or 0:.2f}s")
+
+def _needs_sync_save(trainer):
+    args = trainer.args
+    # 单进程多卡时各卡的CUDA RNG状态需要get_rng_state_all，而Trainer恢复时只按单卡读取，交给Trainer同步保存
+    return (args.world_size > 1 or args.n_gpu > 1 or getattr(trainer, "is_deepspeed_enabled", False)
+            or getattr(trainer, "is_fsdp_enabled", False) or args.push_to_hub or args.load_best_model_at_end
+            or not hasattr(trainer.model, "peft_config"))
+
+def use_async_checkpoint(trainer, max_in_flight=MAX_IN_FLIGHT):
+    """让trainer按save_steps异步保存checkpoint，返回AsyncCheckpointWriter（records为每次保存的统计）"""
+    writer = AsyncCheckpointWriter(max_in_flight)
+    trainer.add_callback(AsyncCheckpointCallback(writer))
+    original_save_checkpoint = trainer._save_checkpoint
+    tokenizer = getattr(trainer, "processing_class", None) or getattr(trainer, "tokenizer", None)
+    tokenizer_dirs = set()
+
+    def save_checkpoint(model, trial):
+        if _needs_sync_save(trainer):
+            return original_save_checkpoint(model, trial)
+        args = trainer.args
+        state = trainer.state
+        stall_start = time.perf_counter()
+        wait_seconds = writer.wait_for_slot()
+        if trainer.hp_search_backend is None and trial is None:
+            trainer.store_flos()
+        run_dir = trainer._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        tokenizer_dir = None
+        if tokenizer is not None:
+            tokenizer_dir = os.path.join(run_dir, TOKENIZER_DIR)
+            # 每次训练在主线程中写一次，之后的checkpoint都链接到这份文件
+            if tokenizer_dir not in tokenizer_dirs:
+                shutil.rmtree(tokenizer_dir, ignore_errors=True)
+                tokenizer.save_pretrained(tokenizer_dir)
+                tokenizer_dirs.add(tokenizer_dir)
+        snapshot = _snapshot_checkpoint(trainer)
+        stall_seconds = time.perf_counter() - stall_start
+        record = {
+            "checkpoint": os.path.basename(output_dir),
+            "step": state.global_step,
+            "stall_seconds": round(stall_seconds, 4),
+            "wait_seconds": round(wait_seconds, 4),
+            "snapshot_seconds": round(stall_seconds - wait_seconds, 4),
+            "in_flight": writer.in_flight,
+        }
+
+        def write_files(checkpoint_dir):
+            _write_checkpoint(snapshot, checkpoint_dir, args, tokenizer_dir)
+
+        writer.submit(output_dir, write_files, record,
+                      after_write=lambda: rotate_checkpoints(run_dir, args.save_total_limit))
+        state.log_history.append({"checkpoint_stall_seconds": record["stall_seconds"], "step": state.global_step})
+        if state.is_world_process_zero:
+            print(f"保存{record['checkpoint']}：训练暂停{stall_seconds:.2f}s（等待之前的保存{wait_seconds:.2f}s，"
+                  f"复制到内存{record['snapshot_seconds']:.2f}s），后台写入中")
+
+    trainer._save_checkpoint = save_checkpoint
+    return writer
+
+if __name__ == "__main__":
+    # 自检：后台写入的原子性、保存份数上限、旧checkpoint删除和错误传递；
+    # 装有torch和peft时在CPU上用小尺寸Qwen3 + LoRA比较异步和同步保存的checkpoint，并从异步checkpoint恢复训练
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        writer = AsyncCheckpointWriter(max_in_flight=2)
+
+        def slow_write(step):
+            def write_files(checkpoint_dir):
+                time.sleep(0.2)
+                assert not os.path.exists(os.path.join(run_dir, f"checkpoint-{step}")), "写完之前不应出现checkpoint目录"
+                np.save(os.path.join(checkpoint_dir, "weights.npy"), np.full(4, step))
+            return write_files
+
+        stalls = []
+        for step in range(1, 6):
+            wait_seconds = writer.wait_for_slot()
+            stalls.append(wait_seconds)
+            assert writer.in_flight < writer.max_in_flight
+            writer.submit(os.path.join(run_dir, f"checkpoint-{step}"), slow_write(step),
+                          {"stall_seconds": wait_seconds}, after_write=lambda: rotate_checkpoints(run_dir, 3))
+        writer.wait()
+        assert sorted(os.listdir(run_dir)) == ["checkpoint-3", "checkpoint-4", "checkpoint-5"], os.listdir(run_dir)
+        assert (np.load(os.path.join(run_dir, "checkpoint-5", "weights.npy")) == 5).all()
+        assert stalls[0] < 0.05 and max(stalls[2:]) > 0.1, f"写入中的保存达到上限时应等待：{stalls}"
+        print(f"保存5次（上限2个写入中）：每次等待 {', '.join(f'{s:.2f}s' for s in stalls)}")
+
+        def failing_write(checkpoint_dir):
+            raise OSError("磁盘已满")
+
+        writer.submit(os.path.join(run_dir, "checkpoint-6"), failing_write, {"stall_seconds": 0.0})
+        try:
+            writer.wait()
+            raise AssertionError("后台写入的错误应在wait时抛出")
+        except OSError:
+            pass
+        assert not os.path.exists(os.path.join(run_dir, "checkpoint-6"))
+
+        # 覆盖已有的checkpoint：新目录就位前旧目录一直以checkpoint-5或.old-checkpoint-5存在，之后被删除
+        def rewrite(checkpoint_dir):
+            assert (np.load(os.path.join(run_dir, "checkpoint-5", "weights.npy")) == 5).all()
+            np.save(os.path.join(checkpoint_dir, "weights.npy"), np.full(4, 50))
+
+        original_replace = os.replace
+
+        def checked_replace(src, dst):
+            assert os.path.exists(os.path.join(run_dir, "checkpoint-5")) or os.path.exists(
+                os.path.join(run_dir, OLD_PREFIX + "checkpoint-5")), "覆盖过程中不应同时没有新旧两份"
+            original_replace(src, dst)
+
+        os.replace = checked_replace
+        try:
+            writer.submit(os.path.join(run_dir, "checkpoint-5"), rewrite, {"stall_seconds": 0.0})
+            writer.wait()
+        finally:
+            os.replace = original_replace
+        assert (np.load(os.path.join(run_dir, "checkpoint-5", "weights.npy")) == 50).all()
+        assert OLD_PREFIX + "checkpoint-5" not in os.listdir(run_dir), os.listdir(run_dir)
+    print("写入检查通过")
+
+    try:
+        import torch
+        from peft import LoraConfig, get_peft_model
+        from transformers import (PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM, Trainer,
+                                  TrainingArguments)
+    except ImportError:
+        print("未安装torch或peft，跳过训练保存检查")
+        raise SystemExit
+
+    from safetensors.torch import load_file
+    from tokenizers import Tokenizer, models
+
+    from packing import PaddingFreeCollator
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel({"[UNK]": 0}, unk_token="[UNK]")))
+    generator = torch.Generator().manual_seed(0)
+    dataset = [{"input_ids": torch.randint(0, 128, (int(n),), generator=generator).tolist()}
+               for n in torch.randint(8, 40, (32,), generator=generator)]
+    config = Qwen3Config(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=256)
+
+    def run(output_dir, async_save, max_steps=6, resume_from_checkpoint=None):
+        torch.manual_seed(0)
+        model = get_peft_model(Qwen3ForCausalLM(config), LoraConfig(r=4, target_modules=["q_proj", "v_proj"]))
+        args = TrainingArguments(output_dir=output_dir, per_device_train_batch_size=4, max_steps=max_steps,
+                                 learning_rate=1e-3, logging_steps=1, save_steps=2, save_total_limit=2, seed=3407,
+                                 use_cpu=True, report_to="none")
+        trainer = Trainer(model=model, args=args, train_dataset=dataset, processing_class=tokenizer,
+                          data_collator=PaddingFreeCollator(assistant_only_loss=False))
+        if async_save:
+            use_async_checkpoint(trainer)
+        trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+        return trainer
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sync_dir, async_dir = os.path.join(tmp_dir, "sync"), os.path.join(tmp_dir, "async")
+        run(sync_dir, async_save=False)
+        run(async_dir, async_save=True)
+        assert sorted(os.listdir(async_dir)) == [TOKENIZER_DIR, "checkpoint-4", "checkpoint-6"], os.listdir(async_dir)
+        for name in ("checkpoint-4", "checkpoint-6"):
+            sync_files = set(os.listdir(os.path.join(sync_dir, name)))
+            async_files = set(os.listdir(os.path.join(async_dir, name)))
+            assert sync_files <= async_files | {"README.md"}, f"{name}缺少文件：{sync_files - async_files}"
+            sync_adapter = load_file(os.path.join(sync_dir, name, "adapter_model.safetensors"))
+            async_adapter = load_file(os.path.join(async_dir, name, "adapter_model.safetensors"))
+            assert sync_adapter.keys() == async_adapter.keys()
+            assert all(torch.equal(sync_adapter[key], async_adapter[key]) for key in sync_adapter)
+            sync_optimizer = torch.load(os.path.join(sync_dir, name, "optimizer.pt"), weights_only=False)
+            async_optimizer = torch.load(os.path.join(async_dir, name, "optimizer.pt"), weights_only=False)
+            assert all(torch.equal(sync_optimizer["state"][i]["exp_avg"], async_optimizer["state"][i]["exp_avg"])
+                       for i in sync_optimizer["state"])
+        print("异步保存的checkpoint与同步保存的adapter和优化器状态一致")
+        resumed = run(os.path.join(tmp_dir, "resumed"), async_save=True, max_steps=8,
+                      resume_from_checkpoint=os.path.join(async_dir, "checkpoint-4"))
+        assert resumed.state.global_step == 8
+        print("从异步保存的checkpoint恢复训练正常")
+    print("自检通过")
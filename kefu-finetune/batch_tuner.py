@@ -0,0 +1,283 @@
+"""自动选择每卡batch大小、梯度累积步数和是否免padding展平
+
+在SFTTrainer创建之后（数据已分词）、trainer.train()之前，用真实数据在当前设备（GPU或CPU）上试跑几个优化步，
+所有候选配置每个优化步的样本数（有效batch）都相同：
+    - per_device_train_batch_size取有效batch的各个约数，gradient_accumulation_steps = 有效batch / 它；
+    - 每种拆分再分别试跑按批内最长样本补齐（trainer原有的collator）和免padding展平（packing.padding_free_collator：
+      TRL的collator打开padding_free，或PaddingFreeCollator；一个micro-batch的样本拼成一行，样本数不变）；
+      没有可用的免padding collator时只试跑补齐的配置。
+      打包（PackedDataset）按包计数，每个优化步的样本数不固定，不参与比较。
+每种配置先跑一个最坏情况的优化步（一个由最长样本组成的micro-batch，再optimizer.step()）预热并测峰值显存/内存，
+峰值包含优化器状态；再跑probe_steps个完整的优化步测吞吐：每步gradient_accumulation_steps个随机micro-batch的
+前向反向（loss按累积步数缩放，与Trainer相同）加一次optimizer.step()，所有配置试跑的样本数相同。
+吞吐为每秒处理的真实token数；不超出设备内存的MEMORY_FRACTION的配置中选吞吐最高的。
+试跑用单独创建的优化器，结束后恢复可训练参数并清空梯度，不影响之后的训练。
+
+结果按 主机名|模型|设备|max_seq_length|有效batch|数据指纹|LoRA|量化|优化器 保存在CACHE_PATH，之后同样的配置直接读取，
+不再试跑；数据指纹是各样本token数的哈希。
+"""
+import gc
+import hashlib
+import json
+import os
+import socket
+import time
+from datetime import datetime
+
+import numpy as np
+
+from length_sampler import dataset_lengths
+from packing import packed_attention_error, padding_free_collator
+
+CACHE_PATH = os.path.expanduser("~/.cache/kefu-finetune/batch_tuner.json")
+PROBE_STEPS = 3
+MEMORY_FRACTION = 0.9
+
+def _divisors(n):
+    return [d for d in range(1, n + 1) if n % d == 0]
+
+def candidate_configs(effective_batch_size, try_padding_free=False):
+    """有效batch不变的各种拆分；try_padding_free=True时每种拆分再加一个免padding展平的配置（每批1条时与补齐相同，不加）"""
+    return [{"per_device_train_batch_size": size, "gradient_accumulation_steps": effective_batch_size // size,
+             "padding_free": padding_free}
+            for padding_free in ((False, True) if try_padding_free else (False,))
+            for size in _divisors(effective_batch_size) if not (padding_free and size == 1)]
+
+def _device_name(device):
+    import torch
+
+    if device.type == "cuda":
+        return torch.cuda.get_device_name(device)
+    return f"{device.type}-{os.cpu_count()}cpu"
+
+def synchronize_device(device):
+    """CUDA上等待已提交的kernel完成，计时前后调用；CPU上什么也不做"""
+    if device.type == "cuda":
+        import torch
+
+        torch.cuda.synchronize(device)
+
+def reset_peak_memory(device):
+    """把峰值显存（CUDA）或峰值RSS（CPU）重置为当前值，之后read_peak_memory只反映此后的峰值"""
+    if device.type == "cuda":
+        import torch
+
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    # Linux下写入5会把进程的峰值RSS（VmHWM）重置为当前值
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def read_peak_memory(device):
+    """峰值显存（CUDA）或峰值RSS（CPU，读/proc），单位字节；无法获得时返回None"""
+    if device.type == "cuda":
+        import torch
+
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _memory_limit(device):
+    import torch
+
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _is_out_of_memory(error):
+    return type(error).__name__ == "OutOfMemoryError" or isinstance(error, MemoryError) or "out of memory" in str(error)
+
+def _dataset_fingerprint(lengths):
+    """各样本token数（截断到max_seq_length后）的哈希，数据量和长度分布变化时随之变化"""
+    return f"{len(lengths)}:{hashlib.sha1(np.ascontiguousarray(lengths, dtype=np.int64).tobytes()).hexdigest()[:16]}"
+
+def _lora_signature(model):
+    peft_config = getattr(model, "peft_config", None)
+    if not peft_config:
+        return "full"
+    signatures = []
+    for name, config in sorted(peft_config.items()):
+        target_modules = config.target_modules
+        if target_modules is not None and not isinstance(target_modules, str):
+            target_modules = ",".join(sorted(target_modules))
+        signatures.append(f"{name}:r={config.r}:{target_modules}")
+    return ";".join(signatures)
+
+def _quantization(model):
+    config = getattr(getattr(model, "config", None), "quantization_config", None)
+    if config is None:
+        return "none"
+    if not isinstance(config, dict):
+        config = config.to_dict()
+    if config.get("load_in_4bit"):
+        return f"4bit-{config.get('bnb_4bit_quant_type', '')}"
+    if config.get("load_in_8bit"):
+        return "8bit"
+    return str(config.get("quant_method", "quantized"))
+
+class _ProbeData:
+    """按配置构造试跑用的优化步：每步为[(collate后的batch, 真实token数)]；补齐和免padding展平取同样的样本"""
+
+    def __init__(self, trainer, lengths, seed, padding_free_collator=None):
+        self.trainer = trainer
+        self.lengths = lengths
+        self.collator = trainer._get_collator_with_removed_columns(trainer.data_collator, description="training")
+        if padding_free_collator is not None:
+            padding_free_collator = trainer._get_collator_with_removed_columns(padding_free_collator,
+                                                                               description="training")
+        self.padding_free_collator = padding_free_collator
+        self.seed = seed
+
+    def batches(self, config, probe_steps):
+        dataset = self.trainer.train_dataset
+        collator = self.padding_free_collator if config["padding_free"] else self.collator
+        size = min(config["per_device_train_batch_size"], len(dataset))
+        rng = np.random.default_rng(self.seed)
+        # 第一步只有一个由最长样本组成的micro-batch，其余每步gradient_accumulation_steps个随机micro-batch
+        steps = [[np.argsort(-self.lengths, kind="stable")[:size]]]
+        steps.extend([rng.choice(len(dataset), size, replace=False)
+                      for _ in range(config["gradient_accumulation_steps"])] for _ in range(probe_steps))
+        for step in steps:
+            yield [(collator([dataset[int(i)] for i in indices]), int(self.lengths[indices].sum()))
+                   for indices in step]
+
+def _probe(trainer, optimizer, steps, device):
+    """逐个优化步试跑，返回(每秒真实token数, 峰值内存)；第一步兼作预热，不计入吞吐"""
+    model = trainer.model
+    model.train()
+    reset_peak_memory(device)
+    tokens = 0
+    elapsed = 0.0
+    for step, micro_batches in enumerate(steps):
+        synchronize_device(device)
+        start_time = time.perf_counter()
+        for batch, _ in micro_batches:
+            loss = trainer.compute_loss(model, trainer._prepare_inputs(batch))
+            (loss / len(micro_batches)).backward()
+        optimizer.step()
+        model.zero_grad(set_to_none=True)
+        synchronize_device(device)
+        if step:
+            elapsed += time.perf_counter() - start_time
+            tokens += sum(num_tokens for _, num_tokens in micro_batches)
+    peak_memory = read_peak_memory(device)
+    return (tokens / elapsed if elapsed else 0.0), peak_memory
+
+def _release_memory(trainer, device):
+    import torch
+
+    trainer.model.zero_grad(set_to_none=True)
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+def _load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, cache_path)
+
+def apply_batch_config(trainer, config):
+    """把选出的batch大小和梯度累积步数写回trainer（免padding展平由调用方用packing.use_padding_free开启）"""
+    args = trainer.args
+    args.per_device_train_batch_size = config["per_device_train_batch_size"]
+    args.gradient_accumulation_steps = config["gradient_accumulation_steps"]
+    trainer._train_batch_size = args.train_batch_size
+    accelerator = getattr(trainer, "accelerator", None)
+    if accelerator is not None and hasattr(accelerator, "gradient_accumulation_steps"):
+        accelerator.gradient_accumulation_steps = config["gradient_accumulation_steps"]
+
+def tune_batch_config(trainer, model_name, max_seq_length, effective_batch_size=None, try_padding_free=True,
+                      probe_steps=PROBE_STEPS, cache_path=CACHE_PATH, retune=False, seed=3407):
+    """试跑并选出吞吐最高的配置，应用到trainer并返回
+    {"per_device_train_batch_size", "gradient_accumulation_steps", "padding_free"}"""
+    args = trainer.args
+    device = args.device
+    model = trainer.model
+    if effective_batch_size is None:
+        effective_batch_size = args.per_device_train_batch_size * args.gradient_accumulation_steps
+    free_collator = padding_free_collator(trainer) if try_padding_free else None
+    if try_padding_free and free_collator is None:
+        print(f"不试跑免padding展平的配置：{packed_attention_error(model)}")
+        try_padding_free = False
+    lengths = np.minimum(dataset_lengths(trainer.train_dataset), max_seq_length)
+    cache_key = "|".join([socket.gethostname(), model_name, _device_name(device), str(max_seq_length),
+                          str(effective_batch_size), _dataset_fingerprint(lengths), _lora_signature(model),
+                          _quantization(model), str(getattr(args.optim, "value", args.optim)),
+                          "padding_free" if try_padding_free else "padded"])
+    cache = _load_cache(cache_path)
+    if cache_key in cache and not retune:
+        config = cache[cache_key]["config"]
+        print(f"batch配置（缓存 {cache_path}）：{config}")
+        apply_batch_config(trainer, config)
+        return config
+
+    data = _ProbeData(trainer, lengths, seed, free_collator)
+    # 试跑用单独创建的优化器（与训练时相同的类型和超参数），结束后丢弃并恢复可训练参数
+    trainable = {name: param.detach().clone() for name, param in model.named_parameters() if param.requires_grad}
+    trainer_optimizer = trainer.optimizer
+    trainer.optimizer = None
+    optimizer = trainer.create_optimizer()
+    memory_limit = _memory_limit(device)
+    results = []
+    try:
+        for config in candidate_configs(effective_batch_size, try_padding_free):
+            try:
+                tokens_per_second, peak_memory = _probe(trainer, optimizer, data.batches(config, probe_steps), device)
+                fits = memory_limit is None or peak_memory is None or peak_memory <= memory_limit * MEMORY_FRACTION
+                error = None
+            except Exception as e:
+                if not _is_out_of_memory(e):
+                    raise
+                tokens_per_second, peak_memory, fits, error = 0.0, None, False, "out of memory"
+            _release_memory(trainer, device)
+            results.append({**config, "tokens_per_second": round(tokens_per_second, 1), "peak_memory": peak_memory,
+                            "fits": fits, "error": error})
+            memory_text = f"{peak_memory / (1 << 30):.2f}GB" if peak_memory is not None else (error or "未知")
+            print(f"  batch {config['per_device_train_batch_size']} × 累积 {config['gradient_accumulation_steps']}"
+                  f"{'（免padding）' if config['padding_free'] else ''}：{tokens_per_second:.0f} token/s，"
+                  f"峰值内存{memory_text}{'' if fits else '，超出内存'}")
+    finally:
+        import torch
+
+        with torch.no_grad():
+            for name, param in model.named_parameters():
+                if name in trainable:
+                    param.copy_(trainable[name])
+        trainer.optimizer = trainer_optimizer
+        del optimizer, trainable
+        _release_memory(trainer, device)
+
+    fitting = [result for result in results if result["fits"]]
+    if not fitting:
+        raise RuntimeError(f"所有batch配置都超出{_device_name(device)}的内存，请减小max_seq_length或有效batch")
+    best = max(fitting, key=lambda result: result["tokens_per_second"])
+    config = {key: best[key] for key in ("per_device_train_batch_size", "gradient_accumulation_steps", "padding_free")}
+    cache[cache_key] = {"config": config, "probes": results, "tuned_at": datetime.now().isoformat(timespec="seconds")}
+    _save_cache(cache_path, cache)
+    print(f"选定batch配置：{config}（已保存到{cache_path}）")
+    apply_batch_config(trainer, config)
+    return config
@@ -0,0 +1,192 @@
+"""按长度分桶组批，可选按token预算决定每批样本数，并统计每个epoch的padding效率
+
+固定per_device_train_batch_size时，一批里长短样本混在一起，短样本按最长样本补齐，
+客服会话长度差异大，大量算力花在pad上。LengthGroupedBatchSampler 每个epoch：
+    1. 打乱全部样本，按顺序切成若干mega-batch（mega_batch_mult个批次的样本量）；
+    2. 每个mega-batch内按长度从长到短排序，再切成批次：
+       - 只给batch_size时每批固定样本数；
+       - 给max_tokens时每批装入尽量多的样本，使 样本数 × 批内最长长度（即补齐后的token数）不超过max_tokens，
+         同时给batch_size时样本数也不超过batch_size；单条超过max_tokens的样本单独成批；
+    3. 打乱所有批次的顺序，并把补齐后token数最多的批次放在最前面，显存不够时第一步就会报错。
+随机性保留在mega-batch层面：同一mega-batch内的样本长度相近才会分到一批，每个epoch的划分都不同。
+样本顺序由seed和epoch决定，Trainer每个epoch调用set_epoch；未调用时每次遍历自动进入下一个epoch。
+断点续训时直接从中断的批次开始产出（见resumable_sampler）。
+
+padding效率 = 真实token数 / 补齐后token数（按批内最长样本补齐，给pad_to_multiple_of时向上取整），
+按实际产出的批次累计；PaddingEfficiencyCallback 在每个epoch结束时打印并写入trainer_state.json的log_history。
+"""
+import numpy as np
+from transformers import TrainerCallback
+
+from resumable_sampler import ResumableBatchSampler, use_batch_sampler
+
+MEGA_BATCH_MULT = 50
+
+def dataset_lengths(dataset, batch_size=10000):
+    """各样本的token数：TokenStore/ConcatTokenStore直接读offsets，datasets.Dataset按input_ids列分批计算，
+    其他数据集（如样本dict的列表）逐条读取input_ids"""
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths(), dtype=np.int64)
+    if not hasattr(dataset, "select_columns"):
+        return np.asarray([len(dataset[i]["input_ids"]) for i in range(len(dataset))], dtype=np.int64)
+    lengths = []
+    for batch in dataset.select_columns(["input_ids"]).iter(batch_size=batch_size):
+        lengths.extend(len(ids) for ids in batch["input_ids"])
+    return np.asarray(lengths, dtype=np.int64)
+
+class LengthGroupedBatchSampler(ResumableBatchSampler):
+    """产出样本下标列表的batch sampler，作为DataLoader的batch_sampler使用"""
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, mega_batch_mult=MEGA_BATCH_MULT, seed=0,
+                 drop_last=False, pad_to_multiple_of=None):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("batch_size和max_tokens至少需要给出一个")
+        super().__init__(seed)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.drop_last = drop_last
+        self.pad_to_multiple_of = pad_to_multiple_of
+        # 按token预算组批时，mega-batch的样本量按平均每批能装入的样本数估算
+        per_batch = batch_size
+        if max_tokens is not None:
+            mean_length = max(1, int(self.lengths.mean())) if len(self.lengths) else 1
+            per_batch = min(per_batch or max_tokens, max(1, max_tokens // mean_length))
+        self.mega_batch_size = max(1, per_batch * mega_batch_mult)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_batches = 0
+        self.num_samples = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def padded_length(self, max_length):
+        if self.pad_to_multiple_of:
+            return -(-max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        return max_length
+
+    def _split(self, indices):
+        """按长度降序排列的下标切成批次"""
+        if self.max_tokens is None:
+            batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+            if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            return batches
+        batches = []
+        start = 0
+        while start < len(indices):
+            # 降序排列，批内最长的就是第一条
+            width = self.padded_length(int(self.lengths[indices[start]]))
+            size = max(1, self.max_tokens // max(1, width))
+            if self.batch_size is not None:
+                size = min(size, self.batch_size)
+            batches.append(indices[start:start + size])
+            start += size
+        return batches
+
+    def _build_plan(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        permutation = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(permutation), self.mega_batch_size):
+            mega_batch = permutation[start:start + self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(-self.lengths[mega_batch], kind="stable")]
+            batches.extend(self._split(mega_batch))
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        if batches:
+            largest = max(range(len(batches)), key=lambda i: len(batches[i]) * int(self.lengths[batches[i][0]]))
+            batches[0], batches[largest] = batches[largest], batches[0]
+        return [batch.tolist() for batch in batches]
+
+    def _on_epoch_begin(self):
+        self.reset_stats()
+
+    def _on_batch(self, batch):
+        batch_lengths = self.lengths[batch]
+        self.num_batches += 1
+        self.num_samples += len(batch)
+        self.real_tokens += int(batch_lengths.sum())
+        self.padded_tokens += len(batch) * self.padded_length(int(batch_lengths.max()))
+
+    def stats(self):
+        """当前epoch已产出批次的padding统计"""
+        return {
+            "batches": self.num_batches,
+            "samples": self.num_samples,
+            "real_tokens": self.real_tokens,
+            "padded_tokens": self.padded_tokens,
+            "padding_efficiency": self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0,
+        }
+
+class PaddingEfficiencyCallback(TrainerCallback):
+    """每个epoch结束时记录sampler的padding效率"""
+
+    def __init__(self, sampler=None):
+        self.sampler = sampler
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if self.sampler is None or not self.sampler.num_batches:
+            return
+        stats = self.sampler.stats()
+        state.log_history.append({**stats, "epoch": state.epoch, "step": state.global_step})
+        print(f"epoch {state.epoch:.2f} padding效率：{stats['padding_efficiency']:.2%}"
+              f"（真实token {stats['real_tokens']} / 补齐后 {stats['padded_tokens']}，{stats['batches']}批）")
+
+def use_length_grouped_batches(trainer, batch_size=None, max_tokens=None, mega_batch_mult=MEGA_BATCH_MULT,
+                               pad_to_multiple_of=None):
+    """让trainer的训练DataLoader改用LengthGroupedBatchSampler，并注册PaddingEfficiencyCallback
+
+    样本长度在创建DataLoader时从trainer.train_dataset读取（此时SFTTrainer已完成分词）。
+    batch_size默认取per_device_train_batch_size；给出max_tokens时每批样本数由token预算决定，
+    per_device_train_batch_size不再生效（batch_size仍作为样本数上限）。
+    """
+    callback = PaddingEfficiencyCallback()
+    trainer.add_callback(callback)
+
+    def make_sampler(dataset, args):
+        callback.sampler = LengthGroupedBatchSampler(
+            dataset_lengths(dataset),
+            batch_size=batch_size if batch_size or max_tokens else args.per_device_train_batch_size,
+            max_tokens=max_tokens,
+            mega_batch_mult=mega_batch_mult,
+            seed=args.seed,
+            drop_last=args.dataloader_drop_last,
+            pad_to_multiple_of=pad_to_multiple_of,
+        )
+        return callback.sampler
+
+    use_batch_sampler(trainer, make_sampler)
+    return callback
+
+if __name__ == "__main__":
+    # 自检：合成长尾长度分布，比较随机组批和分桶组批的padding效率，并检查每个epoch恰好覆盖全部样本
+    rng = np.random.default_rng(0)
+    lengths = np.minimum(rng.lognormal(6.0, 0.8, size=20000).astype(np.int64) + 16, 2048)
+
+    def check(sampler, epochs=2):
+        orders = []
+        for epoch in range(epochs):
+            sampler.set_epoch(epoch)
+            batches = list(sampler)
+            assert len(batches) == len(sampler)
+            indices = sorted(i for batch in batches for i in batch)
+            assert indices == list(range(len(lengths))), "每个epoch应恰好包含每个样本一次"
+            if sampler.max_tokens is not None:
+                assert all(len(b) == 1 or len(b) * lengths[b].max() <= sampler.max_tokens for b in batches)
+            orders.append(batches)
+        assert orders[0] != orders[1], "不同epoch的划分应不同"
+        return sampler.stats()
+
+    random_batches = np.array_split(rng.permutation(len(lengths)), len(lengths) // 8)
+    random_padded = sum(len(b) * int(lengths[b].max()) for b in random_batches)
+    print(f"随机组批（batch_size=8）padding效率：{lengths.sum() / random_padded:.2%}")
+    stats = check(LengthGroupedBatchSampler(lengths, batch_size=8, seed=3407))
+    print(f"分桶组批（batch_size=8）padding效率：{stats['padding_efficiency']:.2%}，{stats['batches']}批")
+    stats = check(LengthGroupedBatchSampler(lengths, max_tokens=8192, seed=3407))
+    print(f"token预算组批（max_tokens=8192）padding效率：{stats['padding_efficiency']:.2%}，"
+          f"{stats['batches']}批，平均每批{stats['samples'] / stats['batches']:.1f}条")
+    # 同一seed和epoch的划分可复现
+    assert LengthGroupedBatchSampler(lengths, max_tokens=8192, seed=1).plan(3) == \
+        LengthGroupedBatchSampler(lengths, max_tokens=8192, seed=1).plan(3)
+    print("自检通过")
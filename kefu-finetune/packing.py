@@ -0,0 +1,303 @@
+"""免padding的序列打包训练
+
+把多条样本拼成不超过max_length的包，一个batch的所有包再展平成一行（[1, 总token数]），完全没有pad：
+    - pack_sequences：best-fit decreasing（按长度从长到短，每条放入剩余空间最小且装得下的包）；
+    - PackedDataset：按打包结果组合任意按下标取样本的数据集（TokenStore、ConcatTokenStore、datasets.Dataset），
+      每个包返回拼接后的input_ids、各样本长度seq_lengths，以及（样本带有时）拼接后的assistant_masks；
+    - PaddingFreeCollator：展平batch，position_ids在每条样本开头归零，每条样本的第一个token不参与loss
+      （否则会用上一条样本的最后一个token预测它）。
+use_packing按包组批（per_device_train_batch_size为包数）；use_padding_free不打包，只把每个batch的样本展平，
+每步的样本数不变（batch_tuner用它与补齐比较）。
+用TRL的SFTTrainer训练时（qwen3_finetune.py），打包走TRL自带的路径：SFTConfig(packing=True, padding_free=True)
+由TRL按BFD打包并使用它的免padding collator，注意力是否按样本分块由TRL/Unsloth负责（非flash-attention时TRL会警告）。
+跳过SFTTrainer数据预处理的预分词数据不会被TRL打包，用pack_train_dataset换成PackedDataset，
+输出字段（input_ids、seq_lengths、assistant_masks）与TRL打包的结果相同；padding_free_collator同样优先
+沿用trainer上TRL的collator。
+不经过TRL时，注意力必须按样本分块（块对角 + 因果），否则样本会看到同一行里前面的样本。
+use_packing/PaddingFreeCollator只接受已确认不跨样本的实现：
+    - block_diagonal_mask=True：给出4D加性注意力掩码（0或dtype最小值，dtype需与模型计算精度一致），
+      transformers的eager/sdpa由自检（需要torch）逐条对比打包前后的logits；掩码大小为 总token数²，只适合调试和CPU验证；
+    - flash_attention_2/3：transformers按归零的position_ids走varlen路径（与DataCollatorWithFlattening相同）。
+sdpa/eager不带掩码时是否识别position_ids取决于transformers版本，Unsloth（FastLanguageModel）会替换注意力的forward，
+两者都未验证，use_packing拒绝打包（packed_attention_error给出原因）。
+"""
+import dataclasses
+from bisect import bisect_left, insort
+
+import numpy as np
+
+IGNORE_INDEX = -100
+# 只靠归零的position_ids就能区分打包样本的注意力实现
+VARLEN_ATTENTION = ("flash_attention_2", "flash_attention_3")
+# 使用4D块对角掩码时已验证的注意力实现
+MASKED_ATTENTION = ("eager", "sdpa")
+
+def pack_sequences(lengths, max_length):
+    """best-fit decreasing打包，返回[[样本下标, ...], ...]；超过max_length的样本单独成包（按max_length计）"""
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_length)
+    packs = []
+    free = []  # (剩余空间, 包下标)，按剩余空间升序
+    for index in np.argsort(-lengths, kind="stable").tolist():
+        length = int(lengths[index])
+        position = bisect_left(free, (length, -1))
+        if position < len(free):
+            remaining, pack_index = free.pop(position)
+            packs[pack_index].append(index)
+        else:
+            remaining, pack_index = max_length, len(packs)
+            packs.append([index])
+        if remaining - length > 0:
+            insort(free, (remaining - length, pack_index))
+    return packs
+
+def packing_stats(packs, lengths, max_length):
+    """填充率（包内token数 / 包数 × max_length）和每包样本数"""
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_length)
+    sequences_per_pack = np.array([len(pack) for pack in packs], dtype=np.int64)
+    num_tokens = int(lengths.sum())
+    return {
+        "num_sequences": int(sequences_per_pack.sum()),
+        "num_packs": len(packs),
+        "num_tokens": num_tokens,
+        "fill_ratio": num_tokens / (len(packs) * max_length) if packs else 0.0,
+        "sequences_per_pack_mean": float(sequences_per_pack.mean()) if packs else 0.0,
+        "sequences_per_pack_max": int(sequences_per_pack.max()) if packs else 0,
+    }
+
+def print_packing_stats(stats):
+    print(f"序列打包：{stats['num_sequences']}条样本 → {stats['num_packs']}个包，"
+          f"填充率{stats['fill_ratio']:.2%}，每包平均{stats['sequences_per_pack_mean']:.2f}条（最多"
+          f"{stats['sequences_per_pack_max']}条）")
+
+class PackedDataset:
+    """按pack_sequences的结果把样本组合成包的数据集"""
+
+    def __init__(self, dataset, max_length, lengths=None):
+        from length_sampler import dataset_lengths
+
+        self.dataset = dataset
+        self.max_length = max_length
+        lengths = dataset_lengths(dataset) if lengths is None else np.asarray(lengths, dtype=np.int64)
+        self.packs = pack_sequences(lengths, max_length)
+        self.stats = packing_stats(self.packs, lengths, max_length)
+        print_packing_stats(self.stats)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, index):
+        samples = [self.dataset[i] for i in self.packs[index]]
+        input_ids = [np.asarray(sample["input_ids"][:self.max_length], dtype=np.int64) for sample in samples]
+        pack = {
+            "input_ids": np.concatenate(input_ids),
+            "seq_lengths": [len(ids) for ids in input_ids],
+        }
+        if "assistant_masks" in samples[0]:
+            pack["assistant_masks"] = np.concatenate([np.asarray(sample["assistant_masks"][:self.max_length],
+                                                                 dtype=np.int64) for sample in samples])
+        return pack
+
+class PaddingFreeCollator:
+    """把一个batch的样本（或PackedDataset的包）展平成一行，position_ids按样本归零
+
+    样本带assistant_masks且assistant_only_loss=True时只对assistant回复计算loss。
+    return_tensors="np" 时返回numpy数组（不依赖torch，便于检查）。
+    """
+
+    def __init__(self, assistant_only_loss=True, block_diagonal_mask=False, mask_dtype="float32", return_tensors="pt"):
+        self.assistant_only_loss = assistant_only_loss
+        self.block_diagonal_mask = block_diagonal_mask
+        self.mask_dtype = mask_dtype
+        self.return_tensors = return_tensors
+
+    def _flatten(self, examples):
+        input_ids, position_ids, labels, seq_lengths = [], [], [], []
+        for example in examples:
+            ids = np.asarray(example["input_ids"], dtype=np.int64)
+            lengths = example.get("seq_lengths")
+            lengths = [len(ids)] if lengths is None else [int(n) for n in lengths]
+            example_labels = ids.copy()
+            if self.assistant_only_loss and "assistant_masks" in example:
+                example_labels[np.asarray(example["assistant_masks"]) == 0] = IGNORE_INDEX
+            starts = np.cumsum([0] + lengths[:-1])
+            example_labels[starts] = IGNORE_INDEX
+            input_ids.append(ids)
+            labels.append(example_labels)
+            position_ids.extend(np.arange(length, dtype=np.int64) for length in lengths)
+            seq_lengths.extend(lengths)
+        batch = {
+            "input_ids": np.concatenate(input_ids)[None],
+            "position_ids": np.concatenate(position_ids)[None],
+            "labels": np.concatenate(labels)[None],
+        }
+        return batch, seq_lengths
+
+    def block_diagonal(self, seq_lengths):
+        """[1, 1, T, T]的布尔掩码，True表示可以注意：同一条样本内且不看未来（返回torch张量时转为加性掩码）"""
+        sequence_ids = np.repeat(np.arange(len(seq_lengths)), seq_lengths)
+        positions = np.arange(len(sequence_ids))
+        mask = (sequence_ids[:, None] == sequence_ids[None, :]) & (positions[:, None] >= positions[None, :])
+        return mask[None, None]
+
+    def __call__(self, examples):
+        batch, seq_lengths = self._flatten(examples)
+        if self.block_diagonal_mask:
+            batch["attention_mask"] = self.block_diagonal(seq_lengths)
+        if self.return_tensors == "np":
+            return batch
+        import torch
+
+        batch = {key: torch.from_numpy(value) for key, value in batch.items()}
+        if self.block_diagonal_mask:
+            dtype = getattr(torch, self.mask_dtype)
+            batch["attention_mask"] = torch.zeros(batch["attention_mask"].shape, dtype=dtype).masked_fill_(
+                ~batch["attention_mask"], torch.finfo(dtype).min)
+        return batch
+
+def _uses_unsloth(model):
+    return any(getattr(type(module).forward, "__module__", "").startswith("unsloth") for module in model.modules())
+
+def packed_attention_error(model, block_diagonal_mask=False):
+    """模型的注意力不能确认按样本分块时返回原因，否则返回None"""
+    if _uses_unsloth(model):
+        return "模型由Unsloth加载，注意力forward被替换，未验证它是否按position_ids或4D掩码区分打包的样本"
+    attn_implementation = getattr(getattr(model, "config", None), "_attn_implementation", None)
+    if block_diagonal_mask:
+        if attn_implementation in MASKED_ATTENTION:
+            return None
+        return f"4D块对角掩码只在{'/'.join(MASKED_ATTENTION)}上验证过，当前注意力实现为{attn_implementation}"
+    if attn_implementation in VARLEN_ATTENTION:
+        return None
+    return (f"注意力实现{attn_implementation}不保证按归零的position_ids区分打包的样本；"
+            f"请用attn_implementation=\"flash_attention_2\"加载模型，或设置block_diagonal_mask=True")
+
+def pack_train_dataset(trainer, max_length):
+    """在trainer创建之后（数据已分词）把训练集换成PackedDataset，不改collator，返回打包统计
+
+    供collator已能处理seq_lengths的trainer使用（如SFTConfig(padding_free=True)时TRL的collator）；
+    三种数据来源（TokenStore、SFT缓存、datasets.Dataset）都适用，per_device_train_batch_size此后表示每步的包数。
+    """
+    trainer.train_dataset = PackedDataset(trainer.train_dataset, max_length)
+    return trainer.train_dataset.stats
+
+def use_packing(trainer, max_length, block_diagonal_mask=False, mask_dtype="float32"):
+    """把训练集换成PackedDataset，collator换成PaddingFreeCollator，返回打包统计
+
+    模型的注意力不能确认按样本分块时（见packed_attention_error）抛出ValueError。
+    """
+    error = packed_attention_error(trainer.model, block_diagonal_mask)
+    if error:
+        raise ValueError(f"不能打包训练：{error}")
+    stats = pack_train_dataset(trainer, max_length)
+    trainer.data_collator = PaddingFreeCollator(block_diagonal_mask=block_diagonal_mask, mask_dtype=mask_dtype)
+    return stats
+
+def _trl_padding_free_collator(collator):
+    """TRL的DataCollatorForLanguageModeling（带padding_free字段的dataclass）打开padding_free后的副本，否则返回None"""
+    if not dataclasses.is_dataclass(collator) or "padding_free" not in {f.name for f in dataclasses.fields(collator)}:
+        return None
+    return dataclasses.replace(collator, padding_free=True)
+
+def padding_free_collator(trainer, block_diagonal_mask=False, mask_dtype="float32"):
+    """把每个batch的样本展平成一行的collator；不能确认注意力按样本分块时返回None
+
+    trainer的collator是TRL的DataCollatorForLanguageModeling时沿用它（与SFTConfig(padding_free=True)时TRL自己创建的
+    相同），否则在packed_attention_error通过时返回PaddingFreeCollator。
+    """
+    collator = _trl_padding_free_collator(trainer.data_collator)
+    if collator is not None:
+        return collator
+    if packed_attention_error(trainer.model, block_diagonal_mask):
+        return None
+    return PaddingFreeCollator(block_diagonal_mask=block_diagonal_mask, mask_dtype=mask_dtype)
+
+def use_padding_free(trainer, block_diagonal_mask=False, mask_dtype="float32"):
+    """不打包，只把每个batch的样本展平成一行，per_device_train_batch_size仍表示样本数
+
+    collator见padding_free_collator，没有可用的collator时抛出ValueError。
+    """
+    collator = padding_free_collator(trainer, block_diagonal_mask, mask_dtype)
+    if collator is None:
+        raise ValueError(f"不能免padding训练：{packed_attention_error(trainer.model, block_diagonal_mask)}")
+    trainer.data_collator = collator
+
+if __name__ == "__main__":
+    # 自检：打包正确性和统计；装有torch时用小尺寸Qwen3在CPU上验证打包前后每条样本的logits一致
+    rng = np.random.default_rng(0)
+    max_length = 2048
+    lengths = np.minimum(rng.lognormal(6.0, 0.8, size=5000).astype(np.int64) + 16, max_length)
+    packs = pack_sequences(lengths, max_length)
+    assert sorted(i for pack in packs for i in pack) == list(range(len(lengths))), "每条样本应恰好出现在一个包中"
+    assert all(lengths[pack].sum() <= max_length for pack in packs)
+    stats = packing_stats(packs, lengths, max_length)
+    print_packing_stats(stats)
+    assert stats["num_packs"] <= int(np.ceil(lengths.sum() / max_length * 11 / 9)) + 1, "BFD不应比最优解多出太多包"
+
+    samples = [{"input_ids": list(range(1, 6)), "assistant_masks": [0, 0, 1, 1, 1]},
+               {"input_ids": [7, 8, 9], "assistant_masks": [0, 1, 1]},
+               {"input_ids": [10, 11, 12, 13], "assistant_masks": [1, 1, 1, 1]}]
+    packed = PackedDataset(samples, max_length=9, lengths=[len(sample["input_ids"]) for sample in samples])
+    batch = PaddingFreeCollator(block_diagonal_mask=True, return_tensors="np")([packed[i] for i in range(len(packed))])
+    flat_lengths = [length for i in range(len(packed)) for length in packed[i]["seq_lengths"]]
+    starts = np.cumsum([0] + flat_lengths[:-1])
+    assert (batch["position_ids"][0][starts] == 0).all() and (batch["labels"][0][starts] == IGNORE_INDEX).all()
+    assert batch["attention_mask"].shape == (1, 1, 12, 12) and batch["attention_mask"][0, 0].sum() == sum(
+        n * (n + 1) // 2 for n in flat_lengths)
+    print("打包与展平检查通过")
+
+    from types import SimpleNamespace
+
+    def fake_model(attn_implementation, forward_module="transformers.models.qwen3.modeling_qwen3"):
+        module_class = type("Attention", (), {"forward": lambda self: None})
+        module_class.forward.__module__ = forward_module
+        return SimpleNamespace(config=SimpleNamespace(_attn_implementation=attn_implementation),
+                               modules=lambda: [module_class()])
+
+    for attn_implementation, block_diagonal_mask, accepted in (
+            ("flash_attention_2", False, True), ("sdpa", True, True), ("eager", True, True),
+            ("sdpa", False, False), ("eager", False, False), ("flash_attention_2", True, False)):
+        error = packed_attention_error(fake_model(attn_implementation), block_diagonal_mask)
+        assert (error is None) == accepted, f"{attn_implementation}（4D掩码={block_diagonal_mask}）：{error}"
+    for block_diagonal_mask in (False, True):
+        assert packed_attention_error(fake_model("flash_attention_2", "unsloth.models.qwen3"), block_diagonal_mask)
+    # Unsloth加载的模型不接受PaddingFreeCollator，但沿用TRL的collator（由TRL/Unsloth处理展平的batch）
+
+    @dataclasses.dataclass
+    class TRLCollator:
+        pad_token_id: int
+        padding_free: bool = False
+
+    unsloth_model = fake_model("sdpa", "unsloth.models.qwen3")
+    assert padding_free_collator(SimpleNamespace(model=unsloth_model, data_collator=object())) is None
+    collator = padding_free_collator(SimpleNamespace(model=unsloth_model, data_collator=TRLCollator(0)))
+    assert collator == TRLCollator(0, padding_free=True)
+    print("注意力实现检查通过")
+
+    try:
+        import torch
+        from transformers import Qwen3Config, Qwen3ForCausalLM
+    except ImportError:
+        print("未安装torch，跳过模型前向检查")
+        raise SystemExit
+
+    torch.manual_seed(0)
+    config = Qwen3Config(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=256)
+    samples = [{"input_ids": torch.randint(0, 128, (n,)).tolist()} for n in (17, 5, 30, 11, 23)]
+    packed = PackedDataset(samples, max_length=48, lengths=[len(sample["input_ids"]) for sample in samples])
+    examples = [packed[i] for i in range(len(packed))]
+    order = [i for pack in packed.packs for i in pack]
+    # use_packing接受的、能在CPU上运行的实现（flash-attention需要CUDA）
+    for attn_implementation, block_diagonal_mask in (("eager", True), ("sdpa", True)):
+        config._attn_implementation = attn_implementation
+        model = Qwen3ForCausalLM(config).eval()
+        batch = PaddingFreeCollator(block_diagonal_mask=block_diagonal_mask)(examples)
+        with torch.no_grad():
+            packed_logits = model(input_ids=batch["input_ids"], position_ids=batch["position_ids"],
+                                  attention_mask=batch.get("attention_mask")).logits[0]
+            separate_logits = torch.cat([model(input_ids=torch.tensor([samples[i]["input_ids"]])).logits[0]
+                                         for i in order])
+        error = (packed_logits - separate_logits).abs().max().item()
+        assert error < 1e-4, f"{attn_implementation}（4D掩码={block_diagonal_mask}）打包后logits不一致：{error}"
+        print(f"{attn_implementation}（4D掩码={block_diagonal_mask}）：打包前后logits最大误差{error:.2e}")
+    print("自检通过")
@@ -0,0 +1,235 @@
+"""训练数据的token统计：为确定max_seq_length、batch配置和max_steps提供依据
+
+流式读取convert_data输出的训练数据（sft_streaming的分片读取，不把数据读入内存），
+按训练时相同的方式套用聊天模板并分词，统计：
+    - 每个会话的token数分布（未截断）以及超过max_seq_length被截断的会话比例和丢失的token比例；
+    - 每轮（每条消息，含角色头尾等模板token）按角色的token数分布；
+    - 截断后的总token数和assistant回复token数（只对assistant计算loss时的可训练token）；
+再按给定的batch配置估算每个epoch的步数、padding浪费和训练耗时：
+    random          随机组批，按批内最长样本补齐（默认的DataLoader）
+    length_grouped  length_sampler按长度分桶组批
+    token_budget    length_sampler按每批token预算组批（给出max_tokens_per_batch时）
+    packing         packing免padding打包，batch_size表示每步的包数
+耗时按 补齐后token数 / tokens_per_second 估算，tokens_per_second取实际训练时记录的吞吐。
+"""
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录（qwen3_template.py）
+from qwen3_template import compiled_renderer_matches, render_qwen3, render_with_template
+from token_store import assistant_mask, assistant_spans
+from sft_streaming import iter_shards, plan_stream_shards
+from length_sampler import LengthGroupedBatchSampler
+from packing import pack_sequences
+
+TURN_START = "<|im_start|>"
+ROLES = ("system", "user", "assistant")
+
+def _histogram_edges(max_seq_length):
+    """32起按2的幂分桶，max_seq_length单独作为一个边界，最后一个桶不设上限"""
+    edges = [0]
+    edge = 32
+    while edge < max_seq_length * 4:
+        edges.append(edge)
+        edge *= 2
+    edges.append(max_seq_length)
+    return sorted(set(edges))
+
+def length_summary(values, edges):
+    """分位数和直方图（桶[edges[i], edges[i+1])，最后一个桶为[edges[-1], +∞)）"""
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return {"count": 0}
+    counts = np.bincount(np.searchsorted(edges, values, side="right") - 1, minlength=len(edges))
+    return {
+        "count": int(len(values)),
+        "mean": round(float(values.mean()), 1),
+        "p50": int(np.percentile(values, 50)),
+        "p90": int(np.percentile(values, 90)),
+        "p99": int(np.percentile(values, 99)),
+        "max": int(values.max()),
+        "histogram": [{"min": edges[i], "max": edges[i + 1] if i + 1 < len(edges) else None, "count": int(count)}
+                      for i, count in enumerate(counts)],
+    }
+
+def _turn_lengths(text, token_starts):
+    """按<|im_start|>把渲染文本分成各条消息，返回[(角色, token数)]"""
+    starts = []
+    position = text.find(TURN_START)
+    while position != -1:
+        starts.append(position)
+        position = text.find(TURN_START, position + len(TURN_START))
+    bounds = np.searchsorted(token_starts, starts + [len(text)])
+    turns = []
+    for start, count in zip(starts, np.diff(bounds)):
+        role_end = text.find("\n", start)
+        turns.append((text[start + len(TURN_START):role_end], int(count)))
+    return turns
+
+def profile_sft_data(data_path, tokenizer, max_seq_length=2048, batch_size=1000):
+    """流式统计训练数据，返回(报告dict, 截断后的各会话token数数组)"""
+    use_compiled = compiled_renderer_matches(tokenizer)
+    session_lengths = []
+    assistant_tokens = []
+    assistant_tokens_truncated = []
+    turn_lengths = {role: [] for role in ROLES}
+    start_time = time.perf_counter()
+
+    def flush(entries):
+        texts = []
+        for entry in entries:
+            text = render_qwen3(entry["conversations"]) if use_compiled else None
+            texts.append(text if text is not None else
+                         render_with_template(tokenizer, entry["conversations"], entry.get("system")))
+        encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        for text, offset_mapping in zip(texts, encoded["offset_mapping"]):
+            mask = np.frombuffer(assistant_mask(offset_mapping, assistant_spans(text)), dtype=np.uint8)
+            session_lengths.append(len(offset_mapping))
+            assistant_tokens.append(int(mask.sum()))
+            assistant_tokens_truncated.append(int(mask[:max_seq_length].sum()))
+            token_starts = np.fromiter((start for start, _ in offset_mapping), dtype=np.int64,
+                                       count=len(offset_mapping))
+            for role, count in _turn_lengths(text, token_starts):
+                turn_lengths.setdefault(role, []).append(count)
+
+    entries = []
+    for entry in iter_shards(plan_stream_shards(data_path)):
+        entries.append(entry)
+        if len(entries) >= batch_size:
+            flush(entries)
+            entries = []
+    flush(entries)
+
+    lengths = np.asarray(session_lengths, dtype=np.int64)
+    truncated_lengths = np.minimum(lengths, max_seq_length)
+    edges = _histogram_edges(max_seq_length)
+    total_tokens = int(lengths.sum())
+    report = {
+        "data_path": data_path,
+        "max_seq_length": max_seq_length,
+        "num_sessions": int(len(lengths)),
+        "profile_seconds": round(time.perf_counter() - start_time, 2),
+        "session_tokens": length_summary(lengths, edges),
+        "turn_tokens": {role: length_summary(values, edges) for role, values in turn_lengths.items() if values},
+        "truncated_sessions": int((lengths > max_seq_length).sum()),
+        "truncated_session_ratio": float((lengths > max_seq_length).mean()) if len(lengths) else 0.0,
+        "total_tokens": total_tokens,
+        "tokens_after_truncation": int(truncated_lengths.sum()),
+        "truncated_token_ratio": 1 - truncated_lengths.sum() / total_tokens if total_tokens else 0.0,
+        "assistant_tokens": int(sum(assistant_tokens)),
+        "assistant_tokens_after_truncation": int(sum(assistant_tokens_truncated)),
+    }
+    return report, truncated_lengths
+
+def estimate_training(lengths, max_seq_length, per_device_batch_size=2, gradient_accumulation_steps=4,
+                      num_devices=1, epochs=1, max_tokens_per_batch=None, tokens_per_second=None, max_steps=None,
+                      seed=3407):
+    """按各组批方式估算每个epoch的步数、padding浪费和耗时；lengths为截断后的会话token数"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    real_tokens = int(lengths.sum())
+    samples_per_step = per_device_batch_size * gradient_accumulation_steps * num_devices
+    rng = np.random.default_rng(seed)
+
+    strategies = {}
+    permutation = rng.permutation(len(lengths))
+    strategies["random"] = [permutation[i:i + per_device_batch_size]
+                            for i in range(0, len(permutation), per_device_batch_size)]
+    strategies["length_grouped"] = LengthGroupedBatchSampler(lengths, batch_size=per_device_batch_size,
+                                                             seed=seed).plan(0)
+    if max_tokens_per_batch:
+        strategies["token_budget"] = LengthGroupedBatchSampler(lengths, max_tokens=max_tokens_per_batch,
+                                                               seed=seed).plan(0)
+
+    estimates = {}
+    for name, batches in strategies.items():
+        padded_tokens = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+        estimates[name] = {"batches": len(batches), "padded_tokens": padded_tokens}
+    packs = pack_sequences(lengths, max_seq_length)
+    estimates["packing"] = {"batches": math.ceil(len(packs) / per_device_batch_size), "padded_tokens": real_tokens,
+                            "packs": len(packs)}
+
+    for estimate in estimates.values():
+        steps_per_epoch = math.ceil(estimate["batches"] / (gradient_accumulation_steps * num_devices))
+        estimate["steps_per_epoch"] = steps_per_epoch
+        estimate["total_steps"] = steps_per_epoch * epochs
+        estimate["padding_ratio"] = (1 - real_tokens / estimate["padded_tokens"]) if estimate["padded_tokens"] else 0.0
+        if tokens_per_second:
+            estimate["hours_per_epoch"] = round(estimate["padded_tokens"] / tokens_per_second / 3600, 2)
+            estimate["hours_total"] = round(estimate["hours_per_epoch"] * epochs, 2)
+        if max_steps:
+            estimate["max_steps_epoch_fraction"] = max_steps / steps_per_epoch if steps_per_epoch else 0.0
+    return {
+        "per_device_batch_size": per_device_batch_size,
+        "gradient_accumulation_steps": gradient_accumulation_steps,
+        "num_devices": num_devices,
+        "samples_per_step": samples_per_step,
+        "epochs": epochs,
+        "max_tokens_per_batch": max_tokens_per_batch,
+        "tokens_per_second": tokens_per_second,
+        "max_steps": max_steps,
+        "strategies": estimates,
+    }
+
+def _print_summary(title, summary):
+    if not summary.get("count"):
+        return
+    print(f"{title}：{summary['count']}条，平均{summary['mean']}，P50 {summary['p50']}，P90 {summary['p90']}，"
+          f"P99 {summary['p99']}，最大{summary['max']}")
+    peak = max(bucket["count"] for bucket in summary["histogram"]) or 1
+    for bucket in summary["histogram"]:
+        if not bucket["count"]:
+            continue
+        label = f"{bucket['min']}-{bucket['max'] - 1}" if bucket["max"] is not None else f"{bucket['min']}+"
+        print(f"  {label:>12} {'#' * max(1, round(40 * bucket['count'] / peak)):<40} {bucket['count']}")
+
+def print_profile(report, estimate):
+    print(f"\n数据：{report['data_path']}，{report['num_sessions']}个会话（统计耗时{report['profile_seconds']}s）")
+    _print_summary("会话token数（未截断）", report["session_tokens"])
+    for role, summary in report["turn_tokens"].items():
+        _print_summary(f"每轮token数（{role}）", summary)
+    print(f"超过max_seq_length={report['max_seq_length']}被截断：{report['truncated_sessions']}个会话"
+          f"（{report['truncated_session_ratio']:.2%}），丢失{report['truncated_token_ratio']:.2%}的token")
+    print(f"截断后总token数：{report['tokens_after_truncation']}，其中assistant回复（可训练）"
+          f"{report['assistant_tokens_after_truncation']}（截断前{report['assistant_tokens']}）")
+
+    print(f"\n训练估算：每卡batch {estimate['per_device_batch_size']} × 梯度累积 "
+          f"{estimate['gradient_accumulation_steps']} × {estimate['num_devices']}卡，{estimate['epochs']}个epoch")
+    for name, strategy in estimate["strategies"].items():
+        line = (f"  {name:<15} 每epoch {strategy['steps_per_epoch']}步，共{strategy['total_steps']}步，"
+                f"padding占{strategy['padding_ratio']:.2%}")
+        if "hours_total" in strategy:
+            line += f"，约{strategy['hours_total']}小时"
+        if "max_steps_epoch_fraction" in strategy:
+            line += f"，max_steps={estimate['max_steps']}相当于{strategy['max_steps_epoch_fraction']:.2f}个epoch"
+        print(line)
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    MODEL = "unsloth/Qwen3-0.6B"
+    DATA_PATH = "../data/qwen3_finetune_data.jsonl"
+    REPORT_PATH = "../data/qwen3_finetune_data.profile.json"
+    MAX_SEQ_LENGTH = 2048
+    # 与qwen3_finetune.py的训练配置一致
+    PER_DEVICE_BATCH_SIZE = 2
+    GRADIENT_ACCUMULATION_STEPS = 4
+    NUM_DEVICES = 1
+    EPOCHS = 1
+    MAX_STEPS = 100
+    MAX_TOKENS_PER_BATCH = None
+    # 实测训练吞吐（每秒处理的补齐后token数，所有卡合计）；None时不估算耗时
+    TOKENS_PER_SECOND = None
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    report, lengths = profile_sft_data(DATA_PATH, tokenizer, max_seq_length=MAX_SEQ_LENGTH)
+    estimate = estimate_training(lengths, MAX_SEQ_LENGTH, PER_DEVICE_BATCH_SIZE, GRADIENT_ACCUMULATION_STEPS,
+                                 NUM_DEVICES, EPOCHS, MAX_TOKENS_PER_BATCH, TOKENS_PER_SECOND, MAX_STEPS)
+    print_profile(report, estimate)
+    with open(REPORT_PATH, 'w', encoding='utf-8') as f:
+        json.dump({**report, "estimate": estimate}, f, ensure_ascii=False, indent=2)
+    print(f"\n报告已保存：{REPORT_PATH}")
@@ -1,13 +1,69 @@
 from unsloth import FastLanguageModel
+import os
+import sys
 import torch
 from datasets import load_dataset
 from trl import SFTTrainer, SFTConfig
 from transformers import TrainingArguments
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录（token_store.py）
+from sft_data import load_qwen3_dataset
+from token_store import TokenStore
+from sft_cache import load_cached_sft_dataset
+from sft_streaming import load_streaming_sft_dataset
+from qwen3_template import format_qwen3_dataset
+from length_sampler import use_length_grouped_batches
+from resumable_sampler import use_batch_sampler
+from packing import pack_train_dataset, use_padding_free
+from batch_tuner import tune_batch_config
+from throughput_callback import ThroughputCallback
+from async_checkpoint import use_async_checkpoint
+
 MODEL = "unsloth/Qwen3-0.6B"
 max_seq_length = 2048
 dtype = None
 load_in_4bit = True
+# 训练数据：convert_data输出的JSONL/Arrow/Parquet文件，或分片转换的输出目录（含manifest.json，按分片并行读取）
+DATA_PATH = "../data/qwen3_finetune_data.jsonl"
+# convert_data以tokens格式输出的预分词目录；设置后跳过格式化和分词，按需从内存映射读取样本，
+# 并只对assistant回复计算loss
+TOKEN_STORE_PATH = None
+# 流式训练：按分片读取DATA_PATH，打乱分片顺序并经过打乱缓冲区，格式化和分词在DataLoader工作进程中进行，
+# 适合放不进内存的数据量；流式数据不能随机访问，PACKING和LENGTH_GROUPED_BATCHES不生效
+STREAMING_DATA = False
+STREAMING_SHUFFLE_BUFFER = 10000
+STREAMING_NUM_WORKERS = 4
+# 格式化+分词结果的磁盘缓存目录（如"../data/sft_cache"）；数据、tokenizer和聊天模板不变时再次启动直接内存映射，
+# None为每次重新处理（默认）
+DATASET_CACHE_DIR = None
+# 格式化的并行进程数（None为按CPU数），以及是否逐条校验内置渲染器与apply_chat_template的输出完全一致
+FORMAT_NUM_PROC = None
+VERIFY_TEMPLATE = False
+# 按长度分桶组批（打乱在mega-batch层面进行），减少短样本补齐到长样本的padding；每个epoch结束时打印padding效率。
+# 默认关闭，保持Trainer原有的随机组批
+LENGTH_GROUPED_BATCHES = False
+# 每批补齐后的token数上限（样本数 × 批内最长长度）；设置后每批样本数由预算决定，per_device_train_batch_size不再生效
+MAX_TOKENS_PER_BATCH = None
+# 免padding打包：走TRL的SFTConfig(packing=True, padding_free=True)，样本按best-fit decreasing拼成包，batch展平成一行，
+# position_ids按样本归零；预分词数据（TOKEN_STORE_PATH、DATASET_CACHE_DIR）不经TRL预处理，由packing.pack_train_dataset
+# 按同样的方式打包。注意力是否按样本分块由TRL/Unsloth负责，非flash-attention时TRL会给出警告。
+# 开启后per_device_train_batch_size表示每步的包数，LENGTH_GROUPED_BATCHES和TUNE_BATCH_CONFIG不再生效
+PACKING = False
+# 训练前在当前设备上试跑，每个优化步的样本数（per_device_train_batch_size × gradient_accumulation_steps）不变，
+# 选出吞吐最高且放得下的batch拆分和是否免padding展平（沿用TRL的collator打开padding_free）；
+# 结果按主机、模型、数据和LoRA配置缓存，之后直接读取
+TUNE_BATCH_CONFIG = False
+# 每步记录token/s、padding比例、数据等待/前向/反向/优化器耗时和峰值内存，写入outputs/throughput.jsonl，训练结束时打印汇总；
+# 计时需要每步同步CUDA，默认关闭
+LOG_THROUGHPUT = False
+# 断点续训：checkpoint目录（如"outputs/checkpoint-100"），True为output_dir下最新的checkpoint，None为从头训练
+RESUME_FROM_CHECKPOINT = None
+# 非流式数据改用可直接定位的batch sampler，sampler位置随checkpoint保存，续训时直接从中断的批次继续、不重放之前的批次；
+# 续训的checkpoint须在开启时保存。LENGTH_GROUPED_BATCHES总是使用；默认关闭，保持Trainer原有的随机组批
+RESUMABLE_BATCHES = False
+# 异步保存checkpoint：训练只暂停到LoRA权重和优化器状态复制进内存，文件在后台线程写出后原子重命名为checkpoint-N；
+# 每次保存打印训练暂停的时间；默认关闭，按Trainer原有方式同步保存
+ASYNC_CHECKPOINT = False
 
 # 模型加载和LoRA配置保持不变（原始代码可运行，不修改）
 model, tokenizer = FastLanguageModel.from_pretrained(
@@ -34,29 +90,34 @@ model = FastLanguageModel.get_peft_model(
 )
 
 # -------------------------- 仅修改数据加载和处理部分 --------------------------
-# 加载清洗好的Qwen3格式数据集（替换原数学推理数据集）
-dataset = load_dataset("json", data_files="../data/qwen3_finetune_data.jsonl")["train"]
-print("一条处理前的数据样本:", dataset[0])  # 查看加载的原始数据
-
-# 应用Qwen3聊天模板（将system和conversations转换为模型可识别的文本）
-def format_dataset(sample):
-    # 调用tokenizer的聊天模板，自动添加<|im_start|>/<|im_end|>标记
-    formatted_text = tokenizer.apply_chat_template(
-        sample["conversations"],
-        system=sample["system"],  # 传入system提示词
-        tokenize=False,
-        add_generation_prompt=False  # 微调时不需要生成提示
-    )
-    return {"text": formatted_text}  # 返回SFTTrainer需要的"text"字段
+if STREAMING_DATA:
+    # 只产出input_ids，与下面格式化 + SFTTrainer分词的结果相同
+    final_dataset = load_streaming_sft_dataset(DATA_PATH, tokenizer, max_length=max_seq_length, seed=3407,
+                                               buffer_size=STREAMING_SHUFFLE_BUFFER)
+    dataset_kwargs = {"skip_prepare_dataset": True}
+elif TOKEN_STORE_PATH:
+    # 样本已是token id和assistant掩码，跳过SFTTrainer的数据预处理
+    final_dataset = TokenStore(TOKEN_STORE_PATH, max_length=max_seq_length)
+    dataset_kwargs = {"skip_prepare_dataset": True}
+    print("一条预分词样本长度:", len(final_dataset[0]["input_ids"]))
+elif DATASET_CACHE_DIR:
+    # 与下面格式化 + SFTTrainer分词的结果相同（对整段计算loss），只处理缓存中没有的数据块
+    final_dataset = load_cached_sft_dataset(DATA_PATH, tokenizer, DATASET_CACHE_DIR, max_length=max_seq_length)
+    dataset_kwargs = {"skip_prepare_dataset": True}
+    print("一条缓存样本长度:", len(final_dataset[0]["input_ids"]))
+else:
+    # 加载清洗好的Qwen3格式数据集（替换原数学推理数据集）
+    dataset = load_qwen3_dataset(DATA_PATH)
+    print("一条处理前的数据样本:", dataset[0])  # 查看加载的原始数据
 
-# 批量处理数据集
-final_dataset = dataset.map(
-    format_dataset,
-    remove_columns=dataset.column_names  # 只保留格式化后的"text"字段
-)
+    # 应用Qwen3聊天模板（将system和conversations转换为模型可识别的文本），批量多进程处理，
+    # 模板与内置Qwen3渲染器一致时用字符串拼接代替逐条执行Jinja模板
+    final_dataset = format_qwen3_dataset(dataset, tokenizer, num_proc=FORMAT_NUM_PROC, verify=VERIFY_TEMPLATE)
+    dataset_kwargs = None
+    print("一条处理后的数据样本:", final_dataset[0]["text"])  # 查看格式化后的文本
 
-print("一条处理后的数据样本:", final_dataset[0]["text"])  # 查看格式化后的文本
-print("final_dataset 数据量:", len(final_dataset))
+if not STREAMING_DATA:
+    print("final_dataset 数据量:", len(final_dataset))
 # ------------------------------------------------------------------------------
 
 # 训练配置保持不变（仅根据数据量调整max_steps，避免训练不充分）
@@ -67,6 +128,10 @@ trainer = SFTTrainer(
     eval_dataset=None,
     args=SFTConfig(
         dataset_text_field="text",
+        dataset_kwargs=dataset_kwargs,
+        packing=PACKING and not STREAMING_DATA,
+        padding_free=PACKING and not STREAMING_DATA,
+        dataloader_num_workers=STREAMING_NUM_WORKERS if STREAMING_DATA else 0,
         per_device_train_batch_size=2,
         gradient_accumulation_steps=4,
         warmup_steps=5,
@@ -82,9 +147,25 @@ trainer = SFTTrainer(
     ),
 )
 
+packing = PACKING and not STREAMING_DATA
+if packing and dataset_kwargs is not None:
+    # 跳过了SFTTrainer的数据预处理，TRL不会打包；collator已是TRL的免padding collator
+    pack_train_dataset(trainer, max_seq_length)
+if TUNE_BATCH_CONFIG and not packing and not STREAMING_DATA:
+    if tune_batch_config(trainer, MODEL, max_seq_length)["padding_free"]:
+        use_padding_free(trainer)
+if LENGTH_GROUPED_BATCHES and not packing and not STREAMING_DATA:
+    use_length_grouped_batches(trainer, max_tokens=MAX_TOKENS_PER_BATCH)
+elif RESUMABLE_BATCHES and not STREAMING_DATA:
+    use_batch_sampler(trainer)
+if LOG_THROUGHPUT:
+    trainer.add_callback(ThroughputCallback(trainer))
+if ASYNC_CHECKPOINT:
+    use_async_checkpoint(trainer)
+
 # 开始训练
 print("\n开始训练...")
-trainer_stats = trainer.train()
+trainer_stats = trainer.train(resume_from_checkpoint=RESUME_FROM_CHECKPOINT)
 
 print("\n训练完成！")
 print("训练统计信息:", trainer_stats)
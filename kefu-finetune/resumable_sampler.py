@@ -0,0 +1,382 @@
+"""可从任意位置直接恢复的batch sampler：断点续训时不重放已训练过的批次
+
+从checkpoint恢复时Trainer默认用skip_first_batches把DataLoader快进到中断的位置，要把已训练过的批次逐个
+再取一遍（数据在DataLoader中读取、分词时很慢）。ResumableBatchSampler 每个epoch的批次顺序只由seed和epoch决定
+（plan(epoch)），恢复时直接从该epoch的第batch_index个批次开始产出，不读取前面的任何样本：
+    - RandomBatchSampler：打乱后按固定样本数切分（打包训练、普通训练）；
+    - length_sampler.LengthGroupedBatchSampler：按长度分桶组批。
+use_batch_sampler 让trainer的训练DataLoader改用这样的sampler，并设置ignore_data_skip=True关闭Trainer的快进。
+ResumeSamplerCallback 按训练循环实际取走的批次（每个micro-batch触发一次on_substep_end或on_step_end）
+累计当前epoch的位置，保存checkpoint时作为可导出状态写入trainer_state.json的stateful_callbacks：
+    {"ResumeSamplerCallback": {"args": {}, "attributes": {"position": [epoch, batch_index]}}}
+恢复时直接读出这个位置，不用global_step推算，按token预算组批（每个epoch的批次数不同）时同样准确；
+sampler产出的批次数不能用作位置，DataLoader会预取。sampler的epoch编号与Trainer的epoch计数解耦，
+Trainer按自己推算的epoch调用set_epoch时换算到保存的epoch。
+Trainer每个epoch最多取训练开始时len(train_dataloader)个批次，批次数逐epoch变化时多出的批次被丢弃；
+sampler显式截断到这个数，恢复后从同一epoch取到的批次与不中断时相同。
+ignore_data_skip=True时Trainer只在恢复到epoch开头时载入rng_state.pth，从epoch中间恢复时不载入；
+use_batch_sampler记下恢复用的checkpoint，从epoch中间恢复时sampler开始产出第一个批次前载入
+（DataLoader创建迭代器时会消耗一个随机数，保存时已经消耗过），恢复到epoch开头时在该epoch开始时载入。
+恢复后的批次顺序和随机状态（dropout等）与不中断训练相同，见tests/test_resumable_sampler.py。
+注意：新版transformers中，每个epoch的批次数不是gradient_accumulation_steps的倍数、且从epoch中间恢复时，
+该epoch末尾不足一个累积步的几个批次会并入下一个epoch的第一个优化步（旧版Trainer自带的快进也是如此）；
+恢复后的这个epoch里state.epoch的小数部分偏小，只影响日志。
+"""
+import numpy as np
+from transformers import TrainerCallback
+from transformers.trainer_callback import ExportableState
+
+class ResumableBatchSampler:
+    """产出样本下标列表的batch sampler基类，子类实现_build_plan(epoch)
+
+    Trainer每个epoch调用set_epoch；未调用时每次遍历自动进入下一个epoch。
+    max_batches_per_epoch不为None时每个epoch最多产出这么多批次。
+    restore_rng不为None时，从resume的位置（epoch中间）开始遍历、产出第一个批次前调用一次。
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.epoch = 0
+        self.batch_index = 0
+        self.epoch_start = 0
+        self.max_batches_per_epoch = None
+        self.restore_rng = None
+        self._epoch_set = False
+        self._epoch_offset = 0
+        self._iterated_epoch = None
+        self._resume_at = None
+        self._plan_epoch = None
+        self._plan = None
+
+    def _build_plan(self, epoch):
+        raise NotImplementedError
+
+    def _on_epoch_begin(self):
+        pass
+
+    def _on_batch(self, batch):
+        pass
+
+    def set_epoch(self, epoch):
+        # resume之后第一次set_epoch传入的编号对应恢复的epoch，之后的编号按同样的差值换算
+        if self._resume_at is not None and self._epoch_offset is None:
+            self._epoch_offset = self._resume_at[0] - epoch
+        self.epoch = epoch + (self._epoch_offset or 0)
+        self._epoch_set = True
+
+    def plan(self, epoch):
+        """返回该epoch的全部批次（下标列表），结果只由seed和epoch决定"""
+        if self._plan_epoch != epoch:
+            self._plan = self._build_plan(epoch)
+            self._plan_epoch = epoch
+        return self._plan
+
+    def epoch_length(self, epoch):
+        """该epoch实际产出的批次数（计入max_batches_per_epoch）"""
+        num_batches = len(self.plan(epoch))
+        if self.max_batches_per_epoch is not None:
+            num_batches = min(num_batches, self.max_batches_per_epoch)
+        return num_batches
+
+    def resume(self, epoch, batch_index):
+        """下一次遍历从第epoch个epoch的第batch_index个批次开始"""
+        self.epoch = epoch
+        self._epoch_set = True
+        self._epoch_offset = None
+        self._resume_at = (epoch, batch_index)
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "batch_index": self.batch_index}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self._plan_epoch = None
+        self.resume(state["epoch"], state["batch_index"])
+
+    def __len__(self):
+        return self.epoch_length(self.epoch)
+
+    def __iter__(self):
+        if not self._epoch_set and self._iterated_epoch == self.epoch:
+            self.epoch += 1
+        self._epoch_set = False
+        self._iterated_epoch = self.epoch
+        start = 0
+        if self._resume_at is not None and self._resume_at[0] == self.epoch:
+            start = self._resume_at[1]
+        self._resume_at = None
+        self.epoch_start = start
+        if start and self.restore_rng is not None:
+            self.restore_rng()
+        self._on_epoch_begin()
+        plan = self.plan(self.epoch)
+        for index in range(start, self.epoch_length(self.epoch)):
+            self.batch_index = index + 1
+            self._on_batch(plan[index])
+            yield plan[index]
+
+class RandomBatchSampler(ResumableBatchSampler):
+    """每个epoch打乱全部样本后按batch_size切分"""
+
+    def __init__(self, num_samples, batch_size, seed=0, drop_last=False):
+        super().__init__(seed)
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def _build_plan(self, epoch):
+        permutation = np.random.default_rng([self.seed, epoch]).permutation(self.num_samples)
+        end = self.num_samples - self.num_samples % self.batch_size if self.drop_last else self.num_samples
+        return [permutation[i:i + self.batch_size].tolist() for i in range(0, end, self.batch_size)]
+
+def _find_batch_sampler(dataloader):
+    """DataLoader（或accelerate包装后的DataLoaderShard/BatchSamplerShard）中的ResumableBatchSampler
+
+    按接口查找而不是isinstance，直接运行本文件自检时length_sampler导入的是另一份模块中的基类。
+    """
+    sampler = getattr(dataloader, "batch_sampler", None)
+    while sampler is not None and not hasattr(sampler, "resume"):
+        sampler = getattr(sampler, "batch_sampler", None)
+    return sampler
+
+class ResumeSamplerCallback(TrainerCallback, ExportableState):
+    """把sampler的位置随checkpoint保存，从checkpoint恢复时定位到中断的批次"""
+
+    def __init__(self, sampler=None):
+        self.sampler = sampler
+        self.position = None
+        self._consumed = 0
+        self._world_size = 1
+        self._restore_rng_at_epoch_begin = False
+
+    def current_position(self):
+        """已被训练循环取走的批次之后的位置[epoch, batch_index]；当前epoch已取完时为下一个epoch的开头"""
+        if self.sampler is None:
+            return None
+        epoch = self.sampler.epoch
+        # 多卡时每个进程依次取第 rank, rank + 进程数, ... 个批次
+        batch_index = self.sampler.epoch_start + self._consumed * self._world_size
+        if batch_index >= self.sampler.epoch_length(epoch):
+            return [epoch + 1, 0]
+        return [epoch, batch_index]
+
+    def state(self):
+        return {"args": {}, "attributes": {"position": self.current_position()}}
+
+    def on_train_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        # restore_callback_states_from_checkpoint=True时Trainer会换成新建的实例，sampler从DataLoader中重新找
+        self.sampler = _find_batch_sampler(train_dataloader) or self.sampler
+        self._world_size = args.world_size
+        if self.sampler is None:
+            return
+        if train_dataloader is not None:
+            self.sampler.max_batches_per_epoch = len(train_dataloader) * args.world_size
+        if state.global_step == 0:
+            return
+        saved = state.stateful_callbacks.get(type(self).__name__)
+        if isinstance(saved, list):
+            saved = saved[-1]
+        position = saved["attributes"].get("position") if saved else self.position
+        if position is None:
+            raise ValueError("checkpoint的trainer_state.json中没有sampler位置（保存时未使用use_batch_sampler），"
+                             "无法直接定位到中断的批次")
+        epoch, batch_index = position
+        self.sampler.resume(epoch, batch_index)
+        # 从epoch中间恢复时由sampler载入随机数状态，恢复到epoch开头时在on_epoch_begin中载入
+        self._restore_rng_at_epoch_begin = batch_index == 0
+        if state.is_world_process_zero:
+            print(f"从global_step {state.global_step}恢复：直接从epoch {epoch}的第{batch_index}个批次开始，不重放之前的批次")
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self._consumed = 0
+        if self._restore_rng_at_epoch_begin:
+            self._restore_rng_at_epoch_begin = False
+            if self.sampler.restore_rng is not None:
+                self.sampler.restore_rng()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._consumed += 1
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._consumed += 1
+
+def use_batch_sampler(trainer, make_sampler=None):
+    """让trainer的训练DataLoader改用make_sampler(dataset, args)返回的ResumableBatchSampler，
+    并注册ResumeSamplerCallback；make_sampler默认为RandomBatchSampler（batch_size取per_device_train_batch_size）
+
+    sampler在创建DataLoader时构造（此时SFTTrainer已完成分词、打包等替换），返回ResumeSamplerCallback，
+    其sampler属性为当前使用的sampler。从checkpoint恢复时sampler.restore_rng载入该checkpoint的随机数状态。
+    """
+    from functools import partial
+
+    from torch.utils.data import DataLoader
+
+    if make_sampler is None:
+        def make_sampler(dataset, args):
+            return RandomBatchSampler(len(dataset), args.per_device_train_batch_size, seed=args.seed,
+                                      drop_last=args.dataloader_drop_last)
+
+    callback = ResumeSamplerCallback()
+    trainer.add_callback(callback)
+    trainer.args.ignore_data_skip = True
+    # trainer.train()把resume_from_checkpoint=True解析为具体目录后传给_inner_training_loop，在这里记下
+    resume_checkpoint = [None]
+    inner_training_loop = trainer._inner_training_loop
+
+    def _inner_training_loop(*args, resume_from_checkpoint=None, **kwargs):
+        resume_checkpoint[0] = resume_from_checkpoint
+        return inner_training_loop(*args, resume_from_checkpoint=resume_from_checkpoint, **kwargs)
+
+    trainer._inner_training_loop = _inner_training_loop
+
+    def get_train_dataloader():
+        args = trainer.args
+        dataset = trainer.train_dataset
+        data_collator = trainer.data_collator
+        sampler = make_sampler(dataset, args)
+        if resume_checkpoint[0] is not None:
+            sampler.restore_rng = partial(trainer._load_rng_state, resume_checkpoint[0])
+        callback.sampler = sampler
+        # 与Trainer相同：datasets.Dataset去掉模型不用的列，其他数据集在collator中去掉
+        try:
+            import datasets
+            is_hf_dataset = isinstance(dataset, datasets.Dataset)
+        except ImportError:
+            is_hf_dataset = False
+        if is_hf_dataset:
+            dataset = trainer._remove_unused_columns(dataset, description="training")
+        else:
+            data_collator = trainer._get_collator_with_removed_columns(data_collator, description="training")
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=data_collator,
+            num_workers=args.dataloader_num_workers,
+            pin_memory=args.dataloader_pin_memory,
+            persistent_workers=args.dataloader_persistent_workers and args.dataloader_num_workers > 0,
+        )
+        return trainer.accelerator.prepare(dataloader)
+
+    trainer.get_train_dataloader = get_train_dataloader
+    return callback
+
+if __name__ == "__main__":
+    # 自检：中断后恢复的批次顺序与不中断时相同，且恢复不遍历之前的批次；不需要torch。
+    # 用小尺寸Qwen3比较不中断训练和从checkpoint恢复训练的批次、loss和最终参数：pytest kefu-finetune/tests
+    import time
+
+    from length_sampler import LengthGroupedBatchSampler
+
+    rng = np.random.default_rng(0)
+    lengths = np.minimum(rng.lognormal(6.0, 0.8, size=200000).astype(np.int64) + 16, 2048)
+    for sampler_class, kwargs in ((RandomBatchSampler, {"num_samples": len(lengths), "batch_size": 8}),
+                                  (LengthGroupedBatchSampler, {"lengths": lengths, "batch_size": 8}),
+                                  (LengthGroupedBatchSampler, {"lengths": lengths, "max_tokens": 8192})):
+        uninterrupted = sampler_class(seed=3407, **kwargs)
+        batches = []
+        for epoch in range(2):
+            uninterrupted.set_epoch(epoch)
+            batches.extend(uninterrupted)
+        num_batches = len(uninterrupted.plan(0))
+        for stop in (0, 1, num_batches // 2, num_batches - 1, num_batches, num_batches + 7):
+            resumed = sampler_class(seed=3407, **kwargs)
+            resumed.resume(stop // num_batches, stop % num_batches)
+            resumed_batches = list(resumed)
+            resumed.set_epoch(1)
+            if stop < num_batches:
+                resumed_batches.extend(resumed)
+            assert resumed_batches == batches[stop:], f"{sampler_class.__name__}从第{stop}个批次恢复后顺序不一致"
+        # 恢复到最后一个批次与从头开始的耗时相当（plan之外不做任何与位置有关的工作）
+        timings = []
+        for batch_index in (0, num_batches - 1):
+            resumed = sampler_class(seed=3407, **kwargs)
+            resumed.plan(0)
+            resumed.resume(0, batch_index)
+            start_time = time.perf_counter()
+            next(iter(resumed))
+            timings.append(time.perf_counter() - start_time)
+        print(f"{sampler_class.__name__}（{num_batches}批/epoch）：恢复后批次顺序一致，"
+              f"定位到第0/第{num_batches - 1}个批次耗时{timings[0] * 1e6:.0f}/{timings[1] * 1e6:.0f}微秒")
+        # state_dict记录已产出的位置
+        resumed = sampler_class(seed=3407, **kwargs)
+        iterator = iter(resumed)
+        [next(iterator) for _ in range(5)]
+        restored = sampler_class(seed=0, **kwargs)
+        restored.load_state_dict(resumed.state_dict())
+        assert next(iter(restored)) == next(iterator)
+    print("sampler检查通过")
+
+    # 按transformers 5 Trainer._run_epoch的取批方式模拟训练：每个epoch按训练开始时的len(dataloader)分成
+    # 若干优化步，每步取gradient_accumulation_steps个批次；保存时记下callback.state()，恢复时从中读出位置。
+    # 按token预算组批时每个epoch的批次数不同，检查从第2、3个epoch中间恢复后取到的批次与不中断时相同
+    from types import SimpleNamespace
+
+    class SizedLoader(SimpleNamespace):
+        def __len__(self):
+            return self.length
+
+    def simulate(make_sampler, accumulation_steps, max_steps, save_step=None, checkpoint=None):
+        """返回(取走的批次列表, (checkpoint, 保存时已取走的批次数))；checkpoint为(global_step, stateful_callbacks)"""
+        sampler = make_sampler()
+        callback = ResumeSamplerCallback()
+        args = SimpleNamespace(world_size=1)
+        state = SimpleNamespace(global_step=0, stateful_callbacks={}, is_world_process_zero=False)
+        if checkpoint is not None:
+            state.global_step, state.stateful_callbacks = checkpoint
+        steps_in_epoch = len(sampler)
+        updates_per_epoch = -(-steps_in_epoch // accumulation_steps)
+        remainder = steps_in_epoch % accumulation_steps or accumulation_steps
+        callback.on_train_begin(args, state, None, train_dataloader=SizedLoader(batch_sampler=sampler,
+                                                                                length=steps_in_epoch))
+        consumed, saved = [], None
+        epoch = state.global_step // updates_per_epoch
+        while True:
+            callback.on_epoch_begin(args, state, None)
+            sampler.set_epoch(epoch)
+            iterator = iter(sampler)
+            step = -1
+            for update_step in range(updates_per_epoch):
+                num_batches = accumulation_steps if update_step != updates_per_epoch - 1 else remainder
+                for batch in [batch for _, batch in zip(range(num_batches), iterator)]:
+                    step += 1
+                    consumed.append(batch)
+                    if (step + 1) % accumulation_steps != 0 and step + 1 != steps_in_epoch:
+                        callback.on_substep_end(args, state, None)
+                        continue
+                    state.global_step += 1
+                    callback.on_step_end(args, state, None)
+                    if state.global_step == save_step:
+                        saved = (state.global_step, {type(callback).__name__: callback.state()}), len(consumed)
+                    if state.global_step == max_steps:
+                        return consumed, saved
+            assert step >= 0, "训练循环取到空的epoch"
+            epoch += 1
+
+    def make_token_sampler():
+        return LengthGroupedBatchSampler(lengths[:3000], max_tokens=8192, seed=3407)
+
+    batch_counts = [len(make_token_sampler().plan(epoch)) for epoch in range(4)]
+    assert len(set(batch_counts)) > 1, f"按token预算组批时各epoch的批次数应不同：{batch_counts}"
+    accumulation_steps = 4
+    updates_per_epoch = -(-batch_counts[0] // accumulation_steps)
+    max_steps = updates_per_epoch * 3 + 5
+    for save_step in (updates_per_epoch + 3, updates_per_epoch * 2 + updates_per_epoch // 2,
+                      updates_per_epoch * 3 - 1):
+        consumed, (checkpoint, num_consumed) = simulate(make_token_sampler, accumulation_steps, max_steps, save_step)
+        position = checkpoint[1]["ResumeSamplerCallback"]["attributes"]["position"]
+        resumed, _ = simulate(make_token_sampler, accumulation_steps, max_steps, checkpoint=checkpoint)
+        assert resumed[:len(consumed) - num_consumed] == consumed[num_consumed:], \
+            f"从第{save_step}步（epoch {position[0]}第{position[1]}个批次）恢复后取到的批次与不中断时不同"
+        print(f"各epoch批次数{batch_counts[:3]}：从第{save_step}步（epoch {position[0]}第{position[1]}个批次）恢复，"
+              f"之后的批次与不中断时相同")
+    # 从epoch中间恢复后，该epoch末尾的几个批次并入下一个优化步，之后的优化步边界不再与epoch对齐；
+    # 恢复后的训练再次保存、再次恢复，位置仍然准确（用global_step推算位置时这里会错位）
+    consumed, (checkpoint, _) = simulate(make_token_sampler, accumulation_steps, max_steps, updates_per_epoch + 3)
+    consumed, (checkpoint, num_consumed) = simulate(make_token_sampler, accumulation_steps, max_steps,
+                                                    updates_per_epoch * 2 + 7, checkpoint)
+    resumed, _ = simulate(make_token_sampler, accumulation_steps, max_steps, checkpoint=checkpoint)
+    assert resumed[:len(consumed) - num_consumed] == consumed[num_consumed:], "第二次恢复后取到的批次与第一次恢复后的训练不同"
+    print(f"恢复后再次保存、恢复（位置{checkpoint[1]['ResumeSamplerCallback']['attributes']['position']}），"
+          f"之后的批次相同")
+
+    print("自检通过（模型训练与恢复的一致性见tests/test_resumable_sampler.py）")
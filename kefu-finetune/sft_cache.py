@@ -0,0 +1,133 @@
+"""SFT数据集的磁盘缓存：缓存套用聊天模板并分词后的结果，再次启动时直接内存映射
+
+缓存按tokenizer指纹（tokenizer文件和聊天模板的摘要）分目录，目录下按数据块保存token存储：
+    <cache_dir>/<tokenizer指纹>/blocks/<块摘要>/   连续block_size条样本的TokenStore
+    <cache_dir>/<tokenizer指纹>/files.json         数据文件（路径、大小、修改时间）→ 块摘要列表
+数据文件的大小和修改时间都没变时不读取数据，直接打开缓存；有变化时重新读取并计算各块摘要，
+只对缓存中没有的块重新格式化和分词（例如追加写入的数据只需处理新增的块）。
+max_seq_length不参与缓存键：token存储保存完整样本，读取时再按max_length截断，修改它不需要重建。
+不再被引用的块不会自动删除，需要时可以直接删除整个缓存目录。
+"""
+import hashlib
+import json
+import os
+import shutil
+from itertools import islice
+
+from sft_data import load_qwen3_dataset, resolve_data_files
+from token_store import ConcatTokenStore, TokenStore, TokenStoreWriter
+
+CACHE_VERSION = 1
+BLOCK_SIZE = 10000
+FILES_MANIFEST = "files.json"
+_TOKENIZER_FILES = ("tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "added_tokens.json",
+                    "vocab.json", "merges.txt", "chat_template.jinja")
+
+def _digest():
+    return hashlib.blake2b(digest_size=16)
+
+def tokenizer_fingerprint(tokenizer):
+    """本地目录加载的tokenizer对其文件取摘要，否则对序列化后的词表取摘要；聊天模板总是参与"""
+    h = _digest()
+    h.update(f"v{CACHE_VERSION}".encode())
+    h.update((tokenizer.chat_template or "").encode('utf-8'))
+    name_or_path = getattr(tokenizer, "name_or_path", "")
+    if os.path.isdir(name_or_path):
+        for name in _TOKENIZER_FILES:
+            path = os.path.join(name_or_path, name)
+            if not os.path.exists(path):
+                continue
+            h.update(name.encode())
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+    else:
+        h.update(tokenizer.backend_tokenizer.to_str().encode('utf-8'))
+    return h.hexdigest()
+
+def _iter_blocks(data_file, data_format, block_size):
+    """产出(块摘要, 读取该块样本的函数)；JSONL按原始字节计算摘要，只有需要重建的块才解析"""
+    if data_format == "jsonl":
+        with open(data_file, 'rb') as f:
+            while True:
+                lines = list(islice(f, block_size))
+                if not lines:
+                    return
+                h = _digest()
+                for line in lines:
+                    h.update(line)
+                yield h.hexdigest(), lambda lines=lines: [json.loads(line) for line in lines if line.strip()]
+        return
+
+    dataset = load_qwen3_dataset(data_file)
+    for start in range(0, len(dataset), block_size):
+        entries = dataset.select(range(start, min(start + block_size, len(dataset)))).to_list()
+        digest = _digest()
+        digest.update(json.dumps(entries, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        yield digest.hexdigest(), lambda entries=entries: entries
+
+def _build_block(block_path, entries, tokenizer):
+    tmp_path = block_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    writer = TokenStoreWriter(tmp_path, tokenizer)
+    for entry in entries:
+        writer.write(entry)
+    writer.close()
+    os.replace(tmp_path, block_path)
+
+def _load_files_manifest(cache_root):
+    path = os.path.join(cache_root, FILES_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_files_manifest(cache_root, manifest):
+    path = os.path.join(cache_root, FILES_MANIFEST)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def load_cached_sft_dataset(data_path, tokenizer, cache_dir, max_length=None, assistant_only_loss=False,
+                            block_size=BLOCK_SIZE):
+    """返回按下标取 {"input_ids"} 的数据集，等价于格式化为"text"字段后分词并截断到max_length
+
+    assistant_only_loss=True 时样本额外带assistant_masks，只对assistant回复计算loss。
+    data_path与load_qwen3_dataset相同，可以是单个数据文件或convert_data的分片输出目录。
+    """
+    cache_root = os.path.join(cache_dir, tokenizer_fingerprint(tokenizer))
+    blocks_dir = os.path.join(cache_root, "blocks")
+    os.makedirs(blocks_dir, exist_ok=True)
+    manifest = _load_files_manifest(cache_root)
+
+    data_files, data_format = resolve_data_files(data_path)
+    block_digests = []
+    reused = built = 0
+    for data_file in data_files:
+        stat = os.stat(data_file)
+        file_key = os.path.abspath(data_file)
+        cached = manifest.get(file_key)
+        if (cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns
+                and all(os.path.isdir(os.path.join(blocks_dir, digest)) for digest in cached["blocks"])):
+            block_digests.extend(cached["blocks"])
+            reused += len(cached["blocks"])
+            continue
+
+        file_blocks = []
+        for digest, load_entries in _iter_blocks(data_file, data_format, block_size):
+            block_path = os.path.join(blocks_dir, digest)
+            if os.path.isdir(block_path):
+                reused += 1
+            else:
+                _build_block(block_path, load_entries(), tokenizer)
+                built += 1
+            file_blocks.append(digest)
+        manifest[file_key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "blocks": file_blocks}
+        block_digests.extend(file_blocks)
+    _save_files_manifest(cache_root, manifest)
+
+    print(f"SFT数据缓存：复用{reused}个数据块，新建{built}个（{cache_root}）")
+    return ConcatTokenStore(TokenStore(os.path.join(blocks_dir, digest), max_length=max_length,
+                                       assistant_masks=assistant_only_loss)
+                            for digest in block_digests)
@@ -0,0 +1,31 @@
+import json
+import os
+from multiprocessing import cpu_count
+
+from datasets import Dataset, concatenate_datasets, load_dataset
+
+SHARD_MANIFEST_NAME = "manifest.json"
+_BUILDERS = {"jsonl": "json", "parquet": "parquet"}
+_EXTENSION_FORMATS = {".jsonl": "jsonl", ".json": "jsonl", ".arrow": "arrow", ".parquet": "parquet"}
+
+def resolve_data_files(data_path):
+    """返回(数据文件列表, 格式)；data_path可以是单个数据文件，也可以是convert_data分片输出目录"""
+    if not os.path.isdir(data_path):
+        return [data_path], _EXTENSION_FORMATS.get(os.path.splitext(data_path)[1], "jsonl")
+    with open(os.path.join(data_path, SHARD_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    data_files = [os.path.join(data_path, shard["path"]) for shard in manifest["shards"]]
+    return data_files, manifest["format"]
+
+def load_qwen3_dataset(data_path, num_proc=None):
+    """加载convert_data输出的Qwen3训练数据；分片目录按分片并行读取
+
+    Arrow IPC流文件直接内存映射（零拷贝，不经过datasets缓存）；JSONL和Parquet经load_dataset读取。
+    """
+    data_files, data_format = resolve_data_files(data_path)
+    if data_format == "arrow":
+        datasets = [Dataset.from_file(data_file) for data_file in data_files]
+        return datasets[0] if len(datasets) == 1 else concatenate_datasets(datasets)
+    if num_proc is None and len(data_files) > 1:
+        num_proc = min(len(data_files), cpu_count())
+    return load_dataset(_BUILDERS[data_format], data_files=data_files, num_proc=num_proc)["train"]
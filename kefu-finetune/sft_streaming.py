@@ -0,0 +1,112 @@
+"""流式读取SFT训练数据：按分片迭代，不把数据集读入内存
+
+load_qwen3_dataset 会把整份数据加载为内存中的Dataset（JSONL还要先转换进datasets缓存），
+数月的客服记录放不进内存时改用 load_streaming_sft_dataset：
+    - 分片：JSONL按约shard_bytes字节、在换行处切分；Parquet按row group；Arrow IPC流按文件。
+      convert_data分片输出目录中的每个文件各自切分；
+    - 打乱：每个epoch按seed和epoch打乱分片顺序，再经过buffer_size条样本的打乱缓冲区；
+    - 格式化（qwen3_template）和分词在迭代时进行，DataLoader开启多个工作进程时各进程读取不同的分片，
+      读取、格式化和分词都在工作进程中完成。
+产出的样本只有input_ids，与格式化为"text"字段后由SFTTrainer分词（截断到max_length）的结果相同，
+需要配合 dataset_kwargs={"skip_prepare_dataset": True} 使用。流式数据集没有长度，训练时必须设置max_steps。
+"""
+import json
+import mmap
+import os
+
+from datasets import IterableDataset
+
+from qwen3_template import compiled_renderer_matches, format_batch
+from sft_data import resolve_data_files
+
+SHARD_BYTES = 64 << 20
+SHUFFLE_BUFFER_SIZE = 10000
+TOKENIZE_BATCH_SIZE = 256
+
+def _jsonl_byte_ranges(path, shard_bytes):
+    """按换行对齐把文件切成约shard_bytes字节的区间"""
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return []
+    boundaries = [0]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while boundaries[-1] + shard_bytes < file_size:
+            newline_pos = mm.find(b'\n', boundaries[-1] + shard_bytes - 1)
+            if newline_pos == -1 or newline_pos + 1 >= file_size:
+                break
+            boundaries.append(newline_pos + 1)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def plan_stream_shards(data_path, shard_bytes=SHARD_BYTES):
+    """返回分片列表，每个分片是 {"format", "path", ...} 的dict"""
+    data_files, data_format = resolve_data_files(data_path)
+    shards = []
+    for data_file in data_files:
+        if data_format == "jsonl":
+            shards.extend({"format": "jsonl", "path": data_file, "byte_start": start, "byte_end": end}
+                          for start, end in _jsonl_byte_ranges(data_file, shard_bytes))
+        elif data_format == "parquet":
+            import pyarrow.parquet as pq
+
+            num_row_groups = pq.ParquetFile(data_file).num_row_groups
+            shards.extend({"format": "parquet", "path": data_file, "row_group": i} for i in range(num_row_groups))
+        else:
+            shards.append({"format": "arrow", "path": data_file})
+    return shards
+
+def _iter_shard(shard):
+    if shard["format"] == "jsonl":
+        with open(shard["path"], 'rb') as f:
+            f.seek(shard["byte_start"])
+            position = shard["byte_start"]
+            while position < shard["byte_end"]:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                if line.strip():
+                    yield json.loads(line)
+    elif shard["format"] == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(shard["path"]).iter_batches(row_groups=[shard["row_group"]]):
+            yield from batch.to_pylist()
+    else:
+        import pyarrow as pa
+
+        with pa.memory_map(shard["path"]) as source:
+            for batch in pa.ipc.open_stream(source):
+                yield from batch.to_pylist()
+
+def iter_shards(shards):
+    """按顺序逐条产出各分片的原始样本dict（未格式化、未分词），profile_sft_data也用它读取数据"""
+    # datasets按gen_kwargs中的列表划分分片：每个DataLoader工作进程、每个epoch的打乱都以分片为单位
+    for shard in shards:
+        yield from _iter_shard(shard)
+
+def _format_and_tokenize(batch, tokenizer, use_compiled, max_length):
+    texts = format_batch(batch, tokenizer, use_compiled)["text"]
+    # 与Unsloth对"text"字段的分词参数一致（Qwen3没有BOS，add_special_tokens不会额外加token）
+    input_ids = tokenizer(texts, truncation=max_length is not None, max_length=max_length,
+                          return_token_type_ids=False, return_attention_mask=False)["input_ids"]
+    return {"input_ids": input_ids}
+
+def load_streaming_sft_dataset(data_path, tokenizer, max_length=None, seed=None, buffer_size=SHUFFLE_BUFFER_SIZE,
+                               shard_bytes=SHARD_BYTES, compiled=True):
+    """返回按分片流式读取、逐批格式化并分词的IterableDataset；seed为None时不打乱"""
+    shards = plan_stream_shards(data_path, shard_bytes)
+    if not shards:
+        raise ValueError(f"没有可读取的训练数据：{data_path}")
+    use_compiled = compiled and compiled_renderer_matches(tokenizer)
+    dataset = IterableDataset.from_generator(iter_shards, gen_kwargs={"shards": shards})
+    if seed is not None:
+        dataset = dataset.shuffle(seed=seed, buffer_size=buffer_size)
+    dataset = dataset.map(
+        _format_and_tokenize,
+        batched=True,
+        batch_size=TOKENIZE_BATCH_SIZE,
+        fn_kwargs={"tokenizer": tokenizer, "use_compiled": use_compiled, "max_length": max_length},
+    )
+    print(f"流式训练数据：{len(shards)}个分片（{data_path}），打乱缓冲区{buffer_size if seed is not None else 0}条")
+    return dataset.select_columns(["input_ids"])
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 与qwen3_finetune.py相同：kefu-finetune目录和仓库根目录
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TESTS_DIR)))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
@@ -0,0 +1,77 @@
+"""用小尺寸Qwen3在CPU上试跑batch_tuner：每个试跑优化步跑满gradient_accumulation_steps个micro-batch，
+试跑不改变模型参数，结果写入缓存后直接读取。数据集是样本dict的列表（没有lengths()和select_columns）。
+"""
+import json
+
+import torch
+from transformers import Qwen3Config, Qwen3ForCausalLM, Trainer, TrainingArguments
+
+from batch_tuner import candidate_configs, tune_batch_config
+from packing import PaddingFreeCollator
+
+EFFECTIVE_BATCH_SIZE = 4
+PROBE_STEPS = 2
+
+def make_trainer(output_dir):
+    torch.manual_seed(0)
+    config = Qwen3Config(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=256)
+    generator = torch.Generator().manual_seed(0)
+    dataset = [{"input_ids": torch.randint(0, 128, (int(n),), generator=generator).tolist()}
+               for n in torch.randint(8, 40, (24,), generator=generator)]
+    args = TrainingArguments(output_dir=output_dir, per_device_train_batch_size=EFFECTIVE_BATCH_SIZE,
+                             gradient_accumulation_steps=1, learning_rate=1e-3, use_cpu=True, report_to="none")
+    return Trainer(model=Qwen3ForCausalLM(config), args=args, train_dataset=dataset,
+                   data_collator=PaddingFreeCollator(assistant_only_loss=False))
+
+def test_probe_runs_full_optimizer_steps(tmp_path):
+    trainer = make_trainer(str(tmp_path))
+    params = [p.detach().clone() for p in trainer.model.parameters()]
+    micro_batches = []
+    optimizer_steps = []
+    original_compute_loss = trainer.compute_loss
+    original_create_optimizer = trainer.create_optimizer
+
+    def compute_loss(model, inputs, *args, **kwargs):
+        micro_batches.append(inputs["input_ids"].shape)
+        return original_compute_loss(model, inputs, *args, **kwargs)
+
+    def create_optimizer():
+        optimizer = original_create_optimizer()
+        original_step = optimizer.step
+
+        def step(*args, **kwargs):
+            optimizer_steps.append(len(micro_batches))
+            return original_step(*args, **kwargs)
+
+        optimizer.step = step
+        return optimizer
+
+    trainer.compute_loss = compute_loss
+    trainer.create_optimizer = create_optimizer
+    cache_path = str(tmp_path / "batch_tuner.json")
+    config = tune_batch_config(trainer, "tiny-qwen3", 64, try_padding_free=False, probe_steps=PROBE_STEPS,
+                               cache_path=cache_path)
+
+    configs = candidate_configs(EFFECTIVE_BATCH_SIZE, try_padding_free=False)
+    assert config in configs
+    # 每种配置：一个预热步（1个micro-batch），再PROBE_STEPS个各含gradient_accumulation_steps个micro-batch的优化步
+    expected_steps = []
+    consumed = 0
+    for candidate in configs:
+        for num_micro_batches in [1] + [candidate["gradient_accumulation_steps"]] * PROBE_STEPS:
+            consumed += num_micro_batches
+            expected_steps.append(consumed)
+    assert optimizer_steps == expected_steps
+    assert all(torch.equal(before, after) for before, after in zip(params, trainer.model.parameters()))
+    assert trainer.optimizer is None
+    assert (trainer.args.per_device_train_batch_size * trainer.args.gradient_accumulation_steps
+            == EFFECTIVE_BATCH_SIZE)
+
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        probes = next(iter(json.load(f).values()))["probes"]
+    assert all(probe["tokens_per_second"] > 0 for probe in probes)
+    optimizer_steps.clear()
+    assert tune_batch_config(trainer, "tiny-qwen3", 64, try_padding_free=False, probe_steps=PROBE_STEPS,
+                             cache_path=cache_path) == config
+    assert optimizer_steps == []
@@ -0,0 +1,101 @@
+"""用小尺寸Qwen3在CPU上比较不中断训练和从checkpoint恢复训练：批次、loss和最终参数都应一致
+
+attention_dropout让训练用到随机数，检查rng_state.pth的恢复；分别从epoch开头、epoch中间和
+按token预算组批（每个epoch的批次数不同）时第3个epoch的中间恢复。需要torch，未安装时报错而不是跳过。
+"""
+import os
+
+import pytest
+import torch
+from transformers import Qwen3Config, Qwen3ForCausalLM, Trainer, TrainerCallback, TrainingArguments
+
+from length_sampler import LengthGroupedBatchSampler
+from packing import PaddingFreeCollator
+from resumable_sampler import use_batch_sampler
+
+GRADIENT_ACCUMULATION_STEPS = 4
+SAMPLERS = {
+    # 每个epoch 12个批次、3个优化步
+    "batch_size": {"batch_size": 4, "mega_batch_mult": 2},
+    "max_tokens": {"max_tokens": 96, "mega_batch_mult": 2},
+}
+
+def make_dataset():
+    generator = torch.Generator().manual_seed(0)
+    return [{"input_ids": torch.randint(0, 128, (int(n),), generator=generator).tolist()}
+            for n in torch.randint(8, 40, (48,), generator=generator)]
+
+def make_sampler(kind, dataset, seed):
+    return LengthGroupedBatchSampler([len(sample["input_ids"]) for sample in dataset], seed=seed, **SAMPLERS[kind])
+
+def updates_per_epoch(kind):
+    num_batches = len(make_sampler(kind, make_dataset(), 3407).plan(0))
+    return -(-num_batches // GRADIENT_ACCUMULATION_STEPS)
+
+class _RecordConsumed(TrainerCallback):
+    """记录每个优化步结束时已取走的批次数"""
+
+    def __init__(self, seen):
+        self.seen = seen
+        self.consumed = {}
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.consumed[state.global_step] = len(self.seen)
+
+def run(kind, output_dir, max_steps, resume_from_checkpoint=None):
+    torch.manual_seed(0)
+    config = Qwen3Config(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=256,
+                         attention_dropout=0.1)
+    model = Qwen3ForCausalLM(config)
+    args = TrainingArguments(output_dir=output_dir, per_device_train_batch_size=4,
+                             gradient_accumulation_steps=GRADIENT_ACCUMULATION_STEPS, max_steps=max_steps,
+                             learning_rate=1e-3, logging_steps=1, save_steps=1, seed=3407, use_cpu=True,
+                             report_to="none", dataloader_num_workers=0, disable_tqdm=True)
+    trainer = Trainer(model=model, args=args, train_dataset=make_dataset(),
+                      data_collator=PaddingFreeCollator(assistant_only_loss=False))
+    use_batch_sampler(trainer, lambda dataset, args: make_sampler(kind, dataset, args.seed))
+    seen = []
+    recorder = _RecordConsumed(seen)
+    trainer.add_callback(recorder)
+    original_compute_loss = trainer.compute_loss
+
+    def compute_loss(model, inputs, *args, **kwargs):
+        seen.append(inputs["input_ids"].tolist())
+        return original_compute_loss(model, inputs, *args, **kwargs)
+
+    trainer.compute_loss = compute_loss
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    losses = {entry["step"]: entry["loss"] for entry in trainer.state.log_history if "loss" in entry}
+    return seen, recorder.consumed, losses, [p.detach().clone() for p in model.parameters()]
+
+@pytest.fixture(scope="module")
+def uninterrupted(tmp_path_factory):
+    """每种sampler训练到第3个epoch中间，每步保存checkpoint"""
+    runs = {}
+    for kind in SAMPLERS:
+        output_dir = str(tmp_path_factory.mktemp(f"uninterrupted-{kind}"))
+        max_steps = updates_per_epoch(kind) * 2 + 3
+        runs[kind] = output_dir, max_steps, run(kind, output_dir, max_steps)
+    return runs
+
+def test_max_tokens_batches_vary_per_epoch():
+    sampler = make_sampler("max_tokens", make_dataset(), 3407)
+    assert len({len(sampler.plan(epoch)) for epoch in range(3)}) > 1
+
+@pytest.mark.parametrize("kind,stop", [
+    ("batch_size", "epoch_end"), ("batch_size", "mid_epoch"), ("batch_size", "third_epoch"),
+    ("max_tokens", "epoch_end"), ("max_tokens", "mid_epoch"), ("max_tokens", "third_epoch"),
+])
+def test_resume_matches_uninterrupted(uninterrupted, tmp_path, kind, stop):
+    output_dir, max_steps, (seen, consumed, losses, params) = uninterrupted[kind]
+    updates = updates_per_epoch(kind)
+    stop_step = {"epoch_end": updates, "mid_epoch": updates + 1, "third_epoch": updates * 2 + 1}[stop]
+    resumed_seen, _, resumed_losses, resumed_params = run(
+        kind, str(tmp_path), max_steps, os.path.join(output_dir, f"checkpoint-{stop_step}"))
+    assert resumed_seen == seen[consumed[stop_step]:], "恢复后的批次与不中断训练不一致"
+    # log_history中stop_step及之前的记录是从checkpoint载入的
+    for step in range(stop_step + 1, max_steps + 1):
+        assert resumed_losses[step] == pytest.approx(losses[step], abs=1e-5), f"第{step}步的loss与不中断训练不一致"
+    error = max((a - b).abs().max().item() for a, b in zip(params, resumed_params))
+    assert error < 1e-5, f"恢复训练后的参数与不中断训练不一致：{error}"
@@ -0,0 +1,208 @@
+"""训练吞吐记录：每个优化步的token/s、padding比例、数据等待和前向/反向/优化器耗时、峰值内存
+
+trainer日志只有loss、grad_norm和学习率，看不出训练是卡在数据读取还是计算上。ThroughputCallback 创建时
+包装该trainer的几个方法来计时（callback事件本身拿不到这些阶段）：
+    get_batch_samples    取出一个优化步的所有micro-batch，计为数据等待（DataLoader读取、collate；
+                         没有该方法的旧版transformers中数据等待计入other）
+    compute_loss         前向，同时统计token数（训练模式下）；非pad token数取attention_mask之和，
+                         没有2D attention_mask（免padding打包）时所有token都是真实token
+    accelerator.backward 反向
+    on_pre_optimizer_step → on_optimizer_step  优化器更新
+一步的总耗时从上一步结束（或保存检查点结束）算到本步结束，其余部分计为other。
+CUDA上计时前后同步设备（synchronize=False可关闭，此时各阶段耗时只反映提交kernel的时间）。
+
+每步一行追加写入 <output_dir>/throughput.jsonl（与各checkpoint的trainer_state.json同在output_dir下），
+训练开始时写一行train_begin，结束时写一行summary并打印汇总表。多卡训练时只有主进程写出，token数为主进程的。
+"""
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+from transformers import TrainerCallback
+
+from batch_tuner import read_peak_memory, reset_peak_memory, synchronize_device
+
+THROUGHPUT_LOG = "throughput.jsonl"
+PHASES = ("data_wait", "forward", "backward", "optimizer", "other")
+PHASE_LABELS = {"data_wait": "数据等待", "forward": "前向", "backward": "反向", "optimizer": "优化器", "other": "其他"}
+# 数据等待占一步耗时的比例超过该值时判断为受数据读取限制
+INPUT_BOUND_RATIO = 0.2
+
+def count_tokens(inputs):
+    """返回(总token数, 非pad token数)"""
+    input_ids = inputs["input_ids"]
+    total = int(np.prod(tuple(input_ids.shape)))
+    attention_mask = inputs.get("attention_mask")
+    if attention_mask is not None and len(attention_mask.shape) == 2:
+        return total, int(attention_mask.sum())
+    return total, total
+
+class ThroughputCallback(TrainerCallback):
+    """trainer.add_callback(ThroughputCallback(trainer))"""
+
+    def __init__(self, trainer, path=None, synchronize=True):
+        self.trainer = trainer
+        self.path = path
+        self.synchronize = synchronize
+        self.records = []
+        self._file = None
+        self._reset_step()
+        self._step_start = None
+        self._optimizer_start = None
+        self._wrap_trainer()
+
+    def _reset_step(self):
+        self._seconds = dict.fromkeys(PHASES[:-1], 0.0)
+        self._tokens = 0
+        self._nonpad_tokens = 0
+
+    def _sync(self):
+        if self.synchronize:
+            synchronize_device(self.trainer.args.device)
+
+    def _timed(self, phase, func):
+        def wrapper(*args, **kwargs):
+            self._sync()
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            self._sync()
+            self._seconds[phase] += time.perf_counter() - start_time
+            return result
+        return wrapper
+
+    def _wrap_trainer(self):
+        trainer = self.trainer
+        if hasattr(trainer, "get_batch_samples"):
+            trainer.get_batch_samples = self._timed("data_wait", trainer.get_batch_samples)
+        original_compute_loss = trainer.compute_loss
+        timed_compute_loss = self._timed("forward", original_compute_loss)
+
+        def compute_loss(model, inputs, *args, **kwargs):
+            # 评估时也会调用compute_loss，只统计训练
+            if not model.training:
+                return original_compute_loss(model, inputs, *args, **kwargs)
+            total, nonpad = count_tokens(inputs)
+            self._tokens += total
+            self._nonpad_tokens += nonpad
+            return timed_compute_loss(model, inputs, *args, **kwargs)
+
+        trainer.compute_loss = compute_loss
+        trainer.accelerator.backward = self._timed("backward", trainer.accelerator.backward)
+
+    def _write(self, state, record):
+        if not state.is_world_process_zero:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.path = self.path or os.path.join(args.output_dir, THROUGHPUT_LOG)
+        self.records = []
+        self._write(state, {
+            "event": "train_begin",
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "global_step": state.global_step,
+            "per_device_train_batch_size": args.per_device_train_batch_size,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            "device": str(args.device),
+        })
+        self._reset_step()
+        reset_peak_memory(args.device)
+        self._step_start = time.perf_counter()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self._optimizer_start = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._optimizer_start is not None:
+            self._sync()
+            self._seconds["optimizer"] += time.perf_counter() - self._optimizer_start
+            self._optimizer_start = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        step_seconds = now - self._step_start
+        seconds = {**self._seconds, "other": max(0.0, step_seconds - sum(self._seconds.values()))}
+        record = {
+            "event": "step",
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "step_seconds": round(step_seconds, 4),
+            "tokens": self._tokens,
+            "nonpad_tokens": self._nonpad_tokens,
+            "tokens_per_second": round(self._tokens / step_seconds, 1) if step_seconds else 0.0,
+            "nonpad_tokens_per_second": round(self._nonpad_tokens / step_seconds, 1) if step_seconds else 0.0,
+            "padding_ratio": round(1 - self._nonpad_tokens / self._tokens, 4) if self._tokens else 0.0,
+            **{f"{phase}_seconds": round(value, 4) for phase, value in seconds.items()},
+            "peak_memory_bytes": read_peak_memory(args.device),
+        }
+        self.records.append(record)
+        self._write(state, record)
+        self._reset_step()
+        reset_peak_memory(args.device)
+        self._step_start = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        # 保存检查点的耗时不计入下一步
+        self._step_start = time.perf_counter()
+
+    def summary(self, warmup_steps=1):
+        """汇总各步（跳过前warmup_steps步）：各指标的平均值、P50、P90，各阶段耗时占比"""
+        records = self.records[warmup_steps:] if len(self.records) > warmup_steps else self.records
+        if not records:
+            return None
+        metrics = {}
+        for key in ("tokens_per_second", "nonpad_tokens_per_second", "padding_ratio", "step_seconds",
+                    *(f"{phase}_seconds" for phase in PHASES)):
+            values = np.array([record[key] for record in records], dtype=np.float64)
+            metrics[key] = {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)),
+                            "p90": float(np.percentile(values, 90))}
+        total_seconds = sum(record["step_seconds"] for record in records)
+        shares = {phase: (sum(record[f"{phase}_seconds"] for record in records) / total_seconds if total_seconds else 0.0)
+                  for phase in PHASES}
+        peaks = [record["peak_memory_bytes"] for record in records if record["peak_memory_bytes"] is not None]
+        return {
+            "event": "summary",
+            "steps": len(records),
+            "skipped_warmup_steps": len(self.records) - len(records),
+            "tokens": sum(record["tokens"] for record in records),
+            "nonpad_tokens": sum(record["nonpad_tokens"] for record in records),
+            "metrics": metrics,
+            "time_share": shares,
+            "peak_memory_bytes": max(peaks) if peaks else None,
+            "input_bound": shares["data_wait"] > INPUT_BOUND_RATIO,
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        summary = self.summary()
+        if summary is not None:
+            self._write(state, summary)
+            if state.is_world_process_zero:
+                print_summary(summary)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def print_summary(summary):
+    print(f"\n训练吞吐汇总（{summary['steps']}步，跳过前{summary['skipped_warmup_steps']}步预热）：")
+    print(f"  {'指标':<16}{'平均':>12}{'P50':>12}{'P90':>12}")
+    rows = [("token/s（总）", "tokens_per_second"), ("token/s（非pad）", "nonpad_tokens_per_second"),
+            ("padding比例", "padding_ratio"), ("每步耗时s", "step_seconds")]
+    rows += [(f"{PHASE_LABELS[phase]}s", f"{phase}_seconds") for phase in PHASES]
+    for label, key in rows:
+        values = summary["metrics"][key]
+        print(f"  {label:<16}{values['mean']:>12.4g}{values['p50']:>12.4g}{values['p90']:>12.4g}")
+    print("  耗时占比：" + "，".join(f"{PHASE_LABELS[phase]}{share:.1%}"
+                                  for phase, share in summary["time_share"].items()))
+    if summary["peak_memory_bytes"] is not None:
+        print(f"  峰值内存：{summary['peak_memory_bytes'] / (1 << 30):.2f}GB")
+    if summary["input_bound"]:
+        print(f"  数据等待占比超过{INPUT_BOUND_RATIO:.0%}，训练受数据读取限制，可增加dataloader_num_workers或预先分词")
+    else:
+        print("  训练受计算限制")
@@ -0,0 +1,272 @@
+"""数据处理引擎：读取 → 解析 → 角色映射 → 过滤 → 切分 → 写出
+
+convert_data.py（htmlBody/fromRecipient字段，输出Qwen3样本）和 preprocess_data.py（body/externalNickName字段，
+输出messages格式）都只是这个引擎上的阶段配置。一次读取、解析输入，再把每个会话分发给多个输出分支：
+    reader   产出(记录块[(记录号, 原始数据)], 块结束位置)，块是分发给工作进程的单位；
+             位置是下次从此处继续读取的字节偏移，无法续读的读取器产出None
+    parser   把原始数据解析为会话dict，返回(会话或None, 提示列表)
+    mapper   把会话映射为一个样本，返回(样本或None, 提示列表)
+    filter   在主进程中按顺序判断样本是否丢弃（如增量、去重），返回None、原因代码或(原因代码, 提示信息)；
+             可以带一个在工作进程中对样本预先计算的prepare
+    splitter 把样本切分为多个窗口（如session_windows.SessionWindower）
+    sampler  不直接写出，而是先收集样本、读完后再给出抽样结果（如preprocess_data.SessionSampler）
+    writer   qwen3_writers中的写出器
+过滤总是作用在切分之前的完整会话上，一个会话的窗口要么全部写出，要么全部丢弃。
+解析、角色映射、prepare和切分在工作进程中完成，在途块数限制为 num_workers * 2，输出顺序与单进程一致。
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from conversion_stats import ConversionStats
+from qwen3_writers import open_qwen3_writer
+
+def iter_line_chunks(f_in, chunk_size, first_line_num=1, complete_lines_only=False, end_offset=None):
+    """按块读取二进制行，产出(块首行号, 行列表, 块结束处的字节偏移)
+
+    complete_lines_only=True 时不读取末尾没有换行符的行（可能仍在追加中），留给下次运行。
+    end_offset 不为None时读到该字节偏移为止，偏移须位于行首（见convert_data.plan_shards）。
+    """
+    lines = f_in if end_offset is None else iter(lambda: f_in.readline() if f_in.tell() < end_offset else b'', b'')
+    while True:
+        raw_lines = list(islice(lines, chunk_size))
+        chunk_end = f_in.tell()
+        if complete_lines_only and raw_lines and not raw_lines[-1].endswith(b'\n'):
+            chunk_end -= len(raw_lines.pop())
+            if raw_lines:
+                yield first_line_num, raw_lines, chunk_end
+            return
+        if not raw_lines:
+            return
+        yield first_line_num, raw_lines, chunk_end
+        first_line_num += len(raw_lines)
+
+def read_lines(input_path, chunk_size=1000, start_offset=0, first_line_num=1, end_offset=None,
+               complete_lines_only=False):
+    """每行一个会话，记录号为行号，搭配convert_data.parse_line；块结束位置为字节偏移"""
+    with open(input_path, 'rb') as f_in:
+        f_in.seek(start_offset)
+        for first_line_num, raw_lines, chunk_end in iter_line_chunks(f_in, chunk_size, first_line_num,
+                                                                     complete_lines_only, end_offset):
+            yield list(enumerate(raw_lines, start=first_line_num)), chunk_end
+
+def parse_passthrough(record_num, data, stats=None):
+    """读取时已完成解析的读取器（如preprocess_data.read_concatenated_json）使用"""
+    if stats is not None:
+        stats.lines += 1
+    return data, []
+
+def _field_fingerprint(fingerprint, field, entry):
+    return fingerprint(entry[field])
+
+class DedupFilter:
+    """用dedup.SessionDeduplicator丢弃重复会话；指纹在工作进程中对切分前的完整样本计算，索引只在主进程中维护"""
+
+    def __init__(self, deduplicator, field="conversations"):
+        self.deduplicator = deduplicator
+        self.prepare = partial(_field_fingerprint, deduplicator.fingerprint_func(), field)
+
+    def __call__(self, entry, record_num, fingerprint):
+        duplicate_kind = self.deduplicator.check(fingerprint)
+        return f"dedup_{duplicate_kind}" if duplicate_kind else None
+
+class PipelineOutput:
+    """一个输出分支；limit限制写出的样本数，所有分支都写满后停止读取
+
+    统计写入report_path（默认 <输出>.stats.json，为None时不写），report_extra追加到报告中。
+    """
+
+    def __init__(self, path, mapper, output_format="jsonl", filters=(), splitter=None, sampler=None, limit=None,
+                 append=False, report_path="", report_extra=None, **writer_options):
+        if output_format not in mapper.output_formats:
+            raise ValueError(f"{type(mapper).__name__}不支持输出格式{output_format}，可选：{', '.join(mapper.output_formats)}")
+        self.path = path
+        self.mapper = mapper
+        self.output_format = output_format
+        self.filters = list(filters)
+        self.splitter = splitter
+        self.sampler = sampler
+        self.limit = limit
+        self.append = append
+        self.report_path = path + ".stats.json" if report_path == "" else report_path
+        self.report_extra = report_extra or {}
+        self.writer_options = writer_options
+        self.stats = ConversionStats()
+        self.num_written = 0
+
+    @property
+    def full(self):
+        return self.limit is not None and self.num_written >= self.limit
+
+    def _worker_spec(self):
+        # 过滤器本身（如去重索引）和抽样器留在主进程，只把在工作进程中运行的部分发出去
+        return (self.mapper, [getattr(f, "prepare", None) for f in self.filters], self.splitter,
+                getattr(self.sampler, "prepare", None))
+
+    def _check(self, entry, record_num, prepared):
+        """依次执行过滤器，返回(原因代码, 提示信息或None)或None"""
+        for entry_filter, value in zip(self.filters, prepared):
+            drop = entry_filter(entry, record_num, value)
+            if drop:
+                return drop if isinstance(drop, tuple) else (drop, None)
+        return None
+
+def _process_chunk(records, parser, specs):
+    """在工作进程中解析一块记录并交给各分支，返回(结果列表, 解析统计快照, [各分支统计快照])
+
+    每条记录的结果为(记录号, 解析提示, 各分支结果或None)，分支结果为
+    (样本或None, 提示, prepare结果, 窗口列表, 切分统计快照或None, 抽样键)。
+    切分统计按样本单独返回，只有样本通过过滤时才计入分支统计。
+    """
+    parse_stats = ConversionStats()
+    branch_stats = [ConversionStats() for _ in specs]
+    results = []
+    for record_num, payload in records:
+        session, parse_notices = parser(record_num, payload, parse_stats)
+        branches = None
+        if session is not None:
+            branches = []
+            for (mapper, prepares, splitter, sample_prepare), stats in zip(specs, branch_stats):
+                entry, notices = mapper(session, record_num, stats)
+                if entry is None:
+                    branches.append((None, notices, None, None, None, None))
+                    continue
+                prepared = [prepare(entry) if prepare else None for prepare in prepares]
+                split_snapshot = None
+                windows = [entry]
+                if splitter is not None:
+                    split_stats = ConversionStats()
+                    windows = splitter.split(entry, split_stats)
+                    split_snapshot = split_stats.snapshot()
+                sample_key = sample_prepare(session) if sample_prepare else None
+                branches.append((entry, notices, prepared, windows, split_snapshot, sample_key))
+        results.append((record_num, parse_notices, branches))
+    return results, parse_stats.snapshot(), [stats.snapshot() for stats in branch_stats]
+
+def _iter_processed_chunks(reader, parser, specs, num_workers):
+    """按原始顺序产出每块的(结果列表, 解析统计快照, 各分支统计快照, 块结束位置)"""
+    if num_workers <= 1:
+        for records, position in reader:
+            yield (*_process_chunk(records, parser, specs), position)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque()
+        for records, position in reader:
+            pending.append((pool.submit(_process_chunk, records, parser, specs), position))
+            if len(pending) >= num_workers * 2:
+                future, position = pending.popleft()
+                yield (*future.result(), position)
+        while pending:
+            future, position = pending.popleft()
+            yield (*future.result(), position)
+
+def iter_mapped(reader, parser, mapper, num_workers=1):
+    """不经过滤和写出，按原始顺序逐条产出(记录号, 样本或None, 提示列表)"""
+    chunks = _iter_processed_chunks(reader, parser, [(mapper, [], None, None)], num_workers)
+    for results, _, _, _ in chunks:
+        for record_num, parse_notices, branches in results:
+            if branches is None:
+                yield record_num, None, parse_notices
+            else:
+                entry, notices = branches[0][:2]
+                yield record_num, entry, parse_notices + notices
+
+def _write(output, writer, entry):
+    write_start = time.perf_counter()
+    writer.write(entry)
+    output.stats.add_time("write", time.perf_counter() - write_start)
+    output.stats.count("written")
+    output.num_written += 1
+
+def run_pipeline(reader, outputs, parser, num_workers=1, on_chunk=None):
+    """单次读取输入，把每个会话分发到所有输出分支，返回各分支写出的样本数
+
+    on_chunk(块结束位置, 块末记录号) 在每块的结果全部写出后调用，供增量转换记录进度。
+    """
+    specs = [output._worker_spec() for output in outputs]
+    writers = []
+    chunks = _iter_processed_chunks(reader, parser, specs, num_workers)
+    try:
+        for output in outputs:
+            writers.append(open_qwen3_writer(output.path, output.output_format, append=output.append,
+                                             **output.writer_options))
+        for results, parse_snapshot, branch_snapshots, position in chunks:
+            for output, snapshot in zip(outputs, branch_snapshots):
+                output.stats.merge(parse_snapshot)
+                output.stats.merge(snapshot)
+            for record_num, parse_notices, branches in results:
+                for reason, message in parse_notices:
+                    # 解析提示对所有分支相同，只由第一个分支打印
+                    outputs[0].stats.warn(reason, message)
+                    for output in outputs[1:]:
+                        output.stats.count(reason)
+                if branches is None:
+                    continue
+                for output, writer, branch in zip(outputs, writers, branches):
+                    entry, notices, prepared, windows, split_snapshot, sample_key = branch
+                    if output.full:
+                        continue
+                    for reason, message in notices:
+                        output.stats.warn(reason, message)
+                    if entry is None:
+                        continue
+                    drop = output._check(entry, record_num, prepared)
+                    if drop:
+                        reason, message = drop
+                        if message:
+                            output.stats.warn(reason, message)
+                        else:
+                            output.stats.count(reason)
+                        continue
+                    if split_snapshot is not None:
+                        output.stats.merge(split_snapshot)
+                    if output.sampler is not None:
+                        output.sampler.add(record_num, windows, sample_key)
+                        continue
+                    for window in windows:
+                        _write(output, writer, window)
+                        if output.full:
+                            break
+            if on_chunk is not None and results:
+                on_chunk(position, results[-1][0])
+            if all(output.full for output in outputs):
+                break
+        for output, writer in zip(outputs, writers):
+            if output.sampler is not None:
+                for entry in output.sampler.sampled():
+                    _write(output, writer, entry)
+    finally:
+        chunks.close()
+        for writer in writers:
+            writer.close()
+
+    for output in outputs:
+        if output.report_path:
+            output.stats.write_report(output.report_path, output_path=output.path,
+                                      mapper=type(output.mapper).__name__, **output.report_extra)
+    return [output.num_written for output in outputs]
+
+def print_pipeline_summary(outputs, labels):
+    for output in outputs:
+        print(f"\n输出：{output.path}（{type(output.mapper).__name__}，{output.output_format}）")
+        print(f"写出样本数：{output.num_written}")
+        output.stats.print_summary(labels)
+
+if __name__ == "__main__":
+    from convert_data import REASON_LABELS, Qwen3RoleMapper, parse_line
+    from preprocess_data import MESSAGES_REASON_LABELS, MessagesRoleMapper
+
+    INPUT_RAW_DATA = "/root/qwenft/data/chatHis.txt"
+    NUM_WORKERS = os.cpu_count() or 1
+    # 一次读取同时产出Qwen3微调数据（convert_data）和messages格式数据（preprocess_data）
+    outputs = [
+        PipelineOutput("/root/qwenft/data/qwen3_finetune_data.jsonl", Qwen3RoleMapper()),
+        PipelineOutput("/root/qwenft/data/processed_chat_data.jsonl", MessagesRoleMapper()),
+    ]
+    run_pipeline(read_lines(INPUT_RAW_DATA), outputs, parse_line, num_workers=NUM_WORKERS)
+    print(f"\n流水线处理完成！")
+    print_pipeline_summary(outputs, {**REASON_LABELS, **MESSAGES_REASON_LABELS})
@@ -1,53 +1,410 @@
 import json
+import math
+import random
+import re
+import time
+from itertools import islice
+
 from tqdm import tqdm
 
-def preprocess_chat_history(input_file, output_file, limit=20):
-    processed_data = []
-    with open(input_file, 'r', encoding='utf-8') as f_in:
-        content = f_in.read()
-        decoder = json.JSONDecoder()
-        idx = 0
-        processed_count = 0
-        with tqdm(total=limit, desc="Processing chat history") as pbar:
-            while idx < len(content) and processed_count < limit:
-                try:
-                    data, new_idx = decoder.raw_decode(content[idx:])
-                    idx += new_idx
-                    chat_history = data.get('chatHistory', [])
-                    # Skip any whitespace or non-JSON characters between objects
-                    while idx < len(content) and content[idx].isspace():
-                        idx += 1
-                except json.JSONDecodeError:
-                    # If a JSON object cannot be decoded, advance by one character and try again
-                    idx += 1
-                    continue
-
-                messages = []
-                for chat in chat_history:
-                    role = ""
-                    message_content = chat.get('body', '').strip()
-                    external_nickname = chat.get('externalNickName', '')
-
-                    if message_content:
-                        if external_nickname:
-                            role = "assistant"
-                        else:
-                            role = "user"
-                        messages.append({"role": role, "content": message_content})
-                
-                if messages:
-                    processed_data.append({"messages": messages})
-                    processed_count += 1
-                    pbar.update(1)
-
-    with open(output_file, 'w', encoding='utf-8') as f_out:
-        for entry in processed_data:
-            json.dump(entry, f_out, ensure_ascii=False)
-            f_out.write('\n')
-
-    print(f"Processed {len(processed_data)} entries and saved to {output_file}")
+from pipeline import PipelineOutput, iter_mapped, parse_passthrough, run_pipeline
+
+CHUNK_SIZE = 1 << 20  # characters read per chunk
+MAX_RECORD_SIZE = 64 << 20  # give up on an object that is still incomplete after this many characters
+# A decode error this close to the end of the buffer may just mean the object continues in the next chunk
+_INCOMPLETE_MARGIN = 8
+# Text allowed between top-level objects; anything else is reported as corruption
+_SEPARATORS = " \t\r\n,[]"
+
+# Characters that change the scanner state outside and inside a string
+_STRUCT_TOKEN_RE = re.compile(r'[{}\[\]"\n]')
+_STRING_TOKEN_RE = re.compile(r'["\\\n]')
+
+class CorruptionReport:
+    """Byte ranges of the input skipped while scanning, with the reason for each."""
+
+    def __init__(self, print_first=10):
+        self.print_first = print_first
+        self.ranges = []
+
+    def add(self, byte_start, byte_end, reason):
+        last = self.ranges[-1] if self.ranges else None
+        if last and last["byte_end"] == byte_start and last["reason"] == reason:
+            # A region that spans several chunks is reported once
+            last["byte_end"] = byte_end
+            return
+        self.ranges.append({"byte_start": byte_start, "byte_end": byte_end, "reason": reason})
+        if len(self.ranges) <= self.print_first:
+            print(f"Skipped corrupt bytes [{byte_start}, {byte_end}): {reason}")
+
+    @property
+    def skipped_bytes(self):
+        return sum(r["byte_end"] - r["byte_start"] for r in self.ranges)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"num_ranges": len(self.ranges), "skipped_bytes": self.skipped_bytes,
+                       "ranges": self.ranges}, f, ensure_ascii=False, indent=2)
+
+def _scan_to_next_object(text, pos, state):
+    """Find the next plausible top-level '{' after a corrupt object.
+
+    Tracks brace depth and whether we are inside a string, so braces in string values and
+    nested objects are not mistaken for a new record. A raw newline cannot occur inside a
+    valid JSON string, so it resets both (the export has one record per line). Returns
+    (index or -1, state); state carries over when the search continues into the next chunk.
+    """
+    depth, in_string, pos_skip = state
+    pos += pos_skip
+    while True:
+        m = (_STRING_TOKEN_RE if in_string else _STRUCT_TOKEN_RE).search(text, pos)
+        if m is None:
+            return -1, (depth, in_string, max(pos - len(text), 0))
+        ch = m.group()
+        pos = m.end()
+        if ch == '\n':
+            depth, in_string = 0, False
+        elif in_string:
+            if ch == '"':
+                in_string = False
+            elif ch == '\\':
+                pos += 1
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            if depth == 0:
+                return m.start(), (0, False, 0)
+            depth += 1
+        elif ch == '[':
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+
+def iter_json_objects(f_in, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE, report=None):
+    """Yield the JSON objects found in a stream of concatenated/comma-separated objects.
+
+    The file is read in fixed-size chunks and each object is decoded in place from the
+    buffer, so memory stays bounded by chunk_size plus the largest record. After an object
+    fails to decode, the scanner jumps straight to the next plausible top-level '{' instead
+    of retrying at every character. When `report` (a CorruptionReport) is given, skipped
+    regions are recorded as byte ranges; f_in should then be opened with newline='' so
+    character and byte positions stay in step.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    idx = 0
+    eof = False
+    resync = None  # (byte offset where the corrupt object starts, reason, scan state)
+    # Byte offset of buffer[0] and a cursor for converting later buffer indexes incrementally
+    byte_base = 0
+    cursor = (0, 0)
+
+    def byte_offset(i):
+        nonlocal cursor
+        cursor_index, cursor_byte = cursor if i >= cursor[0] else (0, byte_base)
+        cursor = (i, cursor_byte + len(buffer[cursor_index:i].encode('utf-8', 'surrogateescape')))
+        return cursor[1]
+
+    def drop_consumed(i):
+        # Keep buffer[i:] only; the file position of the new buffer[0] is tracked for the report
+        nonlocal buffer, byte_base, cursor
+        if report is not None:
+            byte_base = byte_offset(i)
+        buffer = buffer[i:]
+        cursor = (0, byte_base)
+
+    while True:
+        if resync is not None:
+            corrupt_start, reason, state = resync
+            end, state = _scan_to_next_object(buffer, idx, state)
+            if end == -1:
+                if report is not None:
+                    report.add(corrupt_start, byte_offset(len(buffer)), reason)
+                    corrupt_start = byte_offset(len(buffer))
+                if eof:
+                    return
+                drop_consumed(len(buffer))
+                buffer = f_in.read(chunk_size)
+                idx = 0
+                eof = not buffer
+                resync = (corrupt_start, reason, state)
+                continue
+            if report is not None:
+                report.add(corrupt_start, byte_offset(end), reason)
+            resync = None
+            idx = end
+
+        start = buffer.find('{', idx)
+        gap_end = len(buffer) if start == -1 else start
+        if report is not None and buffer[idx:gap_end].strip(_SEPARATORS):
+            report.add(byte_offset(idx), byte_offset(gap_end), "unexpected text between objects")
+        if start == -1:
+            if eof:
+                return
+            drop_consumed(len(buffer))
+            buffer = f_in.read(chunk_size)
+            idx = 0
+            eof = not buffer
+            continue
+        try:
+            data, idx = decoder.raw_decode(buffer, start)
+        except json.JSONDecodeError as e:
+            incomplete = e.pos >= len(buffer) - _INCOMPLETE_MARGIN or e.msg.startswith("Unterminated string")
+            if incomplete and not eof and len(buffer) - start < max_record_size:
+                # Keep only the partial object and read more
+                chunk = f_in.read(chunk_size)
+                eof = not chunk
+                drop_consumed(start)
+                buffer += chunk
+                idx = 0
+            else:
+                # Corrupt object: skip to the next record
+                resync = (byte_offset(start) if report is not None else None, e.msg, (1, False, 0))
+                idx = start + 1
+            continue
+        if isinstance(data, dict):
+            yield data
+        # Drop consumed text once it outgrows a chunk so the buffer does not keep the whole file
+        if idx > chunk_size:
+            drop_consumed(idx)
+            idx = 0
+
+def chat_history_to_messages(data):
+    """Map a session to [{"role", "content"}] using the body/externalNickName fields"""
+    chat_history = data.get('chatHistory', [])
+
+    messages = []
+    for chat in chat_history:
+        role = ""
+        message_content = chat.get('body', '').strip()
+        external_nickname = chat.get('externalNickName', '')
+
+        if message_content:
+            if external_nickname:
+                role = "assistant"
+            else:
+                role = "user"
+            messages.append({"role": role, "content": message_content})
+    return messages
+
+def read_concatenated_json(input_path, chunk_size=1000, report=None):
+    """Pipeline reader for concatenated JSON objects; records are (object number, decoded object).
+
+    Objects are decoded while scanning, so pair it with pipeline.parse_passthrough. There is no
+    resumable position, so chunks carry None. Objects may span lines, which is why this reader
+    does not use session_index: that index assumes one session per line, as convert_data does.
+    """
+    # surrogateescape keeps invalid UTF-8 bytes one character each, so byte offsets stay exact
+    with open(input_path, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f_in:
+        objects = enumerate(iter_json_objects(f_in, report=report), start=1)
+        while True:
+            records = list(islice(objects, chunk_size))
+            if not records:
+                return
+            yield records, None
+
+MESSAGES_REASON_LABELS = {
+    "no_messages": "no messages, skipped",
+}
+
+class MessagesRoleMapper:
+    """Pipeline role mapper: body/externalNickName fields -> {"messages": [...]}"""
+    output_formats = ("jsonl",)
+
+    def __call__(self, session, record_num, stats):
+        start_time = time.perf_counter()
+        messages = chat_history_to_messages(session)
+        stats.add_time("role_map", time.perf_counter() - start_time)
+        if not messages:
+            return None, [("no_messages", f"Session {record_num} has no messages, skipped")]
+        return {"messages": messages}, []
+
+class ReservoirSampler:
+    """Uniform sample of k items from a stream of unknown length (Algorithm L).
+
+    Instead of drawing a random number per item, it draws how many items to skip before the
+    next replacement, so the cost after the reservoir fills is O(k log(n/k)) random draws.
+    """
+
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+        self._w = 1.0
+        self._next = None
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.k:
+            self.items.append(item)
+            if len(self.items) == self.k:
+                self._advance()
+        elif self.seen == self._next:
+            self.items[self.rng.randrange(self.k)] = item
+            self._advance()
+
+    def _advance(self):
+        # 1 - random() is in (0, 1], so log() never sees zero
+        self._w *= math.exp(math.log(1.0 - self.rng.random()) / self.k)
+        skip = math.floor(math.log(1.0 - self.rng.random()) / math.log1p(-self._w)) if self._w < 1.0 else 0
+        self._next = self.seen + skip + 1
+
+def _agent_stratum(data):
+    return str(data.get('agentloginid', ''))
+
+def _day_stratum(data):
+    return str(data.get('createmeetingtime', ''))[:10]
+
+def _month_stratum(data):
+    return str(data.get('createmeetingtime', ''))[:7]
+
+# Module-level functions rather than lambdas so they can be sent to pipeline worker processes
+STRATA = {"agent": _agent_stratum, "day": _day_stratum, "month": _month_stratum}
+
+def _allocate(counts, limit):
+    """Split `limit` across strata in proportion to their sizes (largest remainder method)"""
+    total = sum(counts.values())
+    if total <= limit:
+        return dict(counts)
+    quotas = {key: limit * count / total for key, count in counts.items()}
+    allocation = {key: int(quota) for key, quota in quotas.items()}
+    remaining = limit - sum(allocation.values())
+    for key in sorted(quotas, key=lambda key: allocation[key] - quotas[key])[:remaining]:
+        allocation[key] += 1
+    return allocation
+
+# Above this many strata a one-pass SessionSampler warns about its memory use
+MANY_STRATA = 100
+
+class StratumMapper:
+    """Pipeline role mapper for the counting pass: the session's stratum, or None if it has no messages"""
+
+    def __init__(self, stratify_by):
+        self.stratum_of = STRATA[stratify_by]
+
+    def __call__(self, session, record_num, stats):
+        return (self.stratum_of(session) if chat_history_to_messages(session) else None), []
+
+def count_strata(input_file, stratify_by, num_workers=1):
+    """Count the sessions with messages in each stratum, without keeping any of them"""
+    counts = {}
+    mapper = StratumMapper(stratify_by)
+    with tqdm(desc=f"Counting strata ({stratify_by})", unit=" sessions") as pbar:
+        for _, stratum, _ in iter_mapped(read_concatenated_json(input_file), parse_passthrough, mapper, num_workers):
+            pbar.update(1)
+            if stratum is not None:
+                counts[stratum] = counts.get(stratum, 0) + 1
+    return counts
+
+class SessionSampler:
+    """Pipeline sampler: collects sessions into per-stratum reservoirs instead of writing them.
+
+    `prepare` computes the stratum from the raw session in the worker processes; without
+    stratify_by every session falls into a single stratum (plain reservoir sampling).
+    sampled() returns the chosen entries in input order.
+
+    With a precomputed `allocation` (stratum -> sample size, e.g. from count_strata) each
+    stratum's reservoir holds exactly its share, so memory is bounded by `limit` entries.
+    Without one, the split is only known at the end: every stratum keeps up to `limit`
+    entries and sampled() allocates `limit` across them, so memory is `limit` times the
+    number of strata. A warning is printed once that exceeds MANY_STRATA.
+    """
+
+    def __init__(self, limit, rng, stratify_by=None, allocation=None):
+        self.limit = limit
+        self.rng = rng
+        self.prepare = STRATA[stratify_by] if stratify_by else None
+        self.reservoirs = {}
+        self.allocation = allocation or {}
+        self._preallocated = allocation is not None
+
+    def add(self, record_num, entries, stratum):
+        reservoir = self.reservoirs.get(stratum)
+        if reservoir is None:
+            size = self.allocation.get(stratum, 0) if self._preallocated else self.limit
+            reservoir = self.reservoirs[stratum] = ReservoirSampler(size, self.rng)
+            if not self._preallocated and len(self.reservoirs) == MANY_STRATA + 1:
+                print(f"Warning: more than {MANY_STRATA} strata, each keeps up to {self.limit} sessions "
+                      f"in memory; count strata first (see count_strata) to bound memory by the limit")
+        reservoir.add((record_num, entries))
+
+    def sampled(self):
+        if self._preallocated:
+            sampled = [item for reservoir in self.reservoirs.values() for item in reservoir.items]
+            sampled.sort(key=lambda item: item[0])
+            return [entry for _, entries in sampled for entry in entries]
+        self.allocation = _allocate({key: r.seen for key, r in self.reservoirs.items()}, self.limit)
+        sampled = []
+        for key, reservoir in self.reservoirs.items():
+            sampled.extend(self.rng.sample(reservoir.items, min(self.allocation[key], len(reservoir.items))))
+        sampled.sort(key=lambda item: item[0])
+        return [entry for _, entries in sampled for entry in entries]
+
+def preprocess_chat_history(input_file, output_file, limit=20, sampling="head", stratify_by=None, seed=None):
+    """Write up to `limit` sessions as {"messages": [...]} JSONL.
+
+    sampling="head" takes the first `limit` sessions and stops reading early.
+    sampling="reservoir" draws `limit` sessions uniformly from the whole file in one pass,
+    keeping only `limit` entries in memory.
+    sampling="stratified" groups sessions by stratify_by ("agent", "day" or "month") and
+    allocates `limit` across groups in proportion to their size. Unlike the other modes it
+    reads the input twice: the first pass only counts sessions per group, the second keeps a
+    reservoir of exactly each group's share, so memory stays bounded by `limit` entries however
+    many groups exist. A single pass cannot do both, because the shares depend on the final
+    group sizes; the one-pass alternative (SessionSampler without an allocation, as used on a
+    shared pipeline pass) keeps up to `limit` entries per group.
+    Sampled entries are written in input order. Skipped corrupt regions are written to
+    <output_file>.corruption.json and per-reason counts to <output_file>.stats.json.
+    This is a stage configuration of pipeline.run_pipeline, so the same branch can also be
+    fed from a shared pass over the log (see pipeline.py).
+    """
+    if sampling not in ("head", "reservoir", "stratified"):
+        raise ValueError(f"Unknown sampling method: {sampling}")
+    if sampling == "stratified" and stratify_by not in STRATA:
+        raise ValueError(f"stratify_by must be one of {', '.join(STRATA)}, got {stratify_by}")
+    if sampling != "head" and limit is None:
+        raise ValueError("Sampling needs a limit")
+    report = CorruptionReport()
+    sampler = None
+    if sampling == "reservoir":
+        sampler = SessionSampler(limit, random.Random(seed))
+    elif sampling == "stratified":
+        allocation = _allocate(count_strata(input_file, stratify_by), limit)
+        if len(allocation) > limit:
+            print(f"Warning: {len(allocation)} strata for a limit of {limit}, "
+                  f"{sum(1 for n in allocation.values() if n == 0)} strata get no sample")
+        sampler = SessionSampler(limit, random.Random(seed), stratify_by, allocation)
+    # Invalid bytes kept by surrogateescape are written as '?'
+    output = PipelineOutput(output_file, MessagesRoleMapper(), sampler=sampler,
+                            limit=limit if sampling == "head" else None, errors='replace')
+    if sampling == "head":
+        # Small chunks so reading stops soon after `limit` entries are written
+        reader = read_concatenated_json(input_file, chunk_size=min(limit or 1000, 1000), report=report)
+        pbar = tqdm(total=limit, desc="Processing chat history")
+    else:
+        reader = read_concatenated_json(input_file, report=report)
+        pbar = tqdm(desc=f"Sampling chat history ({sampling})", unit=" sessions")
+
+    def update_progress(position, record_num):
+        pbar.update((output.num_written if sampling == "head" else record_num) - pbar.n)
+
+    with pbar:
+        run_pipeline(reader, [output], parse_passthrough, on_chunk=update_progress)
+    processed_count = output.num_written
+    if sampling == "stratified":
+        for key in sorted(sampler.reservoirs, key=lambda key: -sampler.reservoirs[key].seen):
+            print(f"  {stratify_by}={key}: {sampler.allocation[key]} of {sampler.reservoirs[key].seen}")
+
+    report_path = output_file + ".corruption.json"
+    report.write(report_path)
+    print(f"Processed {processed_count} entries and saved to {output_file}")
+    if report.ranges:
+        print(f"Skipped {report.skipped_bytes} corrupt bytes in {len(report.ranges)} regions, see {report_path}")
 
 if __name__ == "__main__":
     input_json_file = "/root/qwenft/data/chatHis.txt"
     output_jsonl_file = "/root/qwenft/data/processed_chat_data.jsonl"
-    preprocess_chat_history(input_json_file, output_jsonl_file, limit=20)
\ No newline at end of file
+    # "head" keeps the first sessions; "reservoir" samples the whole file in one pass,
+    # "stratified" in two (a counting pass, then a sampling pass with bounded memory)
+    preprocess_chat_history(input_json_file, output_jsonl_file, limit=20, sampling="head")
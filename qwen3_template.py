@@ -0,0 +1,142 @@
+"""Qwen3聊天模板的快速渲染与批量格式化
+
+原先每条样本都调用一次 tokenizer.apply_chat_template，每次都要执行一遍Jinja模板。这里提供：
+- render_qwen3：按 chat_template.jinja 的逻辑手写的字符串拼接渲染器，覆盖训练数据用到的
+  system/user/assistant消息（含<think>思考块）；遇到tools、tool消息、tool_calls、reasoning_content等
+  返回None，由调用方回退到Jinja；
+- compiled_renderer_matches：用一组探针对话比对两种渲染结果，只有tokenizer的模板与之逐字节一致时才启用；
+- format_qwen3_dataset：批量、多进程地生成"text"字段；verify=True 时逐条与apply_chat_template比对。
+注意Qwen3模板不使用system参数，只有conversations中role为system的消息才会渲染出system块，
+这与原format_dataset传入system=...得到的文本一致。
+"""
+from multiprocessing import cpu_count
+
+_TOOL_RESPONSE_START = '<tool_response>'
+_TOOL_RESPONSE_END = '</tool_response>'
+_SUPPORTED_ROLES = ("system", "user", "assistant")
+
+def render_with_template(tokenizer, conversations, system=None):
+    """Jinja渲染（原format_dataset的调用方式）"""
+    return tokenizer.apply_chat_template(
+        conversations,
+        system=system,
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+
+def render_qwen3(messages, add_generation_prompt=False, enable_thinking=None):
+    """与Qwen3 chat_template.jinja逐字节一致的渲染；含模板中其他分支才用到的字段时返回None"""
+    if not messages:
+        return None
+    for message in messages:
+        if (message.get("role") not in _SUPPORTED_ROLES or not isinstance(message.get("content"), str)
+                or message.get("tool_calls") or message.get("reasoning_content") is not None):
+            return None
+
+    parts = []
+    if messages[0]["role"] == "system":
+        parts.append('<|im_start|>system\n' + messages[0]["content"] + '<|im_end|>\n')
+
+    # 最后一条真正的用户提问（不是包在<tool_response>里的工具结果），其后的assistant回复带思考块
+    last_query_index = len(messages) - 1
+    for index in range(len(messages) - 1, -1, -1):
+        content = messages[index]["content"]
+        if messages[index]["role"] == "user" and not (
+                content.startswith(_TOOL_RESPONSE_START) and content.endswith(_TOOL_RESPONSE_END)):
+            last_query_index = index
+            break
+
+    last_index = len(messages) - 1
+    for index, message in enumerate(messages):
+        role = message["role"]
+        content = message["content"]
+        if role == "user" or (role == "system" and index > 0):
+            parts.append('<|im_start|>' + role + '\n' + content + '<|im_end|>\n')
+        elif role == "assistant":
+            reasoning_content = ''
+            if '</think>' in content:
+                reasoning_content = content.split('</think>')[0].rstrip('\n').split('<think>')[-1].lstrip('\n')
+                content = content.split('</think>')[-1].lstrip('\n')
+            if index > last_query_index and (index == last_index or reasoning_content.strip()):
+                parts.append('<|im_start|>assistant\n<think>\n' + reasoning_content.strip('\n')
+                             + '\n</think>\n\n' + content.lstrip('\n'))
+            else:
+                parts.append('<|im_start|>assistant\n' + content)
+            parts.append('<|im_end|>\n')
+
+    if add_generation_prompt:
+        parts.append('<|im_start|>assistant\n')
+        if enable_thinking is False:
+            parts.append('<think>\n\n</think>\n\n')
+    return ''.join(parts)
+
+# 覆盖模板各分支的探针：system块、以assistant开头、多轮、已带思考内容、工具结果样式的用户消息、空内容
+_PROBE_CONVERSATIONS = [
+    [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "您好，请问有什么可以帮您？"}],
+    [{"role": "system", "content": "系统提示"}, {"role": "user", "content": "查物流"},
+     {"role": "assistant", "content": "好的"}, {"role": "user", "content": "  谢谢\n"},
+     {"role": "assistant", "content": "\n不客气"}],
+    [{"role": "assistant", "content": "欢迎光临"}, {"role": "user", "content": "在吗"},
+     {"role": "assistant", "content": "<think>\n想一想\n</think>\n\n在的"}, {"role": "system", "content": "中途提示"}],
+    [{"role": "user", "content": "问题"}, {"role": "assistant", "content": "<think>推理</think>答案"},
+     {"role": "user", "content": "<tool_response>结果</tool_response>"}, {"role": "assistant", "content": ""}],
+]
+
+def compiled_renderer_matches(tokenizer):
+    """tokenizer的聊天模板在所有探针上与render_qwen3逐字节一致时返回True"""
+    try:
+        return all(render_with_template(tokenizer, messages) == render_qwen3(messages)
+                   for messages in _PROBE_CONVERSATIONS)
+    except Exception:
+        return False
+
+def verify_compiled_renderer(dataset, tokenizer, num_samples=None):
+    """逐条比对render_qwen3与apply_chat_template，不一致时抛出ValueError并给出第一处差异"""
+    checked = 0
+    for index in range(len(dataset) if num_samples is None else min(num_samples, len(dataset))):
+        sample = dataset[index]
+        compiled = render_qwen3(sample["conversations"])
+        if compiled is None:
+            continue
+        expected = render_with_template(tokenizer, sample["conversations"], sample.get("system"))
+        if compiled != expected:
+            position = next((i for i, (a, b) in enumerate(zip(compiled, expected)) if a != b),
+                            min(len(compiled), len(expected)))
+            raise ValueError(f"第{index}条样本渲染结果不一致（位置{position}）：\n"
+                             f"compiled: {compiled[max(0, position - 40):position + 40]!r}\n"
+                             f"template: {expected[max(0, position - 40):position + 40]!r}")
+        checked += 1
+    print(f"模板渲染校验通过：{checked}条样本与apply_chat_template逐字节一致")
+    return checked
+
+def format_batch(batch, tokenizer, use_compiled):
+    """把一批 {system, conversations} 渲染为 {"text": [...]}；format_qwen3_dataset和流式读取共用"""
+    texts = []
+    for conversations, system in zip(batch["conversations"], batch["system"]):
+        text = render_qwen3(conversations) if use_compiled else None
+        if text is None:
+            text = render_with_template(tokenizer, conversations, system)
+        texts.append(text)
+    return {"text": texts}
+
+def format_qwen3_dataset(dataset, tokenizer, num_proc=None, compiled=True, verify=False, batch_size=1000):
+    """把 {system, conversations} 数据集批量转换为只含"text"字段的数据集
+
+    num_proc 默认按CPU数和批次数取较小值；compiled=True 且模板探针一致时使用render_qwen3，
+    否则（或遇到不支持的消息时）回退到apply_chat_template。
+    """
+    use_compiled = compiled and compiled_renderer_matches(tokenizer)
+    if compiled and not use_compiled:
+        print("聊天模板与内置Qwen3渲染器不一致，使用apply_chat_template渲染")
+    if verify and use_compiled:
+        verify_compiled_renderer(dataset, tokenizer)
+    if num_proc is None:
+        num_proc = min(cpu_count(), (len(dataset) + batch_size - 1) // batch_size) or None
+    return dataset.map(
+        format_batch,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc and num_proc > 1 else None,
+        fn_kwargs={"tokenizer": tokenizer, "use_compiled": use_compiled},
+        remove_columns=dataset.column_names,  # 只保留格式化后的"text"字段
+    )
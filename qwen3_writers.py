@@ -0,0 +1,147 @@
+import json
+
+from token_store import TokenStoreWriter
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("写出Arrow/Parquet格式需要安装pyarrow：pip install pyarrow") from e
+    return pyarrow
+
+class JsonlWriter:
+    """逐条写出JSONL格式的Qwen3训练样本"""
+
+    def __init__(self, path, append=False, errors=None):
+        self.path = path
+        self._f = open(path, 'a' if append else 'w', encoding='utf-8', errors=errors)
+
+    def write(self, entry):
+        self._f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self._f.close()
+
+# 元数据列及其类型；原始日志中的ID可能是数字，统一存为字符串
+METADATA_FIELDS = (
+    ("session_id", "string"),
+    ("create_time", "string"),
+    ("agent_id", "string"),
+    ("raw_line_num", "int64"),
+    ("original_rounds", "int32"),
+    ("final_rounds", "int32"),
+    # 按token预算切分时才有，未切分输出中为空
+    ("window_index", "int32"),
+    ("num_windows", "int32"),
+)
+
+def qwen3_arrow_schema(pa):
+    """列式输出的schema：system列字典编码（所有样本共用同一段提示词），元数据为带类型的结构体列"""
+    return pa.schema([
+        ("system", pa.dictionary(pa.int32(), pa.string())),
+        ("conversations", pa.list_(pa.struct([("role", pa.string()), ("content", pa.string())]))),
+        ("metadata", pa.struct([(name, getattr(pa, type_name)()) for name, type_name in METADATA_FIELDS])),
+    ])
+
+class _ColumnarWriter:
+    """按列缓存样本，攒满row_group_size条后作为一个批次（行组）写出，内存占用与数据总量无关"""
+
+    def __init__(self, path, row_group_size=10000):
+        self._pa = _require_pyarrow()
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = qwen3_arrow_schema(self._pa)
+        # system列的字典在整个文件内共享，批次之间只追加新值
+        self._system_ids = {}
+        self._system_values = []
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        self._system_indices = []
+        self._conversations = []
+        self._metadata = {name: [] for name, _ in METADATA_FIELDS}
+
+    def write(self, entry):
+        system = entry["system"]
+        system_id = self._system_ids.get(system)
+        if system_id is None:
+            system_id = self._system_ids[system] = len(self._system_values)
+            self._system_values.append(system)
+        self._system_indices.append(system_id)
+        self._conversations.append(entry["conversations"])
+        metadata = entry["metadata"]
+        for name, type_name in METADATA_FIELDS:
+            value = metadata.get(name)
+            self._metadata[name].append(str(value) if type_name == "string" and value is not None else value)
+        if len(self._system_indices) >= self.row_group_size:
+            self._flush()
+
+    def _build_batch(self):
+        pa = self._pa
+        system = pa.DictionaryArray.from_arrays(
+            pa.array(self._system_indices, type=pa.int32()), pa.array(self._system_values, type=pa.string()))
+        conversations = pa.array(self._conversations, type=self.schema.field("conversations").type)
+        metadata_type = self.schema.field("metadata").type
+        metadata = pa.StructArray.from_arrays(
+            [pa.array(self._metadata[field.name], type=field.type) for field in metadata_type],
+            fields=list(metadata_type))
+        return pa.RecordBatch.from_arrays([system, conversations, metadata], schema=self.schema)
+
+    def _flush(self):
+        if self._system_indices:
+            self._write_batch(self._build_batch())
+            self._reset_buffers()
+
+    def close(self):
+        self._flush()
+        self._close()
+
+class ArrowWriter(_ColumnarWriter):
+    """写出Arrow IPC流格式，可被datasets.Dataset.from_file直接内存映射加载（零拷贝）"""
+
+    def __init__(self, path, row_group_size=10000):
+        super().__init__(path, row_group_size)
+        self._sink = self._pa.OSFile(path, 'wb')
+        options = self._pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+        self._writer = self._pa.ipc.new_stream(self._sink, self.schema, options=options)
+
+    def _write_batch(self, batch):
+        self._writer.write_batch(batch)
+
+    def _close(self):
+        self._writer.close()
+        self._sink.close()
+
+class ParquetWriter(_ColumnarWriter):
+    """写出Parquet格式，每个批次一个行组，zstd压缩"""
+
+    def __init__(self, path, row_group_size=10000):
+        super().__init__(path, row_group_size)
+        self._writer = self._pa.parquet.ParquetWriter(path, self.schema, compression="zstd")
+
+    def _write_batch(self, batch):
+        self._writer.write_batch(batch, row_group_size=batch.num_rows)
+
+    def _close(self):
+        self._writer.close()
+
+OUTPUT_FORMATS = {
+    "jsonl": (JsonlWriter, ".jsonl"),
+    "arrow": (ArrowWriter, ".arrow"),
+    "parquet": (ParquetWriter, ".parquet"),
+    # 预分词的token存储目录，需要通过writer_options传入tokenizer
+    "tokens": (TokenStoreWriter, ".tokens"),
+}
+
+def open_qwen3_writer(path, output_format="jsonl", append=False, **writer_options):
+    """按输出格式创建写出器；只有JSONL支持追加写"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式：{output_format}，可选：{', '.join(OUTPUT_FORMATS)}")
+    writer_cls, _ = OUTPUT_FORMATS[output_format]
+    if append:
+        if writer_cls is not JsonlWriter:
+            raise ValueError(f"{output_format}格式不支持追加写，增量转换请使用jsonl")
+        return writer_cls(path, append=True)
+    return writer_cls(path, **writer_options)
@@ -0,0 +1,103 @@
+"""会话JSON解码后端
+
+原始日志每个会话带有大量转换用不到的字段，这里按需选择解码后端：
+- msgspec：按下面的TypedDict模式解码，未声明的字段在解析时直接跳过，不会构造Python对象；
+- orjson：完整解码，但比标准库快；
+- json：标准库回退实现。
+默认按 msgspec → orjson → json 的顺序选择已安装的后端，可以通过环境变量
+QWENFT_JSON_BACKEND 指定（会被进程池的工作进程继承）。各后端的返回值都是普通dict。
+"""
+import json
+import os
+from typing import Any, List, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND_ENV_VAR = "QWENFT_JSON_BACKEND"
+
+class ChatMessage(TypedDict, total=False):
+    # convert_data使用的字段
+    htmlBody: Any
+    fromRecipient: Any
+    sendTime: Any
+    # preprocess_data使用的字段
+    body: Any
+    externalNickName: Any
+
+class ChatSession(TypedDict, total=False):
+    meetingid: Any
+    chatHistory: List[ChatMessage]
+    agentloginid: Any
+    createmeetingtime: Any
+
+class SessionHeader(TypedDict, total=False):
+    # 只取会话级字段，chatHistory整体跳过（建立索引时使用）
+    meetingid: Any
+    agentloginid: Any
+    createmeetingtime: Any
+
+class SessionDecodeError(ValueError):
+    """会话JSON无法解码（各后端的异常统一转换为此类型）"""
+
+def _make_json_decoder(schema=None):
+    def decode(data):
+        try:
+            return json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise SessionDecodeError(str(e)) from e
+    return decode
+
+def _make_orjson_decoder(schema=None):
+    loads = orjson.loads
+
+    def decode(data):
+        try:
+            return loads(data)
+        except orjson.JSONDecodeError as e:
+            raise SessionDecodeError(str(e)) from e
+    return decode
+
+def _make_msgspec_decoder(schema=ChatSession):
+    typed_decode = msgspec.json.Decoder(schema).decode
+    fallback = _make_json_decoder()
+
+    def decode(data):
+        try:
+            return typed_decode(data)
+        except msgspec.ValidationError:
+            # 字段类型与模式不符（如chatHistory为null），交给标准库按原样解码
+            return fallback(data)
+        except (msgspec.DecodeError, UnicodeDecodeError) as e:
+            # 字符串中的非法UTF-8字节会以UnicodeDecodeError的形式抛出
+            raise SessionDecodeError(str(e)) from e
+    return decode
+
+BACKENDS = {
+    "msgspec": (lambda: msgspec is not None, _make_msgspec_decoder),
+    "orjson": (lambda: orjson is not None, _make_orjson_decoder),
+    "json": (lambda: True, _make_json_decoder),
+}
+
+def available_backends():
+    return [name for name, (is_available, _) in BACKENDS.items() if is_available()]
+
+def get_session_decoder(backend=None, header_only=False):
+    """返回 decode(str或bytes) -> dict 函数；backend为None时按环境变量或可用性自动选择
+
+    header_only=True 时msgspec后端只解码SessionHeader中的字段，其余后端仍返回完整dict。
+    """
+    backend = backend or os.environ.get(BACKEND_ENV_VAR) or available_backends()[0]
+    if backend not in BACKENDS:
+        raise ValueError(f"未知的JSON解码后端：{backend}，可选：{', '.join(BACKENDS)}")
+    is_available, make_decoder = BACKENDS[backend]
+    if not is_available():
+        raise ImportError(f"JSON解码后端{backend}未安装：pip install {backend}")
+    return make_decoder(SessionHeader if header_only else ChatSession)
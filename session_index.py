@@ -0,0 +1,279 @@
+"""原始日志的会话索引：session_id → (字节偏移, 长度, 行号, 创建时间, 客服ID)
+
+扫描一遍 chatHis.txt，生成旁路索引文件 <输入>.idx，之后按会话ID查找或随机抽样都不必重新扫描：
+    头部      32字节：魔数、记录数、建立索引时的输入大小、客服ID表的偏移
+    记录      每条36字节，按会话ID的8字节blake2b哈希排序（与convert_data增量清单中的哈希相同）：
+              哈希 u64、行首偏移 u64、创建时间 i64（UTC秒，无法解析时为CREATE_TIME_MISSING）、
+              行长度 u32、行号 u32、客服ID在客服ID表中的下标 u32
+    客服ID表  JSON数组，放在文件末尾
+查找时用mmap在记录区二分，再按偏移直接读出原始行；哈希冲突通过核对解码后的meetingid排除。
+同一会话ID出现多次时（日志中的重复导出）返回全部记录，按行号排列。
+索引沿用convert_data的逐行格式：每行一个会话（可带结尾逗号），与parse_line一致。preprocess_data
+读取的是首尾相接、可跨行的JSON对象，对象内部的换行会让这里把一个会话拆成无法解析的行而跳过，
+因此索引只适用于convert_data能逐行读取的输入；跨行的文件请先用preprocess_data转成JSONL再建索引。
+"""
+import calendar
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from convert_data import SYSTEM_PROMPT, convert_chat_session, parse_line, plan_shards
+from session_decoder import SessionDecodeError, get_session_decoder
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"QWSIDX01"
+_HEADER = struct.Struct("<8sQQQ")
+_RECORD = struct.Struct("<QQqIII")
+CREATE_TIME_MISSING = -(1 << 63)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def session_key(session_id):
+    """会话ID的8字节哈希（整数形式），与convert_data._session_hash一致"""
+    return int.from_bytes(hashlib.blake2b(str(session_id).encode('utf-8'), digest_size=8).digest(), 'big')
+
+def _parse_create_time(value):
+    try:
+        return calendar.timegm(datetime.strptime(str(value), TIME_FORMAT).timetuple())
+    except ValueError:
+        return CREATE_TIME_MISSING
+
+def _record_dtype():
+    """与_RECORD字节布局相同的结构化数组类型，建立索引时整块排序、写出；numpy只在建立索引时导入"""
+    import numpy as np
+
+    return np.dtype([("key", "<u8"), ("offset", "<u8"), ("create_time", "<i8"),
+                     ("length", "<u4"), ("line_num", "<u4"), ("agent", "<u4")])
+
+def _index_range(input_txt_path, byte_start, byte_end, line_start):
+    """扫描一个按换行对齐的字节区间，返回(记录结构化数组, 本区间的客服ID表, 跳过的行数)"""
+    import numpy as np
+
+    decode = get_session_decoder(header_only=True)
+    columns = {name: array(code) for name, code in
+               (("key", 'Q'), ("offset", 'Q'), ("create_time", 'q'), ("length", 'I'), ("line_num", 'I'), ("agent", 'I'))}
+    agents = {}
+    skipped = 0
+    with open(input_txt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(byte_start)
+        line_num = line_start
+        while mm.tell() < byte_end:
+            offset = mm.tell()
+            raw_line = mm.readline()
+            line = raw_line.strip()
+            if line.endswith(b','):
+                line = line[:-1]
+            if line.startswith(b'{'):
+                try:
+                    header = decode(line)
+                except SessionDecodeError:
+                    header = None
+                if isinstance(header, dict):
+                    # 缺少meetingid时与convert_data相同，使用session_<行号>
+                    session_id = header.get('meetingid', f"session_{line_num}")
+                    agent_id = str(header.get('agentloginid', ''))
+                    columns["key"].append(session_key(session_id))
+                    columns["offset"].append(offset)
+                    columns["create_time"].append(_parse_create_time(header.get('createmeetingtime')))
+                    columns["length"].append(len(raw_line))
+                    columns["line_num"].append(line_num)
+                    columns["agent"].append(agents.setdefault(agent_id, len(agents)))
+                else:
+                    skipped += 1
+            line_num += 1
+    records = np.empty(len(columns["key"]), dtype=_record_dtype())
+    for name, column in columns.items():
+        records[name] = np.frombuffer(column, dtype=column.typecode)
+    return records, list(agents), skipped
+
+def build_session_index(input_txt_path, index_path=None, num_workers=None):
+    """扫描原始日志并写出索引文件，返回索引路径；多进程按换行对齐的分片并行扫描"""
+    import numpy as np
+
+    index_path = index_path or input_txt_path + INDEX_SUFFIX
+    num_workers = num_workers or os.cpu_count() or 1
+    input_size = os.path.getsize(input_txt_path)
+    shards = plan_shards(input_txt_path, num_workers * 4, num_workers)
+
+    shard_records = []
+    agent_table = {}
+    skipped = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = pool.map(_index_range, [input_txt_path] * len(shards), [s["byte_start"] for s in shards],
+                           [s["byte_end"] for s in shards], [s["line_start"] for s in shards])
+        for records, agents, shard_skipped in results:
+            # 各分片的客服ID下标映射到全局客服ID表
+            agent_remap = np.array([agent_table.setdefault(agent_id, len(agent_table)) for agent_id in agents],
+                                   dtype=np.uint32)
+            records["agent"] = agent_remap[records["agent"]]
+            shard_records.append(records)
+            skipped += shard_skipped
+
+    # 按(哈希, 行号)原地排序，每条记录36字节，不为每个会话创建Python对象；
+    # 行号随偏移递增，同一会话的多条记录保持原始顺序。空输入时写出只有头部和空客服ID表的索引
+    records = np.concatenate(shard_records) if shard_records else np.empty(0, dtype=_record_dtype())
+    del shard_records
+    records.sort(order=("key", "line_num"))
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        table_offset = _HEADER.size + _RECORD.size * len(records)
+        f.write(_HEADER.pack(INDEX_MAGIC, len(records), input_size, table_offset))
+        f.write(records.tobytes())
+        f.write(json.dumps(list(agent_table), ensure_ascii=False).encode('utf-8'))
+    os.replace(tmp_path, index_path)
+    print(f"索引建立完成：{len(records)}个会话，跳过无法解析的行{skipped}行，客服{len(agent_table)}人")
+    print(f"索引路径：{index_path}")
+    return index_path
+
+class SessionIndex:
+    """只读打开索引，按会话ID查找、读取或随机抽样原始会话"""
+
+    def __init__(self, input_txt_path, index_path=None):
+        self.input_txt_path = input_txt_path
+        self.index_path = index_path or input_txt_path + INDEX_SUFFIX
+        with open(self.index_path, 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_records, self.input_size, table_offset = _HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"不是会话索引文件：{self.index_path}")
+        current_size = os.path.getsize(input_txt_path)
+        if current_size < self.input_size:
+            raise ValueError(f"输入文件比建立索引时小（{current_size} < {self.input_size}），索引已失效，请重建")
+        if current_size > self.input_size:
+            print(f"提示：输入文件在建立索引后有追加，字节偏移{self.input_size}之后的会话不在索引中")
+        self.agent_ids = json.loads(self._index[table_offset:].decode('utf-8'))
+        # 空文件无法mmap，此时索引中也没有记录，不会读取原始行
+        self._input = None
+        if self.input_size > 0:
+            with open(input_txt_path, 'rb') as f:
+                self._input = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.num_records
+
+    def close(self):
+        self._index.close()
+        if self._input is not None:
+            self._input.close()
+
+    def _key_at(self, position):
+        return struct.unpack_from("<Q", self._index, _HEADER.size + _RECORD.size * position)[0]
+
+    def entry(self, position):
+        """第position条记录（按哈希排序）"""
+        _, offset, create_time, length, line_num, agent = _RECORD.unpack_from(
+            self._index, _HEADER.size + _RECORD.size * position)
+        return {
+            "offset": offset,
+            "length": length,
+            "line_num": line_num,
+            "create_time": (None if create_time == CREATE_TIME_MISSING
+                            else datetime.fromtimestamp(create_time, timezone.utc).strftime(TIME_FORMAT)),
+            "agent_id": self.agent_ids[agent],
+        }
+
+    def lookup(self, session_id):
+        """返回该会话ID的全部索引记录（可能含哈希冲突的其他会话，read_session会再核对）"""
+        key = session_key(session_id)
+        low, high = 0, self.num_records
+        while low < high:
+            mid = (low + high) // 2
+            if self._key_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        entries = []
+        while low < self.num_records and self._key_at(low) == key:
+            entries.append(self.entry(low))
+            low += 1
+        return entries
+
+    def read_raw(self, entry):
+        """按索引记录从原始日志中取出该行（bytes）"""
+        return self._input[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def read_session(self, session_id):
+        """返回[(行号, 会话dict)]，已排除哈希冲突"""
+        sessions = []
+        for entry in self.lookup(session_id):
+            chat_session, _ = parse_line(entry["line_num"], self.read_raw(entry))
+            if chat_session is not None and str(chat_session.get('meetingid', f"session_{entry['line_num']}")) == str(session_id):
+                sessions.append((entry["line_num"], chat_session))
+        return sessions
+
+    def sample(self, k, seed=None):
+        """不重复地随机抽取k条索引记录"""
+        rng = random.Random(seed)
+        return [self.entry(position) for position in rng.sample(range(self.num_records), min(k, self.num_records))]
+
+def show_session(input_txt_path, session_id, system_prompt=SYSTEM_PROMPT):
+    """打印某个会话的原始记录和转换结果，索引不存在时先建立；返回找到的记录数"""
+    if not os.path.exists(input_txt_path + INDEX_SUFFIX):
+        build_session_index(input_txt_path)
+    index = SessionIndex(input_txt_path)
+    try:
+        sessions = index.read_session(session_id)
+    finally:
+        index.close()
+    if not sessions:
+        print(f"索引中没有会话{session_id}")
+    for line_num, chat_session in sessions:
+        qwen3_entry, notices = convert_chat_session(chat_session, line_num, system_prompt)
+        print(f"第{line_num}行：{json.dumps(chat_session, ensure_ascii=False)[:500]}")
+        for _, message in notices:
+            print(message)
+        print(f"转换结果：{json.dumps(qwen3_entry, ensure_ascii=False)}")
+    return len(sessions)
+
+def _self_check():
+    """空输入得到空索引；重复导出的会话按行号返回全部记录，无法解析的行被跳过"""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        empty_path = os.path.join(tmp_dir, "empty.txt")
+        open(empty_path, 'wb').close()
+        build_session_index(empty_path, num_workers=2)
+        index = SessionIndex(empty_path)
+        assert len(index) == 0 and index.lookup("s1") == [] and index.sample(3) == [] and index.agent_ids == []
+        index.close()
+
+        input_path = os.path.join(tmp_dir, "chatHis.txt")
+        sessions = [{"meetingid": f"s{i % 7}", "agentloginid": f"a{i % 3}", "createmeetingtime": "2024-01-02 03:04:05",
+                     "chatHistory": []} for i in range(50)]
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for i, session in enumerate(sessions):
+                f.write("{坏行\n" if i % 10 == 9 else json.dumps(session, ensure_ascii=False) + ",\n")
+        build_session_index(input_path, num_workers=2)
+        index = SessionIndex(input_path)
+        assert len(index) == 45
+        for i in range(7):
+            expected = [n + 1 for n in range(i, 50, 7) if n % 10 != 9]
+            assert [line_num for line_num, _ in index.read_session(f"s{i}")] == expected
+            assert all(e["agent_id"] == sessions[e["line_num"] - 1]["agentloginid"] for e in index.lookup(f"s{i}"))
+        assert index.entry(0)["create_time"] == "2024-01-02 03:04:05"
+        index.close()
+    print("自检通过")
+
+if __name__ == "__main__":
+    INPUT_RAW_DATA = "/root/qwenft/data/chatHis.txt"
+    # 排查单个会话时填入meetingid，打印原始记录和转换结果
+    LOOKUP_SESSION_ID = None
+    # 只在临时目录中运行自检，不读取INPUT_RAW_DATA
+    SELF_CHECK = False
+    if SELF_CHECK:
+        _self_check()
+        raise SystemExit
+    if LOOKUP_SESSION_ID is not None:
+        show_session(INPUT_RAW_DATA, LOOKUP_SESSION_ID)
+        raise SystemExit
+    if not os.path.exists(INPUT_RAW_DATA + INDEX_SUFFIX):
+        build_session_index(INPUT_RAW_DATA)
+    index = SessionIndex(INPUT_RAW_DATA)
+    for entry in index.sample(5):
+        print(entry)
+    index.close()
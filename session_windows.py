@@ -0,0 +1,169 @@
+"""按token预算把长会话切分为多个训练窗口
+
+SFT分词时超过max_seq_length的样本会被直接截断，尾部轮次既浪费了算力也学不到。
+SessionWindower 按Qwen3聊天模板估算每轮对话的token数，把会话贪心地切成若干窗口：
+    - 以“轮”为最小单位（连续消息直到一条assistant回复为止），每个窗口都以assistant结尾；
+    - 每个窗口都带system提示词，并在开头重复上一窗口最后overlap_rounds轮作为上下文；
+    - 单轮本身超过预算时单独成为一个窗口（训练时仍会被截断），计入window_oversized。
+未超出预算的会话原样输出（只在metadata中补充window_index=0、num_windows=1）。
+
+token数优先用传入的tokenizer精确计算；未提供tokenizer时按字符粗略估计（中文等非ASCII字符
+和数字各算1个token，其余字符每3个算1个），估计值通常偏大，切出的窗口不会超出预算。
+"""
+
+# Qwen3模板在最后一条assistant回复前插入的空思考块
+THINK_BLOCK = "<think>\n\n</think>\n\n"
+
+def estimate_tokens(text):
+    """不加载tokenizer时的保守估计"""
+    non_ascii = digits = 0
+    for ch in text:
+        if ch > '\x7f':
+            non_ascii += 1
+        elif ch.isdigit():
+            digits += 1
+    other = len(text) - non_ascii - digits
+    return non_ascii + digits + (other + 2) // 3
+
+class SessionWindower:
+    """可pickle，随任务发送到工作进程；tokenizer以名称传入时在各进程首次使用时加载"""
+
+    def __init__(self, max_tokens=2048, overlap_rounds=1, tokenizer=None):
+        if overlap_rounds < 0:
+            raise ValueError(f"overlap_rounds不能为负数：{overlap_rounds}")
+        self.max_tokens = max_tokens
+        self.overlap_rounds = overlap_rounds
+        self.tokenizer = tokenizer
+        self._tokenizer = None
+        self._template_tokens = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_tokenizer"] = None
+        return state
+
+    def _count_batch(self, texts):
+        if self.tokenizer is None:
+            return [estimate_tokens(text) for text in texts]
+        if self._tokenizer is None:
+            from token_store import load_tokenizer
+            self._tokenizer = load_tokenizer(self.tokenizer)
+        return [len(ids) for ids in self._tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def _template_overhead(self):
+        """各角色消息头尾、system块和思考块本身占用的token数"""
+        if self._template_tokens is None:
+            pieces = {
+                "user": "<|im_start|>user\n<|im_end|>\n",
+                "assistant": "<|im_start|>assistant\n<|im_end|>\n",
+                "system": "<|im_start|>system\n<|im_end|>\n",
+                "think": THINK_BLOCK,
+            }
+            self._template_tokens = dict(zip(pieces, self._count_batch(list(pieces.values()))))
+        return self._template_tokens
+
+    def _rounds(self, conversations):
+        """切分为以assistant结尾的轮次，返回[(起始下标, 结束下标), ...]"""
+        rounds = []
+        start = 0
+        for i, message in enumerate(conversations):
+            if message["role"] == "assistant":
+                rounds.append((start, i + 1))
+                start = i + 1
+        return rounds
+
+    def _fill(self, start, round_costs, budget):
+        """从第start轮开始尽量多地装入轮次，返回结束轮次（不含）；至少装入一轮"""
+        end = start
+        while end < len(round_costs) and round_costs[end] <= budget:
+            budget -= round_costs[end]
+            end += 1
+        return max(end, start + 1)
+
+    def split(self, entry, stats=None):
+        """返回切分后的样本列表；传入stats时累计切分计数和token覆盖率"""
+        conversations = entry["conversations"]
+        overhead = self._template_overhead()
+        content_tokens = self._count_batch([entry["system"]] + [m["content"] for m in conversations])
+        base_cost = content_tokens[0] + overhead["system"] + overhead["think"]
+        message_costs = [n + overhead[m["role"]] for n, m in zip(content_tokens[1:], conversations)]
+        rounds = self._rounds(conversations)
+        round_costs = [sum(message_costs[a:b]) for a, b in rounds]
+        total_tokens = base_cost + sum(round_costs)
+        budget = self.max_tokens - base_cost
+        if budget <= 0:
+            raise ValueError(f"system提示词和模板开销（{base_cost} token）已达到max_tokens（{self.max_tokens}），"
+                             f"窗口中放不下任何对话，请增大max_tokens或缩短system提示词")
+
+        # 贪心切分：下一窗口从上一窗口末尾回退overlap_rounds轮开始，且必须包含新的轮次
+        spans = []
+        start = 0
+        while True:
+            end = self._fill(start, round_costs, budget)
+            if spans and end <= spans[-1][1]:
+                start = spans[-1][1]
+                end = self._fill(start, round_costs, budget)
+            spans.append((start, end))
+            if end >= len(rounds):
+                break
+            start = max(end - self.overlap_rounds, start + 1)
+
+        # 覆盖率：整段落在某个不超预算窗口内的轮次计为已覆盖，超预算的单轮只计截断前的部分
+        covered_tokens = base_cost
+        covered_rounds = set()
+        oversized = 0
+        for start, end in spans:
+            if sum(round_costs[start:end]) <= budget:
+                covered_rounds.update(range(start, end))
+            else:
+                oversized += 1
+                if start not in covered_rounds:
+                    covered_tokens += max(0, min(round_costs[start], budget))
+        covered_tokens += sum(round_costs[i] for i in covered_rounds)
+        covered_tokens = min(covered_tokens, total_tokens)
+
+        if stats is not None:
+            stats.add_total("session_tokens", total_tokens)
+            stats.add_total("covered_tokens_before", min(total_tokens, self.max_tokens))
+            stats.add_total("covered_tokens_after", covered_tokens)
+            if len(spans) > 1:
+                stats.count("window_split")
+                stats.add_total("windows_from_split", len(spans))
+            if oversized:
+                stats.count("window_oversized", oversized)
+
+        windows = []
+        for window_index, (start, end) in enumerate(spans):
+            window_conversations = conversations[rounds[start][0]:rounds[end - 1][1]]
+            windows.append({
+                "system": entry["system"],
+                "conversations": window_conversations,
+                "metadata": {
+                    **entry["metadata"],
+                    "final_rounds": len(window_conversations),
+                    "window_index": window_index,
+                    "num_windows": len(spans),
+                },
+            })
+        return windows
+
+if __name__ == "__main__":
+    # 自检：长会话切分后每个窗口都不超出预算且以assistant结尾；system提示词本身超出预算时报错
+    rounds = [[{"role": "user", "content": f"第{i}个问题，" * 20}, {"role": "assistant", "content": f"第{i}个回答。" * 30}]
+              for i in range(40)]
+    entry = {"system": "你是客服助手。", "conversations": [m for r in rounds for m in r], "metadata": {}}
+    windower = SessionWindower(max_tokens=1024, overlap_rounds=1)
+    windows = windower.split(entry)
+    assert len(windows) > 1 and all(w["conversations"][-1]["role"] == "assistant" for w in windows)
+    overhead = windower._template_overhead()
+    for window in windows:
+        cost = estimate_tokens(window["system"]) + overhead["system"] + overhead["think"] + sum(
+            estimate_tokens(m["content"]) + overhead[m["role"]] for m in window["conversations"])
+        assert cost <= windower.max_tokens, cost
+    print(f"{len(entry['conversations'])}条消息切分为{len(windows)}个窗口")
+    try:
+        SessionWindower(max_tokens=64).split({**entry, "system": "请遵守以下规定。" * 20})
+        raise AssertionError("system提示词超出预算时应报错")
+    except ValueError as e:
+        print(f"system提示词超出预算：{e}")
+    print("自检通过")
@@ -0,0 +1,206 @@
+"""预分词的内存映射token存储
+
+convert_data 以 output_format="tokens" 输出时，每个会话按 qwen3_finetune.py 训练时相同的方式
+套用聊天模板（qwen3_template），再用fast tokenizer批量分词，写入一个目录：
+    tokens.bin   所有样本的token id首尾相接（词表超过65535时为uint32，否则uint16）
+    masks.bin    与tokens.bin逐一对应的uint8，1表示属于assistant回复、参与loss
+    offsets.bin  uint64，长度为样本数+1，第i个样本为tokens[offsets[i]:offsets[i+1]]
+    meta.json    样本数、token总数、dtype、tokenizer名称和聊天模板摘要等
+训练时 TokenStore 以numpy.memmap打开，可以随机访问任意样本而不把数据读入内存。
+"""
+import hashlib
+import json
+import os
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+from qwen3_template import compiled_renderer_matches, render_qwen3, render_with_template
+
+TOKENS_FILE = "tokens.bin"
+MASKS_FILE = "masks.bin"
+OFFSETS_FILE = "offsets.bin"
+META_FILE = "meta.json"
+
+ASSISTANT_HEADER = "<|im_start|>assistant\n"
+TURN_END = "<|im_end|>"
+
+def _typecode_for_vocab(vocab_size):
+    return 'H' if vocab_size <= 0xFFFF else 'I'
+
+def assistant_spans(text):
+    """返回渲染文本中每段assistant回复的字符区间（不含角色头，含结尾的<|im_end|>）"""
+    spans = []
+    start = text.find(ASSISTANT_HEADER)
+    while start != -1:
+        content_start = start + len(ASSISTANT_HEADER)
+        end = text.find(TURN_END, content_start)
+        end = len(text) if end == -1 else end + len(TURN_END)
+        spans.append((content_start, end))
+        start = text.find(ASSISTANT_HEADER, end)
+    return spans
+
+def assistant_mask(offset_mapping, spans):
+    """按token的字符起点判断是否落在assistant区间内"""
+    mask = bytearray(len(offset_mapping))
+    span_index = 0
+    for i, (char_start, _) in enumerate(offset_mapping):
+        while span_index < len(spans) and char_start >= spans[span_index][1]:
+            span_index += 1
+        if span_index == len(spans):
+            break
+        if char_start >= spans[span_index][0]:
+            mask[i] = 1
+    return mask
+
+def load_tokenizer(tokenizer):
+    """tokenizer可以是已加载的对象，也可以是名称或路径"""
+    if not isinstance(tokenizer, str):
+        return tokenizer
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError("输出预分词数据需要安装transformers：pip install transformers") from e
+    return AutoTokenizer.from_pretrained(tokenizer)
+
+class TokenStoreWriter:
+    """以convert_data写出器的接口（write/close）批量分词并追加到token存储目录"""
+
+    def __init__(self, path, tokenizer, batch_size=1000):
+        self.path = path
+        self.tokenizer = load_tokenizer(tokenizer)
+        if not self.tokenizer.is_fast:
+            raise ValueError("预分词需要fast tokenizer（需要offset_mapping计算assistant掩码）")
+        self.batch_size = batch_size
+        self._compiled_template = compiled_renderer_matches(self.tokenizer)
+        self.typecode = _typecode_for_vocab(len(self.tokenizer))
+        os.makedirs(path, exist_ok=True)
+        self._tokens_f = open(os.path.join(path, TOKENS_FILE), 'wb')
+        self._masks_f = open(os.path.join(path, MASKS_FILE), 'wb')
+        self._offsets_f = open(os.path.join(path, OFFSETS_FILE), 'wb')
+        self._num_tokens = 0
+        self._num_samples = 0
+        self._assistant_tokens = 0
+        array('Q', [0]).tofile(self._offsets_f)
+        self._pending = []
+
+    def write(self, entry):
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _render(self, entry):
+        # 与qwen3_finetune.py的格式化方式保持一致：模板与内置Qwen3渲染器一致时走字符串拼接
+        text = render_qwen3(entry["conversations"]) if self._compiled_template else None
+        if text is None:
+            text = render_with_template(self.tokenizer, entry["conversations"], entry["system"])
+        return text
+
+    def _flush(self):
+        if not self._pending:
+            return
+        texts = [self._render(entry) for entry in self._pending]
+        encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = array('Q')
+        for text, input_ids, offset_mapping in zip(texts, encoded["input_ids"], encoded["offset_mapping"]):
+            mask = assistant_mask(offset_mapping, assistant_spans(text))
+            array(self.typecode, input_ids).tofile(self._tokens_f)
+            self._masks_f.write(mask)
+            self._num_tokens += len(input_ids)
+            self._assistant_tokens += sum(mask)
+            offsets.append(self._num_tokens)
+        offsets.tofile(self._offsets_f)
+        self._num_samples += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self._flush()
+        for f in (self._tokens_f, self._masks_f, self._offsets_f):
+            f.close()
+        chat_template = self.tokenizer.chat_template or ""
+        meta = {
+            "num_samples": self._num_samples,
+            "num_tokens": self._num_tokens,
+            "assistant_tokens": self._assistant_tokens,
+            "dtype": "uint16" if self.typecode == 'H' else "uint32",
+            "byteorder": sys.byteorder,
+            "vocab_size": len(self.tokenizer),
+            "tokenizer": getattr(self.tokenizer, "name_or_path", ""),
+            "chat_template_sha1": hashlib.sha1(chat_template.encode('utf-8')).hexdigest(),
+        }
+        with open(os.path.join(self.path, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+class TokenStore:
+    """只读打开token存储，按下标返回 {"input_ids", "assistant_masks"}，可直接作为训练集
+
+    max_length 与SFT分词时的truncation一致，超长样本只取前max_length个token。
+    assistant_masks=False 时只返回input_ids，与按"text"字段分词训练时一样对整段计算loss。
+    """
+
+    def __init__(self, path, max_length=None, assistant_masks=True):
+        import numpy as np
+
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"token存储的字节序（{self.meta['byteorder']}）与本机不一致")
+        self.path = path
+        self.max_length = max_length
+        self.assistant_masks = assistant_masks
+        num_tokens = self.meta["num_tokens"]
+        # 空文件无法建立memmap，用空数组代替
+        self.tokens = (np.memmap(os.path.join(path, TOKENS_FILE), dtype=self.meta["dtype"], mode='r')
+                       if num_tokens else np.zeros(0, dtype=self.meta["dtype"]))
+        self.masks = (np.memmap(os.path.join(path, MASKS_FILE), dtype=np.uint8, mode='r')
+                      if num_tokens else np.zeros(0, dtype=np.uint8))
+        self.offsets = np.memmap(os.path.join(path, OFFSETS_FILE), dtype=np.uint64, mode='r')
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def lengths(self):
+        """各样本（截断后）的token数"""
+        import numpy as np
+
+        lengths = np.diff(self.offsets).astype(np.int64)
+        return lengths if self.max_length is None else np.minimum(lengths, self.max_length)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start = int(self.offsets[index])
+        end = int(self.offsets[index + 1])
+        if self.max_length is not None:
+            end = min(end, start + self.max_length)
+        sample = {"input_ids": self.tokens[start:end].astype('int64')}
+        if self.assistant_masks:
+            sample["assistant_masks"] = self.masks[start:end].astype('int64')
+        return sample
+
+class ConcatTokenStore:
+    """把多个TokenStore首尾相接成一个数据集（如按数据块分别缓存的token存储）"""
+
+    def __init__(self, stores):
+        self.stores = list(stores)
+        self._ends = list(accumulate(len(store) for store in self.stores))
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def lengths(self):
+        import numpy as np
+
+        return np.concatenate([store.lengths() for store in self.stores]) if self.stores else np.zeros(0, np.int64)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        store_index = bisect_right(self._ends, index)
+        start = self._ends[store_index - 1] if store_index else 0
+        return self.stores[store_index][index - start]